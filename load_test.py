@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+#Drive the WSGI app in-process with simulated players and report throughput,
+#latency percentiles and error rates per route, named as in /admin/metrics.
+#Compare with a report saved by an earlier run, exiting 1 if anything
+#regressed. Needs the App Engine SDK on the path, or passed with --sdk.
+
+parser = argparse.ArgumentParser(description="Load test the app in-process with simulated players.")
+parser.add_argument("-p", "--players", type=int, default=16,
+	help="simulated players [default: 16]")
+parser.add_argument("-d", "--duration", type=float, default=30,
+	help="seconds to run for [default: 30]")
+parser.add_argument("-w", "--wrong", type=float, default=0.2,
+	help="fraction of submissions that are wrong [default: 0.2]")
+parser.add_argument("-t", "--think", type=float, default=0.05,
+	help="most seconds a player waits between requests [default: 0.05]")
+parser.add_argument("-s", "--seed", type=int,
+	help="seed for the players' choices [default: random]")
+parser.add_argument("--sdk",
+	help="the App Engine SDK directory, to put its libraries on the path")
+parser.add_argument("--json", action="store_true",
+	help="print the report as json")
+parser.add_argument("-o", "--output",
+	help="save the report as json to this file, to compare later runs with")
+parser.add_argument("-b", "--baseline",
+	help="a report saved with --output to compare with, exiting 1 if anything regressed")
+parser.add_argument("--threshold", type=float, default=0.2,
+	help="the fraction p95 latency may grow, or throughput drop, by before it is flagged [default: 0.2]")
+args = parser.parse_args()
+
+if args.sdk:
+	sys.path.insert(0, args.sdk)
+	import dev_appserver
+	dev_appserver.fix_sys_path()
+
+import main
+import webapp2
+
+_player = threading.local()
+
+class FakeUser(object):
+	"""Stands in for google.appengine.api.users.User"""
+
+	def __init__(self, nickname):
+		self._nickname = nickname
+
+	def nickname(self):
+		return self._nickname
+
+# every request is made by the player of the calling thread
+main.users.get_current_user = lambda: FakeUser(_player.name)
+
+
+class Stats(object):
+	"""Latencies and statuses of the requests to each route"""
+
+	def __init__(self):
+		self.latencies = {}
+		self.statuses = {}
+		self._lock = threading.Lock()
+
+	def add(self, route, status, seconds):
+		with self._lock:
+			self.latencies.setdefault(route, []).append(seconds)
+			counts = self.statuses.setdefault(route, {})
+			counts[status] = counts.get(status, 0) + 1
+
+	def report(self, elapsed):
+		"""Returns a json serializable report of the requests so far"""
+		routes = {}
+		total = 0
+		for route, latencies in self.latencies.iteritems():
+			latencies = sorted(latencies)
+			statuses = self.statuses[route]
+			total += len(latencies)
+			routes[route] = {
+				"requests": len(latencies),
+				"per_second": len(latencies) / elapsed,
+				"p50": percentile(latencies, 0.50),
+				"p95": percentile(latencies, 0.95),
+				"p99": percentile(latencies, 0.99),
+				"max": latencies[-1],
+				"client_errors": sum(count for status, count in statuses.iteritems() if 400 <= status < 500) / float(len(latencies)),
+				"server_errors": sum(count for status, count in statuses.iteritems() if status >= 500) / float(len(latencies)),
+				"statuses": statuses,
+			}
+		return {"seconds": elapsed, "requests": total, "per_second": total / elapsed, "routes": routes}
+
+STATS = Stats()
+
+def percentile(values, fraction):
+	"""Returns the value at a fraction of the way through sorted values"""
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def request(method, path, body=None):
+	"""Make a request to the app as the current player
+
+	Returns: A tuple (status, parsed json body or None).
+	"""
+	req = webapp2.Request.blank(path)
+	req.method = method
+	if body is not None:
+		req.body = json.dumps(body)
+		req.content_type = "application/json"
+	match = main.app.router.match(req)
+	route = main.metrics.route_name(method, match[0].template if match else path)
+
+	start = time.time()
+	response = req.get_response(main.app)
+	STATS.add(route, response.status_int, time.time() - start)
+
+	try:
+		return response.status_int, json.loads(response.body)
+	except ValueError:
+		return response.status_int, None
+
+def solution_for(problem, wrong):
+	"""Returns a solution to a problem, or a wrong one"""
+	if wrong:
+		return "def {0}(value):\n\treturn value\n".format(problem.expected_func)
+	answers = dict(zip(problem.test_inputs, problem.expected_outputs))
+	return "def {0}(value):\n\treturn {1!r}[value]\n".format(problem.expected_func, answers)
+
+def play(name, deadline, choices):
+	"""Play games as one player until the deadline"""
+	_player.name = name
+	status, joined = request("POST", "/tables", {"action": "join"})
+	if status != 200:
+		return
+	table_id = joined["table_id"]
+	seat_num = joined["seat"]["seat_num"]
+	base = "/tables/{0}".format(table_id)
+	seq = 0
+
+	while time.time() < deadline:
+		status, game = request("GET", base + "/game")
+		if status != 200:
+			break
+		seat = game["seats"][seat_num]
+		if game["state"] == "ready" and seat_num == 0:
+			request("POST", base + "/game", {"action": "start"})
+		elif game["state"] == "playing" and seat["active"]:
+			request("GET", base + "/code")
+			# the harness peeks at the problem to play like someone who can code
+			table = main.TABLES.get(table_id)
+			task = table.get_seat(name).coding_task if table else None
+			if task is not None:
+				request("POST", base + "/code", {"solution": solution_for(task.problem, choices.random() < args.wrong)})
+		else:
+			status, events = request("GET", base + "/events?since={0}".format(seq))
+			if status == 200:
+				seq = events["seq"]
+		time.sleep(choices.random() * args.think)
+
+def print_report(report):
+	print "{0} requests in {1:.1f}s, {2:.1f} requests/s".format(report["requests"], report["seconds"], report["per_second"])
+	print "{0:<40} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>7} {7:>7}".format(
+		"route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "4xx %", "5xx %")
+	for route, stats in sorted(report["routes"].iteritems()):
+		print "{0:<40} {1:8d} {2:8.1f} {3:9.2f} {4:9.2f} {5:9.2f} {6:7.1f} {7:7.1f}".format(route,
+			stats["requests"], stats["per_second"], stats["p50"] * 1000, stats["p95"] * 1000, stats["p99"] * 1000,
+			stats["client_errors"] * 100, stats["server_errors"] * 100)
+
+def compare(baseline, report, threshold):
+	"""Compare a report with an earlier one
+
+	A route regressed if its p95 latency grew by more than threshold
+	or its rate of server errors grew at all. The run regressed if its
+	throughput dropped by more than threshold.
+
+	Returns: A list of the names of the routes that regressed, and
+	  "requests/s" if the throughput did.
+	"""
+	regressions = []
+	print "{0:<40} {1:>12} {2:>12} {3:>8} {4:>7} {5:>7}".format("route", "before p95", "after p95", "change", "5xx %", "was %")
+	for route, stats in sorted(report["routes"].iteritems()):
+		before = baseline["routes"].get(route)
+		if before is None:
+			print "{0:<40} {1:>12} {2:12.2f} {3:>8}".format(route, "-", stats["p95"] * 1000, "new")
+			continue
+		change = stats["p95"] / before["p95"] - 1 if before["p95"] else 0.0
+		flag = ""
+		if change > threshold or stats["server_errors"] > before["server_errors"]:
+			regressions.append(route)
+			flag = "  REGRESSION"
+		print "{0:<40} {1:12.2f} {2:12.2f} {3:+7.1f}% {4:7.1f} {5:7.1f}{6}".format(route, before["p95"] * 1000, stats["p95"] * 1000,
+			change * 100, stats["server_errors"] * 100, before["server_errors"] * 100, flag)
+	change = report["per_second"] / baseline["per_second"] - 1 if baseline["per_second"] else 0.0
+	flag = ""
+	if change < -threshold:
+		regressions.append("requests/s")
+		flag = "  REGRESSION"
+	print "{0:<40} {1:12.1f} {2:12.1f} {3:+7.1f}%{4}".format("requests/s", baseline["per_second"], report["per_second"], change * 100, flag)
+	return regressions
+
+if __name__ == "__main__":
+	baseline = None
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			baseline = json.load(baseline_file)
+
+	seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+	start = time.time()
+	deadline = start + args.duration
+	players = [threading.Thread(target=play, args=("player{0}".format(num), deadline, random.Random(seed + num)))
+		for num in xrange(args.players)]
+	for player in players:
+		player.daemon = True
+		player.start()
+	for player in players:
+		player.join()
+
+	report = STATS.report(time.time() - start)
+	report["seed"] = seed
+	if args.json:
+		print json.dumps(report, indent=2, sort_keys=True)
+	else:
+		print_report(report)
+	if args.output:
+		with open(args.output, "w") as output:
+			json.dump(report, output, indent=2, sort_keys=True)
+
+	if baseline is not None and compare(baseline, report, args.threshold):
+		sys.exit(1)
@@ -14,19 +14,57 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from speedcoders import startup
 from speedcoders import sc_exceptions as exc
+from speedcoders import challenges
 from speedcoders import game
+from speedcoders import grading
+from speedcoders import lobby
+from speedcoders import locks
+from speedcoders import metrics
+from speedcoders import state_store
 
 import json
+import pstats
+import Queue
+import time
 import traceback
 
 from google.appengine.api import users
 import webapp2
 
-GAME = game.Table(seats=4, tokens=2)
+# a SQLite file shared by every instance on this machine, or None to
+# keep tables in this instance, without saving them anywhere
+STATE_STORE_FILE = None
+TABLES = lobby.TableRegistry(seats=4, tokens=2,
+	store=state_store.open_store(STATE_STORE_FILE) if STATE_STORE_FILE is not None else None)
+# the table served by the routes that don't name one
+DEFAULT_TABLE_ID = "default"
+TABLES.get_or_create(DEFAULT_TABLE_ID, pinned=True)
+GRADER = grading.GradingQueue()
 DEBUG = True
+# the longest a job poll will wait for grading to finish
+MAX_POLL_WAIT = 20
+# the most seats a table created by a player may have
+MAX_TABLE_SEATS = 16
 
 class BaseHandler(webapp2.RequestHandler):
+	# whether requests to this handler may be picked for profiling
+	profiled = True
+
+	def dispatch(self):
+		# record the latency of every request under its route template
+		profile = metrics.PROFILER.begin() if self.profiled else None
+		start = time.time()
+		try:
+			super(BaseHandler, self).dispatch()
+		finally:
+			route = self.request.route
+			name = metrics.route_name(self.request.method, route.template if route else self.request.path)
+			metrics.ROUTES.record(name, time.time() - start)
+			if profile is not None:
+				metrics.PROFILER.end(profile)
+
 	def handle_exception(self, exception, debug):
 		if isinstance(exception, webapp2.HTTPException):
 			self.response.write(str(exception))
@@ -60,60 +98,182 @@ class BaseHandler(webapp2.RequestHandler):
 		self.response.write(json_str)
 		self.response.headers['Content-Type'] = 'application/json'
 
+	def write_snapshot(self, snapshot):
+		"""Write a Table snapshot, or 304 if the client already has it"""
+		etag, json_str = snapshot
+		self.response.headers['ETag'] = etag
+		self.response.headers['Cache-Control'] = 'no-cache'
+		known = [tag.strip() for tag in self.request.headers.get('If-None-Match', '').split(',')]
+		if etag in known or '*' in known:
+			self.response.set_status(304)
+			return
+		self.write_json(json_str)
+
+	def bounded_int(self, post_data, name, low, high):
+		"""Returns an optional int parameter, or None if missing
+
+		Throws: IllegalArgumentException if the parameter is not an int
+		  between low and high, inclusive.
+		"""
+		value = post_data.get(name)
+		if value is None:
+			return None
+		if isinstance(value, bool) or not isinstance(value, (int, long)) or not low <= value <= high:
+			raise exc.IllegalArgumentException("'{0}' must be an integer from {1} to {2}".format(name, low, high))
+		return value
+
+	def query_number(self, name, convert=int, default=0):
+		"""Returns a numeric query parameter, or default if missing
+
+		Throws: IllegalArgumentException if the parameter is not a
+		  finite, non-negative number.
+		"""
+		value = self.request.get(name)
+		if not value:
+			return default
+		try:
+			value = convert(value)
+		except ValueError:
+			raise exc.IllegalArgumentException("'{0}' must be a number".format(name))
+		# rejects nan too
+		if not 0 <= value < float('inf'):
+			raise exc.IllegalArgumentException("'{0}' must be a non-negative number".format(name))
+		return value
+
+	def get_table(self, table_id):
+		table = TABLES.get(table_id)
+		if table is None:
+			webapp2.abort(404, detail="no such table '{0}'".format(table_id))
+		return table
+
 
 class CodeHandler(BaseHandler):
-	def get(self):
+	def get(self, table_id=DEFAULT_TABLE_ID):
 		user = self.login()
 		if not user:
 			return;
 
-		challenge = GAME.get_challenge(user.nickname())
+		table = self.get_table(table_id)
+		# raises if the user isn't at the table
+		table.get_challenge(user.nickname())
 
-		self.write_json(challenge)
+		self.write_snapshot(table.snapshot())
 
-	def post(self, seat_num):
+	def post(self, table_id=DEFAULT_TABLE_ID):
 		user = self.login()
 		if not user:
 			return;
 
+		table = self.get_table(table_id)
+
 		post_data = json.loads(self.request.body)
 
-		if 'solution' in post_data:
-			result = GAME.submit_answer(user.nickname(), post_data['solution'])
-		else:
-			raise webapp2.HTTPBadRequest("missing parameter 'solution'")
+		if 'solution' not in post_data:
+			raise exc.IllegalArgumentException("missing parameter 'solution'")
 
+		if post_data.get('async'):
+			# queue the solution and let the client poll for the result
+			try:
+				job = GRADER.submit(user.nickname(), post_data['solution'], table.submit_answer)
+			except Queue.Full:
+				webapp2.abort(503, detail="too many solutions waiting to be graded")
+			self.response.set_status(202)
+			self.write_json(json.dumps({"job_id": job.id, "state": job.state, "url": "/code/jobs/" + job.id}))
+			return
+
+		result = table.submit_answer(user.nickname(), post_data['solution'])
 		self.write_json(result)
 
 
+class DraftHandler(BaseHandler):
+	def post(self, table_id=DEFAULT_TABLE_ID):
+		user = self.login()
+		if not user:
+			return;
+
+		table = self.get_table(table_id)
+		post_data = json.loads(self.request.body)
+
+		if 'version' not in post_data:
+			raise exc.IllegalArgumentException("missing parameter 'version'")
+		version = post_data['version']
+		if isinstance(version, bool) or not isinstance(version, (int, long)) or version < 0:
+			raise exc.IllegalArgumentException("'version' must be a non-negative integer")
+		if not isinstance(post_data.get('patches'), list):
+			raise exc.IllegalArgumentException("missing parameter 'patches'")
+
+		version = table.update_draft(user.nickname(), version, post_data['patches'])
+		self.write_json(json.dumps({"version": version}))
+
+
+class JobHandler(BaseHandler):
+	def get(self, job_id):
+		user = self.login()
+		if not user:
+			return;
+
+		# long-poll: wait for grading to finish for up to 'wait' seconds
+		wait = min(self.query_number('wait', float), MAX_POLL_WAIT)
+
+		job = GRADER.get(job_id)
+		if job is None or job.user != user.nickname():
+			webapp2.abort(404, detail="no such job '{0}'".format(job_id))
+
+		if wait > 0:
+			job.wait(wait)
+
+		if job.state == grading.FAILED:
+			raise job.error
+		if job.state != grading.DONE:
+			self.response.set_status(202)
+			self.write_json(json.dumps({"job_id": job.id, "state": job.state}))
+			return
+		# job.result is the json object submit_answer returned, so its
+		# "result" and "game" follow the job's own keys
+		self.write_json('{{"job_id": {0}, "state": {1}, {2}'.format(
+			json.dumps(job.id), json.dumps(job.state), job.result.lstrip()[1:]))
+
+
 class SeatHandler(BaseHandler):
-	def post(self, seat_num):
+	def post(self, seat_num, table_id=DEFAULT_TABLE_ID):
 		user = self.login()
 		if not user:
 			return;
 
+		# 404 if there is no such table
+		self.get_table(table_id)
 		post_data = json.loads(self.request.body)
 
 		if "action" in post_data:
 			if post_data['action'] == 'sit':
-				seat = GAME.add_user(user.nickname(), int(seat_num))
+				seat = TABLES.sit(table_id, user.nickname(), int(seat_num))
 			elif post_data['action'] == 'stand':
-				seat = GAME.remove_user(user.nickname())
+				seat = TABLES.stand(table_id, user.nickname())
 			else:
-				raise webapp2.HTTPBadRequest("action must be 'sit' or 'stand'")
+				raise exc.IllegalArgumentException("action must be 'sit' or 'stand'")
 		else:
-			raise webapp2.HTTPBadRequest("missing parameter 'action'")
+			raise exc.IllegalArgumentException("missing parameter 'action'")
 
 		self.write_json(seat)
 
 
-class MainHandler(BaseHandler):
+class WarmupHandler(BaseHandler):
+	def get(self):
+		# load the word model before the instance takes real traffic
+		challenges.get_word_generator()
+
+
+class TablesHandler(BaseHandler):
 	def get(self):
 		user = self.login()
 		if not user:
 			return;
 
-		self.write_json(GAME.to_json())
+		self.write_json(json.dumps([{
+			"table_id": table_id,
+			"seat_count": table.seat_count,
+			"empty_seats": [seat.num for seat in table.table if seat.empty()],
+		} for table_id, table in TABLES.open_tables()]))
 
 	def post(self):
 		user = self.login()
@@ -122,17 +282,190 @@ class MainHandler(BaseHandler):
 
 		post_data = json.loads(self.request.body)
 
+		if 'action' in post_data:
+			if post_data['action'] == 'create':
+				seats = self.bounded_int(post_data, 'seats', 2, MAX_TABLE_SEATS)
+				max_tokens = (seats or TABLES.seats) - 1
+				tokens = self.bounded_int(post_data, 'tokens', 1, max_tokens)
+				if tokens is None:
+					# the default may not fit a small table
+					tokens = min(TABLES.tokens, max_tokens)
+				record = post_data.get('record', False)
+				if not isinstance(record, bool):
+					raise exc.IllegalArgumentException("'record' must be true or false")
+				table_id, table = TABLES.create(seats, tokens, record=record)
+				seat = None
+			elif post_data['action'] == 'join':
+				table_id, seat = TABLES.join(user.nickname())
+			else:
+				raise exc.IllegalArgumentException("action must be 'create' or 'join'")
+		else:
+			raise exc.IllegalArgumentException("missing parameter 'action'")
+
+		self.write_json('{{"table_id": {0}, "seat": {1}}}'.format(json.dumps(table_id), seat or "null"))
+
+
+class EventsHandler(BaseHandler):
+	def get(self, table_id=DEFAULT_TABLE_ID):
+		user = self.login()
+		if not user:
+			return;
+
+		table = self.get_table(table_id)
+		# EventSource clients resume from the Last-Event-ID header
+		if self.request.headers.get('Last-Event-ID'):
+			try:
+				since = max(int(self.request.headers['Last-Event-ID']), 0)
+			except ValueError:
+				# not an id we gave out, so start the stream over
+				since = 0
+		else:
+			since = self.query_number('since')
+		wait = min(self.query_number('wait', float), MAX_POLL_WAIT)
+		stream = 'text/event-stream' in self.request.headers.get('Accept', '')
+		if stream and not self.request.get('wait'):
+			wait = MAX_POLL_WAIT
+
+		events, resync = table.events_since(since, wait)
+
+		if stream:
+			# App Engine buffers responses, so each response carries the
+			# events of one long-poll and EventSource reconnects for more
+			self.response.headers['Content-Type'] = 'text/event-stream'
+			self.response.headers['Cache-Control'] = 'no-cache'
+			self.response.write("retry: 0\n\n")
+			if resync:
+				self.response.write("event: resync\ndata: {}\n\n")
+			for event in events:
+				self.response.write("id: {0}\ndata: {1}\n\n".format(event["seq"], json.dumps(event)))
+			return
+
+		self.write_json(json.dumps({
+			"events": events,
+			"resync": resync,
+			"seq": events[-1]["seq"] if events else since,
+		}))
+
+
+class AdminHandler(BaseHandler):
+	profiled = False
+
+	def dispatch(self):
+		if not users.is_current_user_admin():
+			self.response.write("admins only")
+			self.response.set_status(403)
+			return
+		super(AdminHandler, self).dispatch()
+
+
+class MetricsHandler(AdminHandler):
+	def get(self):
+		self.write_json(json.dumps({
+			"routes": metrics.ROUTES.report(),
+			"operations": metrics.OPERATIONS.report(),
+			"locks": locks.report(),
+			"problem_pool": game.Seat.challenge_generator.stats(),
+			"startup": startup.report(),
+			"profiler": {"profiled": metrics.PROFILER.profiled, "remaining": metrics.PROFILER.remaining},
+		}))
+
+	def post(self):
+		post_data = json.loads(self.request.body)
+
+		if post_data.get('action') == 'reset':
+			metrics.ROUTES.reset()
+			metrics.OPERATIONS.reset()
+		else:
+			raise exc.IllegalArgumentException("action must be 'reset'")
+		self.response.set_status(204)
+
+
+class RecordingHandler(AdminHandler):
+	def get(self, table_id):
+		# for replay_benchmark.py, from tables created with 'record'
+		table = self.get_table(table_id)
+		if table.actions is None:
+			raise exc.IllegalStateException("Table {0} isn't being recorded.".format(table_id))
+		self.write_json(json.dumps(table.recording()))
+
+
+class ProfileHandler(AdminHandler):
+	def get(self):
+		sort = self.request.get('sort', 'cumulative')
+		if sort not in pstats.Stats.sort_arg_dict_default:
+			raise exc.IllegalArgumentException("'sort' must be one of {0}".format(", ".join(sorted(pstats.Stats.sort_arg_dict_default))))
+		try:
+			limit = int(self.request.get('limit', 40))
+		except ValueError:
+			raise exc.IllegalArgumentException("'limit' must be an integer")
+		self.response.headers['Content-Type'] = 'text/plain'
+		self.response.write(metrics.PROFILER.report(sort, limit))
+
+	def post(self):
+		post_data = json.loads(self.request.body)
+
 		if 'action' in post_data:
 			if post_data['action'] == 'start':
-				GAME.play()
+				if 'requests' not in post_data:
+					raise exc.IllegalArgumentException("missing parameter 'requests'")
+				try:
+					requests, rate = int(post_data['requests']), float(post_data.get('rate', 1.0))
+				except (TypeError, ValueError):
+					raise exc.IllegalArgumentException("'requests' must be an integer and 'rate' a number")
+				metrics.PROFILER.start(requests, rate)
+			elif post_data['action'] == 'stop':
+				metrics.PROFILER.stop()
 			else:
-				raise webapp2.HTTPBadRequest("action must be 'start'")
+				raise exc.IllegalArgumentException("action must be 'start' or 'stop'")
 		else:
-			raise webapp2.HTTPBadRequest("missing parameter 'action'")
-		self.write_json(GAME.to_json())
+			raise exc.IllegalArgumentException("missing parameter 'action'")
+		self.write_json(json.dumps({"profiled": metrics.PROFILER.profiled, "remaining": metrics.PROFILER.remaining}))
+
+
+class MainHandler(BaseHandler):
+	def get(self, table_id=DEFAULT_TABLE_ID):
+		user = self.login()
+		if not user:
+			return;
+
+		self.write_snapshot(self.get_table(table_id).snapshot())
+
+	def post(self, table_id=DEFAULT_TABLE_ID):
+		user = self.login()
+		if not user:
+			return;
+
+		table = self.get_table(table_id)
+		post_data = json.loads(self.request.body)
+
+		if 'action' in post_data:
+			if post_data['action'] == 'start':
+				table.play()
+			elif post_data['action'] == 'close':
+				TABLES.close(table_id)
+			else:
+				raise exc.IllegalArgumentException("action must be 'start' or 'close'")
+		else:
+			raise exc.IllegalArgumentException("missing parameter 'action'")
+		self.write_json(table.to_json())
 
 app = webapp2.WSGIApplication([
 	('/code', CodeHandler),
+	('/code/jobs/(\w+)', JobHandler),
+	('/code/draft', DraftHandler),
 	('/seats/(\d+)', SeatHandler),
 	('/game', MainHandler),
+	('/game/events', EventsHandler),
+	('/tables', TablesHandler),
+	webapp2.Route('/tables/<table_id:\w+>/game', MainHandler),
+	webapp2.Route('/tables/<table_id:\w+>/events', EventsHandler),
+	webapp2.Route('/tables/<table_id:\w+>/seats/<seat_num:\d+>', SeatHandler),
+	webapp2.Route('/tables/<table_id:\w+>/code', CodeHandler),
+	webapp2.Route('/tables/<table_id:\w+>/code/draft', DraftHandler),
+	('/admin/metrics', MetricsHandler),
+	('/admin/profile', ProfileHandler),
+	webapp2.Route('/admin/tables/<table_id:\w+>/recording', RecordingHandler),
+	('/_ah/warmup', WarmupHandler),
 ], debug=True)
+
+startup.record("app_import", time.time() - startup.STARTED)
@@ -1,12 +1,50 @@
+import marshal
 import random
+import struct
+import threading
+import time
 
+import sandbox
+import startup
 import word_generator
 
-WORD_GENERATOR = word_generator.load("word_gen4.pickle")
+# The word model is only loaded the first time a word is generated. Set
+# WORD_MODEL_MMAP to memory-map a compact model so that every process on
+# the machine shares one copy of its pages.
+WORD_MODEL_FILE = "word_gen4.pickle"
+WORD_MODEL_MMAP = False
+
+# random_string hands out words from a buffer refilled this many at a time
+WORD_BUFFER_SIZE = 64
+
+# serialized problems are marshalled tuples tagged with this version, and
+# streams of them prefix each problem with its length
+PROBLEM_FORMAT_VERSION = 1
+PROBLEM_LENGTH = struct.Struct("<I")
+
+_word_generator = None
+_word_generator_lock = threading.Lock()
+_word_buffer = []
+
+def get_word_generator():
+	"""Returns the shared word generator, loading it on first use"""
+	global _word_generator
+	if _word_generator is None:
+		with _word_generator_lock:
+			if _word_generator is None:
+				start = time.time()
+				generator = word_generator.load(WORD_MODEL_FILE, WORD_MODEL_MMAP)
+				startup.record("word_model", time.time() - start)
+				_word_generator = generator
+	return _word_generator
 
 class CodingProblem(object):
 	"""A procedurally generated coding problem
 
+	A plain record of everything needed to grade a solution, so that
+	problems can be generated ahead of time, stored with dumps and
+	loaded into another process with loads.
+
 	Note that this is NOT a safe class. Execing code passed in
 	from a user is a bad idea, generally. Only run this in
 	carefully controlled situations where you trust the users.
@@ -15,47 +53,74 @@ class CodingProblem(object):
 	  statement: A str. The statement of the problem sent to the user.
 	  expected_func: A str. The name of the function that the user
 	    is instructed to write.
-	  validator: A function. The validator takes the user's function
-	    as an argument and calls it against a set of test cases,
-	    verifying correctness.
+	  test_inputs: A list. Every value the user's function is called
+	    with.
+	  expected_outputs: A list. The value the user's function should
+	    return for each test input, computed when the problem is
+	    generated.
+	  kind: A str. The KIND of the generator that made the problem,
+	    or None.
 	"""
 
-	def __init__(self, statement, expected_func, validator):
+	def __init__(self, statement, expected_func, test_inputs, expected_outputs, kind=None):
 		"""Initialize this CodingProblem
 
 		Args:
 		  statement: A str. The statement of the problem sent to the user.
 		  expected_func: A str. The name of the function that the user
 		    is instructed to write.
-		  validator: A function. The validator takes the user's function
-		    as an argument and calls it against a set of test cases,
-		    verifying correctness.
+		  test_inputs: A list. Every value the user's function is
+		    called with.
+		  expected_outputs: A list. The correct output for each test
+		    input, in the same order.
+		  kind: A str. The kind of problem. [Default: None]
 		"""
 		self.statement = statement
 		self.expected_func = expected_func
-		self.validator = validator
+		self.test_inputs = list(test_inputs)
+		self.expected_outputs = list(expected_outputs)
+		self.kind = kind
+
+	def dumps(self):
+		"""Returns this problem serialized as a str
+
+		Test inputs and outputs must be built in types, such as str
+		and int, which every problem generator uses.
+		"""
+		return marshal.dumps((PROBLEM_FORMAT_VERSION, self.kind, self.statement,
+			self.expected_func, self.test_inputs, self.expected_outputs))
+
+	@classmethod
+	def loads(cls, data):
+		"""Returns the CodingProblem serialized in a str by dumps
+
+		Throws: ValueError if the data is not a serialized problem of
+		  a known format version.
+		"""
+		record = marshal.loads(data)
+		if not isinstance(record, tuple) or record[0] != PROBLEM_FORMAT_VERSION:
+			raise ValueError("not a version {0} problem".format(PROBLEM_FORMAT_VERSION))
+		version, kind, statement, expected_func, test_inputs, expected_outputs = record
+		return cls(statement, expected_func, test_inputs, expected_outputs, kind)
 
 	def validate(self, solution):
-		"""Validate the solution against the validator
+		"""Validate the solution against the expected outputs
 
-		Execs the user's code and runs it agains the validator. This is
-		NOT a safe function. Execing code passed in from a user is a
-		bad idea, generally. Only run this in carefully controlled
-		situations where you trust the users.
+		Execs the user's code, usually in a sandbox worker process,
+		and calls it on every test input, timing each call. The
+		outputs are compared with the expected outputs in the same
+		process, so only the verdict comes back. This is NOT a safe function. Execing code passed in
+		from a user is a bad idea, generally. Only run this in
+		carefully controlled situations where you trust the users.
 
 		Args:
 		  solution: A string. Contrains the user's python code.
 
-		Returns: A bool. True if the user's solution passed
-		  all tests.
+		Returns: A sandbox.ExecutionResult. It is truthy if the user's
+		  solution passed all tests. Its failed_cases lists the
+		  indexes of the test inputs it got wrong.
 		"""
-		try:
-			exec solution
-			return self.validator(locals()[self.expected_func])
-		except:
-			import traceback
-			traceback.print_exc()
-			return False
+		return sandbox.execute(solution, self.expected_func, self.test_inputs, self.expected_outputs)
 
 	def __str__(self):
 		return self.statement
@@ -69,195 +134,285 @@ class IfStatement(object):
 	Attrs:
 	  statement: A str. A part of the problem statement describing
 	    when the if condition should evaluate to true.
-	  is_strue: A function. Takes a value and returns true if this
-	    if condition is satisfied by the value.
+	  condition: A function. Takes the values of this if statement
+	    and a value, and returns true if the value satisfies it.
+	    Shared by every if statement of the same kind.
+	  values: A dict. The values this if statement was generated with.
 	  test_cases: A tuple of values. These values are designed to
 	    test boundary conditions of the if statement to make sure
 	    it is implemented correctly.
 	"""
 
-	def __init__(self, statement, is_true, test_cases):
+	def __init__(self, statement, condition, values, test_cases):
 		"""Initialize this IfStatement
 
 		Args:
 		  statement: A str. A part of the problem statement describing
 		    when the if condition should evaluate to true.
-		  is_strue: A function. Takes a value and returns true if this
-		    if condition is satisfied by the value.
+		  condition: A function(values, value) that returns true if
+		    the value satisfies the if statement.
+		  values: A dict. The values the if statement was generated
+		    with.
 		  test_cases: A tuple of values. These values are designed to
 		    test boundary conditions of the if statement to make sure
 		    it is implemented correctly.
 		"""
 		self.statement = statement
-		self.is_true = is_true
+		self.condition = condition
+		self.values = values
 		self.test_cases = test_cases
 
+	def is_true(self, value):
+		"""Returns true if the value satisfies this if condition"""
+		return self.condition(self.values, value)
+
 	def __str__(self):
 		return self.statement
 
-def random_string():
-	"""Generate an english-like random word"""
-	return WORD_GENERATOR.generate_word()
+def write_problems(fileobj, problems):
+	"""Write a stream of serialized problems to a file
 
-def validator(validator_gen, test_cases):
-	"""Create a function that will validate a solution
+	Args:
+	  fileobj: A file opened for binary writing.
+	  problems: An iterable of CodingProblems.
+
+	Returns: An int. The number of problems written.
+	"""
+	count = 0
+	for problem in problems:
+		data = problem.dumps()
+		fileobj.write(PROBLEM_LENGTH.pack(len(data)))
+		fileobj.write(data)
+		count += 1
+	return count
+
+def read_problems(fileobj):
+	"""Read the problems written by write_problems from a file
 
 	Args:
-	  validator_gen: A function that returns a function. The
-	    validator_gen function takes a test case and returns a
-	    new function that will accept a function written by a
-	    user and evaluate it against the test case.
-	  test_cases: A list of values. The values are used to make
-	    a comprehensive set of validators.
-
-	Returns: A function that takes the user's function as an
-	  argument and tests it against all test cases.
+	  fileobj: A file opened for binary reading.
+
+	Returns: A generator of CodingProblems, in the order written.
 	"""
-	validators = []
-	for test_case in test_cases:
-		validators.append(validator_gen(test_case))
-	return lambda f: all(validator(f) for validator in validators)
+	while True:
+		prefix = fileobj.read(PROBLEM_LENGTH.size)
+		if not prefix:
+			return
+		length, = PROBLEM_LENGTH.unpack(prefix)
+		yield CodingProblem.loads(fileobj.read(length))
+
+def random_string(rng=None):
+	"""Generate an english-like random word
 
-def random_int_if():
+	Args:
+	  rng: A random.Random to generate the word with. If not given,
+	    the word comes from a shared buffer of pre-generated words.
+	    [Default: None]
+	"""
+	if rng is not None:
+		return get_word_generator().generate_word(rng=rng)
+	try:
+		return _word_buffer.pop()
+	except IndexError:
+		words = get_word_generator().generate_words(WORD_BUFFER_SIZE)
+		_word_buffer.extend(words[1:])
+		return words[0]
+
+def random_int_if(rng=None):
 	"""Generate a random int IfStatement for use in a CodingProblem"""
-	generators = [iter(LessThanIf()), iter(BetweenIf())]
-	return next(random.choice(generators))
+	generators = [iter(LessThanIf(rng)), iter(BetweenIf(rng))]
+	return next((rng or random).choice(generators))
 
-def random_str_if():
+def random_str_if(rng=None):
 	"""Generate a random str IfStatement for use in a CodingProblem"""
-	generators = [iter(UnlessSubstrIf()), iter(IfSubstrIf())]
-	return next(random.choice(generators))
+	generators = [iter(UnlessSubstrIf(rng)), iter(IfSubstrIf(rng))]
+	return next((rng or random).choice(generators))
+
+class RandomGenerator(object):
+	"""Base class of the generators that draw random values
+
+	Attrs:
+	  rng: A random.Random to generate with, or None to use the
+	    random module and take words from the shared buffer.
+	"""
+
+	def __init__(self, rng=None):
+		"""Initialize this generator
+
+		Args:
+		  rng: A random.Random. [Default: None]
+		"""
+		self.rng = rng
 
-class LessThanIf(object):
+	@property
+	def random(self):
+		"""The random.Random or module to draw values from"""
+		return self.rng or random
+
+class LessThanIf(RandomGenerator):
 	"""Generates less than based IfStatements"""
 	STATEMENT_TEMPLATE = "if the value is less than {val}"
 
 	def values(self):
 		return {
-			"val": random.randint(-1000, 1000)
+			"val": self.random.randint(-1000, 1000)
 		}
 
+	@staticmethod
+	def condition(values, val):
+		return val < values['val']
+
 	def __iter__(self):
 		while True:
 			values = self.values()
 			yield IfStatement(
 				self.STATEMENT_TEMPLATE.format(**values),
-				lambda val: val < values['val'],
+				self.condition,
+				values,
 				(values["val"] - 1000, values["val"] - 1, values["val"], values["val"] + 1000)
 			)
 
-class BetweenIf(object):
+class BetweenIf(RandomGenerator):
 	"""Generates between based IfStatements"""
 	STATEMENT_TEMPLATE = "if the value is between {val1} and {val2}, inclusive"
 
 	def values(self):
 		return {
-			"val1": random.randint(-10000, 0),
-			"val2": random.randint(1, 10000)
+			"val1": self.random.randint(-10000, 0),
+			"val2": self.random.randint(1, 10000)
 		}
 
+	@staticmethod
+	def condition(values, val):
+		return val >= values['val1'] and val <= values['val2']
+
 	def __iter__(self):
 		while True:
 			values = self.values()
 			yield IfStatement(
 				self.STATEMENT_TEMPLATE.format(**values),
-				lambda val: val >= values['val1'] and val <= values['val2'],
+				self.condition,
+				values,
 				(values["val1"], values["val2"], values["val2"] - values["val1"] // 2, values["val1"] - 1, values["val1"] - 1000, values["val2"] + 1, values["val2"] + 1000)
 			)
 
-class UnlessSubstrIf(object):
+class UnlessSubstrIf(RandomGenerator):
 	"""Generates unless substring based IfStaments"""
 	STATEMENT_TEMPLATE = "unless the string contains the substr '{substr}'"
 
 	def values(self):
 		return {
-			"substr": random_string()
+			"substr": random_string(self.rng)
 		}
 
+	@staticmethod
+	def condition(values, s):
+		return values['substr'] not in s
+
 	def __iter__(self):
 		while True:
 			values = self.values()
 			yield IfStatement(
 				self.STATEMENT_TEMPLATE.format(**values),
-				lambda s: values['substr'] not in s,
+				self.condition,
+				values,
 				(values['substr'], values['substr'] + "foo", values['substr'][1:], values['substr'][1:]+"1foo")
 			)
 
-class IfSubstrIf(object):
+class IfSubstrIf(RandomGenerator):
 	"""Generates if subtring based IfStatements"""
 	STATEMENT_TEMPLATE = "if the string contains the substr '{substr}'"
 
 	def values(self):
 		return {
-			"substr": random_string()
+			"substr": random_string(self.rng)
 		}
 
+	@staticmethod
+	def condition(values, s):
+		return values['substr'] in s
+
 	def __iter__(self):
 		while True:
 			values = self.values()
 			yield IfStatement(
 				self.STATEMENT_TEMPLATE.format(**values),
-				lambda s: values['substr'] in s,
+				self.condition,
+				values,
 				(values['substr'], values['substr'] + "foo", values['substr'][1:], values['substr'][1:]+"1foo")
 			)
 
-class AppendProblemGenerator(object):
+class AppendProblemGenerator(RandomGenerator):
 	"""Generates CodingProblems requiring string appending"""
+	KIND = "append"
 	STATEMENT_TEMPLATE = "Write a function called '{func_name}' that takes one str argument and appends the string '{append}' to it."
 
 	def values(self):
 		return {
-			"func_name": random_string(),
-			"append": random_string()
+			"func_name": random_string(self.rng),
+			"append": random_string(self.rng)
 		}
 
 	def __iter__(self):
 		while True:
 			values = self.values()
+			test_inputs = ["foo"]
 			yield CodingProblem(
 				self.STATEMENT_TEMPLATE.format(**values),
 				values['func_name'],
-				validator(lambda test_case: lambda f: f(test_case) == test_case + values['append'], ["foo"])
+				test_inputs,
+				[case + values['append'] for case in test_inputs],
+				self.KIND
 			)
 
-class AdditionProblemGenerator(object):
+class AdditionProblemGenerator(RandomGenerator):
 	"""Generates CodingProblems requiring addition"""
+	KIND = "addition"
 	STATEMENT_TEMPLATE = "Write a function called '{func_name}' that takes one integer argument and adds {add1} to it {if_condition}. Otherwise, it should add {add2} to it."
 
 	def values(self):
 		return {
-			"func_name": random_string(),
-			"if_condition": random_int_if(),
-			"add1": random.randint(-1000, 1000),
-			"add2": random.randint(100000, 1000000),
+			"func_name": random_string(self.rng),
+			"if_condition": random_int_if(self.rng),
+			"add1": self.random.randint(-1000, 1000),
+			"add2": self.random.randint(100000, 1000000),
 		}
 
 	def __iter__(self):
 		while True:
 			values = self.values()
+			if_condition = values['if_condition']
+			test_inputs = if_condition.test_cases
 			yield CodingProblem(
 				self.STATEMENT_TEMPLATE.format(**values),
 				values['func_name'],
-				validator(lambda test_case: lambda f: f(test_case) == test_case + (values['add1'] if values['if_condition'].is_true(test_case) else values['add2']), values['if_condition'].test_cases)
+				test_inputs,
+				[case + (values['add1'] if if_condition.is_true(case) else values['add2']) for case in test_inputs],
+				self.KIND
 			)
 
-class SubstitutionProblemGenerator(object):
+class SubstitutionProblemGenerator(RandomGenerator):
 	"""Generates coding problems requiring substitution"""
+	KIND = "substitution"
 	STATEMENT_TEMPLATE = "Write a function called '{func_name}' that takes one str argument and substitutes all instances of the substr '{substr1}' with '{substr2}' {if_condition}."
 
 	def values(self):
 		return {
-			"func_name": random_string(),
-			"if_condition": random_str_if(),
-			"substr1": random_string(),
-			"substr2": random_string(),
+			"func_name": random_string(self.rng),
+			"if_condition": random_str_if(self.rng),
+			"substr1": random_string(self.rng),
+			"substr2": random_string(self.rng),
 		}
 
 	def __iter__(self):
 		while True:
 			values = self.values()
+			if_condition = values['if_condition']
+			test_inputs = [case + values['substr1'] for case in if_condition.test_cases]
 			yield CodingProblem(
 				self.STATEMENT_TEMPLATE.format(**values),
 				values['func_name'],
-				validator(lambda test_case: lambda f: f(test_case) == (test_case.replace(values["substr1"], values["substr2"]) if values['if_condition'].is_true(test_case) else test_case), [case + values['substr1'] for case in values['if_condition'].test_cases])
+				test_inputs,
+				[case.replace(values["substr1"], values["substr2"]) if if_condition.is_true(case) else case for case in test_inputs],
+				self.KIND
 			)
@@ -1,17 +1,50 @@
 #! /usr/bin/env python
 
+import collections
+import heapq
 import json
-import random
+import logging
 import threading
+import time
+import uuid
+import weakref
 
 import sc_exceptions as exc
+import challenges
 import generator
+import locks
+import metrics
+import rng
 
 # game states
 SETUP = "setup"
 READY = "ready"
 PLAYING = "playing"
 
+# event types
+SIT = "sit"
+STAND = "stand"
+START = "start"
+TOKEN_PASSED = "token_passed"
+SOLUTION_SUBMITTED = "solution_submitted"
+GAME_OVER = "game_over"
+SABOTAGED = "sabotaged"
+DRAFT_PATCHED = "draft_patched"
+# the table was reloaded with changes made by another instance
+RELOADED = "reloaded"
+
+# Seconds between rounds of sabotage on a playing table, or None to
+# never sabotage, and the chance of each character of a solution being
+# substituted in a round. Set per table with sabotage_interval and
+# sabotage_rate.
+SABOTAGE_INTERVAL = None
+SABOTAGE_RATE = generator.CodingProblemAssignment.SCREW_FACTOR
+
+# Patches to a draft solution are batched for this many seconds before
+# they are published as one event and the table snapshot is rebuilt, or
+# published at once if None. Set per table with draft_sync_interval.
+DRAFT_SYNC_INTERVAL = 0.25
+
 class Seat(object):
 	"""Represents a seat in a speedcoders game
 
@@ -28,7 +61,8 @@ class Seat(object):
 	    being worked on or None if the user is not working on a
 	    problem.
 	"""
-	challenge_generator = iter(generator.ProblemGenerator())
+	# problems are generated ahead of time so receive_token only pops one
+	challenge_generator = generator.ProblemPool(iter(generator.ProblemGenerator()))
 
 	def __init__(self, seat_num, user=None, token=False):
 		"""Initialize this Seat
@@ -45,11 +79,21 @@ class Seat(object):
 		self.num = seat_num
 
 		self.coding_task = None
+		self._json = None
+
+	def changed(self):
+		"""Drop the cached json of this seat
+
+		Must be called whenever the seat or its coding task changes
+		other than through the methods of this Seat.
+		"""
+		self._json = None
 
 	def reset(self):
 		"""Reset the token and coding task"""
 		self.token = False
 		self.coding_task = None
+		self.changed()
 
 	@property
 	def disp_num(self):
@@ -67,6 +111,7 @@ class Seat(object):
 		"""
 		if self.empty():
 			self.user = user
+			self.changed()
 		else:
 			raise exc.IllegalStateException("Seat {0} is currently occupied by {1}.".format(self.disp_num, self.user))
 
@@ -77,6 +122,7 @@ class Seat(object):
 		"""
 		if not self.empty():
 			self.user = None
+			self.changed()
 		else:
 			raise exc.IllegalStateException("Seat {0} is not currently occupied.".format(self.disp_num))
 
@@ -89,31 +135,44 @@ class Seat(object):
 		assert self.token
 		self.reset()
 
-	def receive_token(self):
+	def receive_token(self, task=None):
 		"""Add the token to this seat
 
+		Args:
+		  task: A CodingProblemAssignment. The task that comes with the
+		    token, drawn ahead of time so that no problem is generated
+		    while the table is locked. If not given, one is drawn from
+		    challenge_generator. [Default: None]
+
 		Throws: GameOverException if this seat already has a token.
 		"""
 		if self.token:
-			raise exc.GameOverException("{0} lost!".format(self.user))
+			raise exc.GameOverException(self.user, "{0} lost!".format(self.user))
 		else:
 			self.token = True
-			self.coding_task = next(self.challenge_generator)
-
-	def submit_answer(self, solution):
-		"""Test a solution for correctness"""
-		assert self.coding_task is not None
-		return self.coding_task.submit_solution(solution)
+			self.coding_task = task or next(self.challenge_generator)
+			self.changed()
 
-	def to_json(self):
-		"""Returns a json representation of this seat"""
-		return json.dumps({
+	def to_dict(self):
+		"""Returns a json serializable representation of this seat"""
+		return {
 			"user": self.user,
 			"active": self.token,
 			"seat_num": self.num,
 			"coding_task": self.coding_task.problem.statement if self.coding_task else None,
 			"solution": self.coding_task.solution if self.coding_task else None,
-		})
+			"solution_version": self.coding_task.version if self.coding_task else None,
+		}
+
+	def to_json(self):
+		"""Returns a json representation of this seat
+
+		The encoded json is cached until the seat changes.
+		"""
+		encoded = self._json
+		if encoded is None:
+			encoded = self._json = json.dumps(self.to_dict())
+		return encoded
 
 
 class Table(object):
@@ -122,30 +181,283 @@ class Table(object):
 	This object contains the initial conditions and main state of the
 	game.
 
+	Mutations hold the table lock only while they change the table;
+	drawing problems, running solutions and waiting for events all
+	happen outside it. Reads are served from the cached snapshot and
+	the seat index without taking the lock at all. The lock records
+	wait and hold times per method, see locks.report.
+
+	Every table draws its random numbers from streams derived from its
+	seed. A table created with a seed, or recording its actions, also
+	draws its problems from its own seeded stream, so a recording can
+	be replayed move for move with replay. Other tables share the
+	pregenerated problems of Seat.challenge_generator.
+
 	Attrs:
 	  seat_count: An int. The number of seats that this game will hold.
 	  token_count: An int. The number of tokens that will be seeded on
 	    the table.
-	  table: A list of Seats. The seats at this table.
+	  table: A list of Seats. The seats at this table. Users should
+	    only be seated through add_user and remove_user, which keep
+	    the seat index and occupancy count up to date.
 	  state: A string. The state of the current game.
 	  last_loser: A string. The username of the last user to lose a game.
+	  occupied: An int. The number of occupied seats.
+	  version: An int. Incremented every time the state of the table
+	    changes. Every method that changes the table must call
+	    changed while holding the lock.
+	  lock: An InstrumentedLock. Guards every change to the table.
+	  event_seq: An int. The sequence number of the latest event.
+	  seed: An int. The seed of this table's random streams.
+	  rng: A random.Random. The stream tokens are placed with.
+	  actions: A list of the actions applied to this table, as lists
+	    of a method name followed by its arguments, or None if the
+	    table isn't recording.
+	  sabotage_interval: A float. The seconds between rounds of
+	    sabotage while playing, or None for no sabotage.
+	  sabotage_rate: A float. The chance of each character of an
+	    active solution being substituted in a round of sabotage.
+	  draft_sync_interval: A float. The seconds patches to draft
+	    solutions are batched for, or None to publish each at once.
+	  on_change: A function called with no arguments, under the lock,
+	    whenever the table changes, or None. Used to save the table
+	    to a state store.
+	  stored_version: An int. The version of the table last loaded
+	    from or saved to a state store, or None if it never was.
+	  stale: A bool. Whether a state store holds newer changes than
+	    this copy of the table.
+	  checked: A float. When this copy of the table was last found to
+	    be up to date with a state store.
 	"""
+	# the number of events kept for clients catching up
+	EVENT_LOG_SIZE = 256
 
-	def __init__(self, seats, tokens):
+	def __init__(self, seats, tokens, seed=None, record=False):
 		"""Initialize this Table
 
 		Args:
 		  seats: An int. The number of seats that this game will hold.
 		  tokens: An int. The number of tokens that will be seeded on
 		    the table.
+		  seed: An int. The seed of the table's random streams. If
+		    given, the table's problems are drawn from a stream of it
+		    too. [Default: a fresh seed]
+		  record: A bool. Whether to record the table's actions for
+		    replay. [Default: False]
 		"""
 		self.seat_count = seats
 		self.token_count = tokens
+		self.seed = seed if seed is not None else rng.new_seed()
+		self.rng = rng.stream(self.seed, "tokens")
+		self.actions = [] if record else None
+		self.sabotage_interval = SABOTAGE_INTERVAL
+		self.sabotage_rate = SABOTAGE_RATE
+		self._sabotage_rng = rng.stream(self.seed, "sabotage")
+		self.draft_sync_interval = DRAFT_SYNC_INTERVAL
+		# seat numbers to the [task, base version, version, patches] not yet published
+		self._drafts = {}
+		# the number of games started, so the scheduler can tell them apart
+		self._games = 0
+		if seed is not None or record:
+			self._problems_rng = rng.stream(self.seed, "problems")
+			self._problems = iter(generator.ProblemGenerator(rng=self._problems_rng))
+		else:
+			self._problems_rng = None
+			self._problems = None
 
 		self.table = [Seat(num) for num in xrange(self.seat_count)]
 		self.state = SETUP
 		self.last_loser = ""
-		self._lock = threading.RLock()
+		self.occupied = 0
+		self.version = 0
+		# distinguishes the versions of this table from those of a
+		# table with the same id in another process or after a restart
+		self._epoch = uuid.uuid4().hex[:12]
+		self._snapshot = None
+		self.event_seq = 0
+		self._events = collections.deque(maxlen=self.EVENT_LOG_SIZE)
+		self._seats_by_user = {}
+		# may hold seats that have since been taken; see first_empty_seat
+		self._empty_seats = range(self.seat_count)
+		# the seat numbers in _empty_seats, so none is pushed twice
+		self._in_empty_seats = set(self._empty_seats)
+		self.lock = locks.InstrumentedLock("Table")
+		# guards only the event log, so waiting clients never hold the table
+		self._new_event = threading.Condition()
+
+		self.on_change = None
+		self.stored_version = None
+		self.stale = False
+		self.checked = time.time()
+
+	def publish(self, event_type, **data):
+		"""Add an event to the event log and wake up waiting clients
+
+		Call with the table lock held, so events are logged in the
+		order the changes were made.
+
+		Args:
+		  event_type: A str. One of the event types.
+		  data: The json serializable details of the event.
+		"""
+		with self._new_event:
+			self.event_seq += 1
+			data["seq"] = self.event_seq
+			data["type"] = event_type
+			self._events.append(data)
+			self._new_event.notify_all()
+
+	def events_since(self, seq, timeout=0):
+		"""Get the events after a sequence number
+
+		Args:
+		  seq: An int. The sequence number of the last event the
+		    client has seen, or 0 for every retained event.
+		  timeout: A float. If there are no newer events, how long to
+		    wait for one. [Default: 0]
+
+		Returns: A tuple (events, resync) of a list of event dicts in
+		  order and a bool. resync is True if events after seq have
+		  already been dropped from the log, in which case the client
+		  should fetch the full state again.
+		"""
+		with self._new_event:
+			if self.event_seq <= seq and timeout > 0:
+				self._new_event.wait(timeout)
+			oldest = self._events[0]["seq"] if self._events else self.event_seq + 1
+			resync = seq + 1 < oldest and seq < self.event_seq
+			return [event for event in self._events if event["seq"] > seq], resync
+
+	def record(self, action, *args):
+		"""Record an action for replay, if this table is recording
+
+		Call with the lock held.
+
+		Args:
+		  action: A str. The name of the method applied.
+		  args: The json serializable arguments it was called with.
+		"""
+		if self.actions is not None:
+			self.actions.append([action] + list(args))
+
+	def recording(self):
+		"""Returns a json serializable recording of this table for replay"""
+		with self.lock.hold("recording"):
+			return {
+				"seats": self.seat_count,
+				"tokens": self.token_count,
+				"seed": self.seed,
+				"actions": list(self.actions or []),
+			}
+
+	def changed(self):
+		"""Record that the state of this table changed
+
+		Bumps the version and drops the cached snapshot. Call with
+		the lock held.
+		"""
+		self.version += 1
+		self._snapshot = None
+		if self.on_change is not None:
+			self.on_change()
+
+	def to_state(self):
+		"""Returns the state of this table for a state store
+
+		The state is made of built in types only, so that it can be
+		marshalled. It includes the position of the random streams, so
+		a restored table goes on drawing the same tokens, problems and
+		sabotage as this one would. The event log and any recording are
+		not included. Call with the lock held.
+		"""
+		streams = {"tokens": self.rng.getstate(), "sabotage": self._sabotage_rng.getstate()}
+		if self._problems_rng is not None:
+			streams["problems"] = self._problems_rng.getstate()
+		return {
+			"seat_count": self.seat_count,
+			"token_count": self.token_count,
+			"seed": self.seed,
+			"epoch": self._epoch,
+			"version": self.version,
+			"state": self.state,
+			"last_loser": self.last_loser,
+			"streams": streams,
+			"seats": [{
+				"user": seat.user,
+				"token": seat.token,
+				"problem": seat.coding_task.problem.dumps() if seat.coding_task else None,
+				"solution": seat.coding_task.solution if seat.coding_task else None,
+				"solution_version": seat.coding_task.version if seat.coding_task else None,
+			} for seat in self.table],
+		}
+
+	@classmethod
+	def from_state(cls, state):
+		"""Returns a Table restored from the result of to_state"""
+		table = cls(state["seat_count"], state["token_count"])
+		table.load_state(state)
+		return table
+
+	def load_state(self, state):
+		"""Replace the state of this table with the result of to_state
+
+		Updates this Table in place, so everything holding on to it
+		sees the new state. Batched draft patches are dropped. Does
+		not call on_change. Call with the lock held.
+		"""
+		if state["seat_count"] != self.seat_count:
+			self.table = [Seat(num) for num in xrange(state["seat_count"])]
+		self.seat_count = state["seat_count"]
+		self.token_count = state["token_count"]
+		self.restore_streams(state["seed"], state.get("streams"))
+		self._epoch = state["epoch"]
+		self.version = state["version"]
+		self.state = state["state"]
+		self.last_loser = state["last_loser"]
+		self._seats_by_user = {}
+		self.occupied = 0
+		for seat, seat_state in zip(self.table, state["seats"]):
+			seat.user = seat_state["user"]
+			seat.token = seat_state["token"]
+			seat.coding_task = None
+			if seat_state["problem"] is not None:
+				seat.coding_task = generator.CodingProblemAssignment(challenges.CodingProblem.loads(seat_state["problem"]))
+				seat.coding_task.solution = seat_state["solution"]
+				seat.coding_task.version = seat_state.get("solution_version") or 0
+			seat.changed()
+			if seat.user is not None:
+				self._seats_by_user[seat.user] = seat
+				self.occupied += 1
+		self._empty_seats = [seat.num for seat in self.table if seat.empty()]
+		self._in_empty_seats = set(self._empty_seats)
+		self._drafts = {}
+		self._snapshot = None
+		if self.state == PLAYING and not self._games:
+			self._games = 1
+		self.stale = False
+
+	def restore_streams(self, seed, streams=None):
+		"""Derive this table's random streams from a seed
+
+		Args:
+		  seed: An int. The seed of the streams.
+		  streams: A dict of stream names to the random states saved
+		    by to_state, to carry on from, or None to start each stream
+		    afresh. A problems stream is only kept if it is in there.
+		    [Default: None]
+		"""
+		streams = streams or {}
+		self.seed = seed
+		self.rng = rng.stream(seed, "tokens")
+		self._sabotage_rng = rng.stream(seed, "sabotage")
+		if "problems" in streams:
+			self._problems_rng = rng.stream(seed, "problems")
+			self._problems = iter(generator.ProblemGenerator(rng=self._problems_rng))
+		else:
+			self._problems_rng = self._problems = None
+		for name, stream in (("tokens", self.rng), ("sabotage", self._sabotage_rng), ("problems", self._problems_rng)):
+			if name in streams:
+				stream.setstate(streams[name])
 
 	def validate_seat_num(self, seat_num):
 		"""Validate that a seat number is valid for this table
@@ -161,7 +473,11 @@ class Table(object):
 
 	def full(self):
 		"""Returns whether this table is full"""
-		return all(lambda seat: not seat.empty(), self.table)
+		return self.occupied == self.seat_count
+
+	def joinable(self):
+		"""Returns whether users can still sit down at this table"""
+		return self.state == SETUP and not self.full()
 
 	def get_seat(self, user):
 		"""Returns the Seat assigned to the given user
@@ -172,10 +488,15 @@ class Table(object):
 		Returns: The user's Seat or None if the user doesn't have
 		  a seat.
 		"""
-		for seat in self.table:
-			if seat.user == user:
-				return seat
-		return None
+		return self._seats_by_user.get(user)
+
+	def first_empty_seat(self):
+		"""Returns the lowest numbered empty Seat, or None if full"""
+		empty_seats = self._empty_seats
+		# seats taken by number are only dropped from the heap here
+		while empty_seats and not self.table[empty_seats[0]].empty():
+			self._in_empty_seats.discard(heapq.heappop(empty_seats))
+		return self.table[empty_seats[0]] if empty_seats else None
 
 	def add_user(self, user, seat_num=None):
 		"""Add a user to this table
@@ -199,16 +520,25 @@ class Table(object):
 		"""
 		seat_num is None or self.validate_seat_num(seat_num)
 
-		with self._lock:
+		with self.lock.hold("add_user"):
 			assert self.state == SETUP
 			if self.full():
 				raise exc.IllegalStateException("No empty seats.")
 
-			if self.get_seat(user) is not None:
-				raise exc.IllegalStateException("{0} is already sitting in seat {1}.".format(user, seat.display_num))
+			seat = self.get_seat(user)
+			if seat is not None:
+				raise exc.IllegalStateException("{0} is already sitting in seat {1}.".format(user, seat.disp_num))
 
-			seat = self.table[seat_num]
+			if seat_num is None:
+				seat = self.first_empty_seat()
+			else:
+				seat = self.table[seat_num]
 			seat.sit_down(user)
+			self.changed()
+			self._seats_by_user[user] = seat
+			self.occupied += 1
+			self.record("add_user", user, seat_num)
+			self.publish(SIT, user=user, seat_num=seat.num)
 			if self.full():
 				self.state = READY
 			return seat.to_json()
@@ -223,53 +553,275 @@ class Table(object):
 
 		Returns: A json representation of the vacated seat.
 		"""
-		with self._lock:
+		with self.lock.hold("remove_user"):
 			assert self.state == SETUP or self.state == READY
 			seat = self.get_seat(user)
 			if seat is None:
 				raise exc.IllegalStateException("{0} is not currently in a seat.".format(user))
+			self.changed()
 			seat.stand_up()
+			del self._seats_by_user[user]
+			self.occupied -= 1
+			if seat.num not in self._in_empty_seats:
+				heapq.heappush(self._empty_seats, seat.num)
+				self._in_empty_seats.add(seat.num)
 			self.state = SETUP
+			self.record("remove_user", user)
+			self.publish(STAND, user=user, seat_num=seat.num)
 			return seat.to_json()
 
-	def reset_tokens(self):
+	def draw_tasks(self, count):
+		"""Draw coding tasks for tokens about to be handed out
+
+		Call without holding the lock, since drawing may have to
+		generate a problem. Tables with their own problem stream draw
+		under the lock instead, in the order the tokens move, so that
+		a replay draws the same problems.
+
+		Args:
+		  count: An int. The number of tasks to draw.
+
+		Returns: A list of CodingProblemAssignments, or of Nones for
+		  next_task to fill in.
+		"""
+		if self._problems is not None:
+			return [None] * count
+		return [next(Seat.challenge_generator) for _ in xrange(count)]
+
+	def next_task(self):
+		"""Draw a coding task while holding the lock"""
+		if self._problems is not None:
+			return next(self._problems)
+		return next(Seat.challenge_generator)
+
+	def reset_tokens(self, tasks=None):
 		"""Redistribute tokens as equally as possible around the table
 
 		Table must be READY. Distributes tokens evenly around the table
 		starting with a random user.
+
+		Args:
+		  tasks: A list of token_count CodingProblemAssignments from
+		    draw_tasks to hand out with the tokens. If not given,
+		    tasks are drawn while holding the lock. [Default: None]
 		"""
-		with self._lock:
+		tasks = tasks or [None] * self.token_count
+		with self.lock.hold("reset_tokens"):
 			assert self.state == READY
+			self.changed()
 			for seat in self.table:
 				seat.token = False
+				seat.changed()
 
-			seat_num = random.randint(0, self.seat_count - 1)
+			seat_num = self.rng.randint(0, self.seat_count - 1)
 			inc = self.seat_count // self.token_count
 			for i in xrange(self.token_count):
 				seat = self.table[seat_num]
-				seat.receive_token()
+				seat.receive_token(tasks[i] or self.next_task())
 				seat_num = (seat_num + inc) % self.seat_count
 
 	def play(self):
 		"""Start the game"""
-		with self._lock:
+		tasks = self.draw_tasks(self.token_count)
+		with self.lock.hold("play"):
 			assert self.state == READY
-			self.reset_tokens()
+			self.changed()
+			self.reset_tokens(tasks)
 			self.state = PLAYING
+			self._games += 1
+			self.record("play")
+			self.publish(START, tokens=[seat.num for seat in self.table if seat.token])
+		if self.sabotage_interval:
+			SABOTEUR.schedule(self, self.sabotage_interval)
 
 	def end_game(self, loser):
 		"""End the game"""
-		with self._lock:
+		with self.lock.hold("end_game"):
 			assert self.state == PLAYING
+			self.changed()
 			self.last_loser = loser
-			self.state == READY
+			self.state = READY
+			self.publish(GAME_OVER, loser=loser)
 
-	def pass_token(self, seat):
-		"""Move a token from one seat to the next"""
-		with self._lock:
+	def pass_token(self, seat, task=None):
+		"""Move a token from one seat to the next
+
+		Args:
+		  seat: A Seat. The seat passing on its token.
+		  task: A CodingProblemAssignment from draw_tasks to pass on
+		    with the token. If not given, one is drawn while holding
+		    the lock. [Default: None]
+		"""
+		with self.lock.hold("pass_token"):
 			assert self.state == PLAYING
+			self.changed()
+			receiver = self.table[(seat.num + 1) % self.seat_count]
 			self.table[seat.num].pass_token()
-			self.table[(seat.num + 1) % self.seat_count].receive_token()
+			receiver.receive_token(task or self.next_task())
+			self.publish(TOKEN_PASSED, from_seat=seat.num, to_seat=receiver.num,
+				coding_task=receiver.coding_task.problem.statement)
+
+	def sabotage(self):
+		"""Substitute random characters in the solutions being worked on
+
+		The solutions are copied under the lock, mutated without it
+		and written back under the lock, unless the seat has moved on
+		to another task or its solution changed in the meantime.
+
+		Returns: A list of the numbers of the seats sabotaged.
+		"""
+		with self.lock.hold("sabotage"):
+			if self.state != PLAYING:
+				return []
+			targets = [(seat, seat.coding_task, seat.coding_task.solution)
+				for seat in self.table if seat.coding_task is not None and seat.coding_task.solution]
+
+		screwed = [(seat, task, solution, generator.screw(solution, self.sabotage_rate, self._sabotage_rng))
+			for seat, task, solution in targets]
+
+		with self.lock.hold("sabotage"):
+			return self.apply_sabotage([[seat.num, new_solution] for seat, task, solution, new_solution in screwed
+				if seat.coding_task is task and task.solution is solution])
+
+	def apply_sabotage(self, solutions):
+		"""Replace drafts with their sabotaged copies
+
+		The copies are recorded rather than the draws that made them,
+		since when sabotage happens depends on the scheduler, so a
+		replay applies exactly the same sabotage at the same point.
+
+		Args:
+		  solutions: A list of [seat_num, solution] lists. The seats
+		    whose drafts were sabotaged and their new drafts.
+
+		Returns: A list of the numbers of the seats sabotaged.
+		"""
+		with self.lock.hold("apply_sabotage"):
+			if not solutions:
+				return []
+			for seat_num, solution in solutions:
+				seat = self.table[seat_num]
+				self.publish_draft(seat_num)
+				seat.coding_task.update_solution(solution)
+				seat.changed()
+			self.changed()
+			self.record("apply_sabotage", solutions)
+			sabotaged = [seat_num for seat_num, solution in solutions]
+			self.publish(SABOTAGED, seats=sabotaged)
+			return sabotaged
+
+	def update_draft(self, user, version, patches):
+		"""Apply patches to the draft solution a user is working on
+
+		The draft changes at once, but to spare every poller a copy of
+		every keystroke, the patches are only published when the batch
+		is flushed, see flush_drafts. Clients holding the draft at the
+		batch's base_version apply its patches to reach its version;
+		clients that already have that version ignore it and any other
+		client fetches the table again.
+
+		Args:
+		  user: A string. The user whose draft is patched.
+		  version: An int. The version of the draft the patches were
+		    made against, from solution_version.
+		  patches: A list of [start, end, replacement] lists, see
+		    generator.patch.
+
+		Throws: IllegalStateException if the user is not working on a
+		  challenge or the draft is no longer at version.
+		  IllegalArgumentException if a patch is malformed.
+
+		Returns: An int. The new version of the draft.
+		"""
+		seat = self.get_seat(user)
+		if seat is None:
+			raise exc.IllegalStateException("User {0} is not at the table.".format(user))
+
+		with self.lock.hold("update_draft"):
+			task = seat.coding_task
+			if task is None:
+				raise exc.IllegalStateException("User {0} is not working on a challenge.".format(user))
+			if version != task.version:
+				raise exc.IllegalStateException("The draft is at version {0}, not {1}.".format(task.version, version))
+			try:
+				new_version = task.patch_solution(version, patches)
+			except ValueError as error:
+				raise exc.IllegalArgumentException(str(error))
+			self.record("update_draft", user, version, patches)
+
+			draft = self._drafts.get(seat.num)
+			# a batch only carries patches that follow on from each other
+			if draft is None or draft[0] is not task or draft[2] != version:
+				if draft is not None and self.publish_draft(seat.num):
+					self.changed()
+				first = not self._drafts
+				self._drafts[seat.num] = [task, version, new_version, list(patches)]
+				if self.draft_sync_interval and first:
+					DRAFT_SYNCER.schedule(self, self.draft_sync_interval)
+			else:
+				draft[2] = new_version
+				draft[3].extend(patches)
+			if not self.draft_sync_interval:
+				self.flush_drafts()
+		return new_version
+
+	def flush_drafts(self):
+		"""Publish the batched patches to draft solutions
+
+		Publishes one event per patched draft and rebuilds the table
+		snapshot once. Drafts that were replaced since they were
+		patched, by a submission, sabotage or the token moving on, are
+		skipped, as those changes publish the new draft themselves.
+
+		Returns: A list of the numbers of the seats published.
+		"""
+		with self.lock.hold("flush_drafts"):
+			published = [seat_num for seat_num in sorted(self._drafts) if self.publish_draft(seat_num)]
+			if published:
+				self.changed()
+		return published
+
+	def publish_draft(self, seat_num):
+		"""Publish the batched patches to one seat's draft now
+
+		Every change to a draft other than a patch publishes the batch
+		first, so clients never miss a version. Call with the lock
+		held, and call changed if this returns True.
+
+		Args:
+		  seat_num: An int. The seat whose batch is published.
+
+		Returns: A bool. Whether there was a batch to publish.
+		"""
+		draft = self._drafts.pop(seat_num, None)
+		if draft is None:
+			return False
+		task, base_version, version, patches = draft
+		seat = self.table[seat_num]
+		if seat.coding_task is not task or task.version != version:
+			return False
+		seat.changed()
+		self.publish(DRAFT_PATCHED, seat_num=seat_num, base_version=base_version,
+			version=version, patches=patches)
+		return True
+
+	def wipe_draft(self, seat):
+		"""Clear the draft solution of a seat and publish it as a patch
+
+		Call with the lock held.
+
+		Args:
+		  seat: A Seat with a coding task.
+		"""
+		self.publish_draft(seat.num)
+		task = seat.coding_task
+		base_version = task.version
+		length = len(task.solution)
+		task.update_solution("")
+		self.changed()
+		seat.changed()
+		self.publish(DRAFT_PATCHED, seat_num=seat.num, base_version=base_version,
+			version=task.version, patches=[[0, length, ""]])
 
 	def get_challenge(self, user):
 		"""Get a coding challenge
@@ -279,16 +831,19 @@ class Table(object):
 		Args:
 		  user: A string. The user to get a challenge for
 
+		Only reads the seat index and the cached snapshot, so it
+		never waits on the lock unless the snapshot must be rebuilt.
+
 		Throws: IllegalStateException if the user is not at the table
 
-		Returns: A json payload representing the current state of the
-		  game.
+		Returns: A json payload with the "result" of running the
+		  solution, the dict of its sandbox.ExecutionResult, and the
+		  current state of the "game".
 		"""
-		with self._lock:
-			seat = self.get_seat(user)
-			if seat is None:
-				raise exc.IllegalStateException("User {0} is not at the table.".format(user))
-			return self.to_json()
+		seat = self.get_seat(user)
+		if seat is None:
+			raise exc.IllegalStateException("User {0} is not at the table.".format(user))
+		return self.to_json()
 
 	def submit_answer(self, user, solution):
 		"""Submit a potential answer to a challenge
@@ -298,31 +853,192 @@ class Table(object):
 		  solution: A string. The python code which should be checked for
 		    correctness.
 
-		Throws: IllegalStateException if the user is not in a seat.
+		Submitting wipes the user's draft, so a failed submission
+		starts over. The draft is wiped under the lock, but the
+		solution is run without holding it, so a slow solution only
+		holds up the user who submitted it. The lock is taken again to
+		apply the result, and the next task is drawn and the table
+		encoded outside of it.
+
+		Throws: IllegalStateException if the user is not in a seat or
+		  is not working on a challenge.
 
 		Returns: A json payload representing the current state of the
 		  game.
 		"""
-		with self._lock:
-			seat = self.get_seat(user)
-			if seat is None:
-				raise exc.IllegalStateException("User {0} is not at the table.".format(user))
-
-			if seat.submit_answer(solution):
+		seat = self.get_seat(user)
+		if seat is None:
+			raise exc.IllegalStateException("User {0} is not at the table.".format(user))
+		with self.lock.hold("submit_answer"):
+			task = seat.coding_task
+			if task is None:
+				raise exc.IllegalStateException("User {0} is not working on a challenge.".format(user))
+			self.wipe_draft(seat)
+
+		with metrics.timed("Table.submit_answer.validate"):
+			result = task.problem.validate(solution)
+		next_task = self.draw_tasks(1)[0] if result else None
+		details = result.to_dict()
+
+		with self.lock.hold("submit_answer"):
+			self.publish(SOLUTION_SUBMITTED, user=user, seat_num=seat.num, passed=bool(result), result=details)
+			# the token may have moved on, or the game ended, while the solution was running
+			if seat.coding_task is task:
+				self.record("submit_answer", user, solution)
+			# a restarted game takes the token but leaves the task
+			if result and seat.token and seat.coding_task is task and self.state == PLAYING:
 				try:
-					self.pass_token(seat.num)
+					self.pass_token(seat, next_task)
 				except exc.GameOverException as goe:
 					self.end_game(goe.loser)
-			return self.to_json()
+		# the table json is already encoded, so it is spliced in as is
+		return '{{"result": {0}, "game": {1}}}'.format(json.dumps(details), self.to_json())
+
+	def snapshot(self):
+		"""Returns the current state of this Table, encoded
+
+		The encoded state is cached until the table changes, so
+		repeated polls of an unchanged table do no serialization.
+		Each seat's json is cached separately, so only the seats that
+		changed are encoded again.
+
+		Returns: A tuple (etag, json) of a str identifying this
+		  version of the table, suitable for an ETag header, and the
+		  json representation of the table.
+		"""
+		snapshot = self._snapshot
+		if snapshot is None:
+			with self.lock.hold("snapshot"):
+				snapshot = self._snapshot
+				if snapshot is None:
+					start = time.time()
+					body = '{{"seat_count": {0}, "token_count": {1}, "seats": [{2}], "state": {3}, "last_loser": {4}, "version": {5}}}'.format(
+						self.seat_count,
+						self.token_count,
+						", ".join(seat.to_json() for seat in self.table),
+						json.dumps(self.state),
+						json.dumps(self.last_loser),
+						self.version)
+					metrics.record("Table.snapshot.serialize", time.time() - start)
+					snapshot = self._snapshot = ('"{0}-{1}"'.format(self._epoch, self.version), body)
+		return snapshot
 
 	def to_json(self):
 		"""Returns a json representation of this Table"""
-		return json.dumps({
-			"seat_count": self.seat_count,
-			"token_count": self.token_count,
-			"seats": [seat.to_json() for seat in self.table],
-			"state": self.state,
-			"last_loser": self.last_loser
-		})
+		return self.snapshot()[1]
 
 
+class SabotageScheduler(object):
+	"""Runs rounds of sabotage on playing tables from one thread
+
+	Each scheduled table is sabotaged every interval seconds until
+	the game it was scheduled for is over. Tables are held weakly, so a table that is
+	closed and dropped is forgotten.
+	"""
+
+	def __init__(self):
+		self._due = []
+		self._count = 0
+		self._wake = threading.Condition()
+		self._worker = None
+
+	def schedule(self, table, interval):
+		"""Start sabotaging a table every interval seconds
+
+		Args:
+		  table: A Table. The table, which should be PLAYING.
+		  interval: A float. The seconds between rounds.
+		"""
+		with self._wake:
+			self._count += 1
+			heapq.heappush(self._due, (time.time() + interval, self._count, weakref.ref(table), table._games, interval))
+			if self._worker is None:
+				self._worker = threading.Thread(target=self._run, name="SabotageScheduler")
+				self._worker.daemon = True
+				self._worker.start()
+			self._wake.notify()
+
+	def _run(self):
+		while True:
+			with self._wake:
+				while not self._due or self._due[0][0] > time.time():
+					self._wake.wait(self._due[0][0] - time.time() if self._due else None)
+				due, count, table_ref, game, interval = heapq.heappop(self._due)
+			table = table_ref()
+			if table is None or table.state != PLAYING or table._games != game:
+				continue
+			try:
+				table.sabotage()
+			except Exception:
+				logging.exception("Failed to sabotage a table")
+			with self._wake:
+				heapq.heappush(self._due, (max(due + interval, time.time()), count, table_ref, game, interval))
+
+SABOTEUR = SabotageScheduler()
+
+
+class DraftSyncScheduler(object):
+	"""Flushes the batched draft patches of tables from one thread
+
+	Each scheduled table is flushed once, after the delay it was
+	scheduled with. Tables are held weakly, like in SabotageScheduler.
+	"""
+
+	def __init__(self):
+		self._due = []
+		self._count = 0
+		self._wake = threading.Condition()
+		self._worker = None
+
+	def schedule(self, table, delay):
+		"""Flush the drafts of a table after delay seconds
+
+		Args:
+		  table: A Table.
+		  delay: A float. The seconds to batch patches for.
+		"""
+		with self._wake:
+			self._count += 1
+			heapq.heappush(self._due, (time.time() + delay, self._count, weakref.ref(table)))
+			if self._worker is None:
+				self._worker = threading.Thread(target=self._run, name="DraftSyncScheduler")
+				self._worker.daemon = True
+				self._worker.start()
+			self._wake.notify()
+
+	def _run(self):
+		while True:
+			with self._wake:
+				while not self._due or self._due[0][0] > time.time():
+					self._wake.wait(self._due[0][0] - time.time() if self._due else None)
+				due, count, table_ref = heapq.heappop(self._due)
+			table = table_ref()
+			if table is None:
+				continue
+			try:
+				table.flush_drafts()
+			except Exception:
+				logging.exception("Failed to flush draft patches")
+
+DRAFT_SYNCER = DraftSyncScheduler()
+
+
+def replay(recording):
+	"""Replay a recorded game on a new Table
+
+	Applies the recorded actions in order. The table draws the same
+	tokens and problems as the recorded one did, so the replay ends
+	in the same state, and timing replays compares the engine's
+	performance on exactly the same game.
+
+	Args:
+	  recording: A dict returned by Table.recording.
+
+	Returns: The Table the game was replayed on.
+	"""
+	table = Table(recording["seats"], recording["tokens"], recording["seed"])
+	# publish drafts as they are patched, so replays change the table the same way
+	table.draft_sync_interval = None
+	for action in recording["actions"]:
+		getattr(table, action[0])(*action[1:])
+	return table
@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+
+import unittest
+
+import challenges
+import game
+
+challenges.WORD_MODEL_FILE = "word_gen3.pickle"
+
+class ReplayTest(unittest.TestCase):
+
+	def setUp(self):
+		self.table = game.Table(seats=2, tokens=1, seed=7, record=True)
+		# publish drafts at once, like a replay does
+		self.table.draft_sync_interval = None
+		self.table.sabotage_rate = 0.5
+		self.table.add_user("alice")
+		self.table.add_user("bob")
+		self.table.play()
+
+	def active(self):
+		return [seat for seat in self.table.table if seat.token][0]
+
+	def test_replay_matches_sabotaged_game(self):
+		seat = self.active()
+		version = self.table.update_draft(seat.user, seat.coding_task.version, [[0, 0, "def solve(value):\n\treturn value\n"]])
+		self.assertEqual(self.table.sabotage(), [seat.num])
+		sabotaged = seat.coding_task.solution
+		self.table.update_draft(seat.user, version + 1, [[0, 0, "# "]])
+		self.table.submit_answer(seat.user, "def solve(value):\n\treturn value\n")
+
+		replayed = game.replay(self.table.recording())
+		self.assertEqual(replayed.to_json(), self.table.to_json())
+		actions = [action[0] for action in self.table.recording()["actions"]]
+		self.assertIn("apply_sabotage", actions)
+		self.assertNotEqual(sabotaged, "def solve(value):\n\treturn value\n")
+
+	def test_submit_after_restart_keeps_tokens(self):
+		seat = self.active()
+		task = seat.coding_task
+		validate = task.problem.validate
+		def restart_then_validate(solution):
+			# the game ends and starts again while the solution runs
+			self.table.end_game(seat.user)
+			self.table.play()
+			result = validate(solution)
+			result.passed = True
+			return result
+		task.problem.validate = restart_then_validate
+		self.table.submit_answer(seat.user, "")
+		self.assertEqual(sum(1 for other in self.table.table if other.token), self.table.token_count)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,9 +1,15 @@
 #! /usr/bin/env python
 
+import collections
+import logging
+import math
 import random
 import string
+import threading
+import time
 
 import challenges
+import problem_bank
 
 class StaticProblemGenerator(object):
 	"""A simple problem generator for testing
@@ -16,39 +22,304 @@ class StaticProblemGenerator(object):
 					challenges.CodingProblem(
 						"Write a function called 'foo' that takes one str argument and appends the string 'foo' to it.",
 						"foo",
-						lambda f: f("stuff") == "stufffoo"
+						["stuff"],
+						["stufffoo"]
 					)
 				)
 
 class ProblemGenerator(object):
 	"""A coding problem generator
 
-	Generates a random coding problem from a number
-	of specific generators.
+	Draws random coding problems from a problem bank, or generates
+	them from a number of specific generators if there is no bank.
+
+	Attrs:
+	  bank: A ProblemBank to draw problems from, or None to use the
+	    bank in problem_bank.PROBLEM_BANK_FILE if there is one.
+	  kinds: A list of strs. The kinds of problem to hand out, or
+	    None for every kind.
+	  recent: An int. Problems with the same statement as one of
+	    the last this many problems drawn from a bank are drawn
+	    again.
+	  rng: A random.Random to draw problems with, or None to use the
+	    random module.
 	"""
+	# the most times a recently seen problem is redrawn, for small banks
+	MAX_REDRAWS = 8
+
+	def __init__(self, bank=None, kinds=None, recent=1024, rng=None):
+		"""Initialize this ProblemGenerator
+
+		Args:
+		  bank: A ProblemBank. [Default: the shared bank, if any]
+		  kinds: A list of strs. The kinds of problem to hand out.
+		    [Default: None]
+		  recent: An int. How many drawn statements to avoid
+		    repeating. [Default: 1024]
+		  rng: A random.Random. Pass a seeded one to draw the same
+		    problems every time. [Default: None]
+		"""
+		self.bank = bank
+		self.kinds = kinds
+		self.recent = recent
+		self.rng = rng
+
 	def __iter__(self):
-		generators = (
-			iter(challenges.AppendProblemGenerator()),
-			iter(challenges.AdditionProblemGenerator()),
-			iter(challenges.SubstitutionProblemGenerator()),
+		bank = self.bank or problem_bank.get_problem_bank()
+		problems = self.draw(bank) if bank is not None else self.generate()
+		for problem in problems:
+			yield CodingProblemAssignment(problem)
+
+	def generate(self):
+		"""Yields problems generated live"""
+		generators = tuple(
+			iter(problem_generator) for problem_generator in (
+				challenges.AppendProblemGenerator(self.rng),
+				challenges.AdditionProblemGenerator(self.rng),
+				challenges.SubstitutionProblemGenerator(self.rng),
+			) if not self.kinds or problem_generator.KIND in self.kinds
 		)
+		choice = (self.rng or random).choice
 		while True:
-			yield CodingProblemAssignment(
-				next(random.choice(generators))
-			)
+			yield next(choice(generators))
+
+	def draw(self, bank):
+		"""Yields problems drawn from a bank, avoiding recent repeats"""
+		recent = collections.deque()
+		seen = set()
+		rng = self.rng or random
+		while True:
+			for _ in xrange(self.MAX_REDRAWS):
+				problem = bank.draw(self.kinds, rng)
+				if problem.statement not in seen:
+					break
+			if problem.statement not in seen:
+				seen.add(problem.statement)
+				recent.append(problem.statement)
+				if len(recent) > self.recent:
+					seen.discard(recent.popleft())
+			yield problem
+
+class ProblemPool(object):
+	"""A bounded pool of ready-made coding problems
+
+	Wraps a problem iterator so that handing out a problem is a
+	constant time pop. A background thread tops the pool back up
+	after problems are taken, so generation happens off the
+	caller's critical path. If the pool is empty the problem is
+	generated inline and counted as a miss.
+
+	Attrs:
+	  problems: An iterator of CodingProblemAssignments. The source
+	    of new problems.
+	  size: An int. The number of problems kept ready.
+	  hits: An int. The number of problems served from the pool.
+	  misses: An int. The number of problems generated inline
+	    because the pool was empty.
+	  refills: An int. The number of times the pool was topped up.
+	  refill_seconds: A float. The total time spent topping up.
+	  last_refill_seconds: A float. The time the last top up took.
+	"""
+
+	def __init__(self, problems, size=16, background=True):
+		"""Initialize this ProblemPool
+
+		The pool is filled lazily, starting with the first problem
+		taken from it.
+
+		Args:
+		  problems: An iterator of CodingProblemAssignments.
+		  size: An int. The number of problems to keep ready.
+		    [Default: 16]
+		  background: A bool. Whether to refill the pool from a
+		    background thread. If False, call refill to top the
+		    pool up. [Default: True]
+		"""
+		self.problems = problems
+		self.size = size
+		self.background = background
+		self.hits = 0
+		self.misses = 0
+		self.refills = 0
+		self.refill_seconds = 0.0
+		self.last_refill_seconds = 0.0
+
+		self._pool = collections.deque()
+		self._source_lock = threading.Lock()
+		self._stats_lock = threading.Lock()
+		self._wanted = threading.Event()
+		self._worker = None
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		"""Take a problem out of the pool"""
+		try:
+			problem = self._pool.popleft()
+			hit = True
+		except IndexError:
+			problem = self.generate()
+			hit = False
+		with self._stats_lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+		self.wake()
+		return problem
+
+	def generate(self):
+		"""Generate one problem from the source iterator"""
+		# generators can't be advanced from two threads at once
+		with self._source_lock:
+			return next(self.problems)
+
+	def refill(self):
+		"""Top the pool up to its size
+
+		Returns: An int. The number of problems generated.
+		"""
+		start = time.time()
+		added = 0
+		while len(self._pool) < self.size:
+			self._pool.append(self.generate())
+			added += 1
+		if added:
+			elapsed = time.time() - start
+			with self._stats_lock:
+				self.refills += 1
+				self.refill_seconds += elapsed
+				self.last_refill_seconds = elapsed
+		return added
+
+	def wake(self):
+		"""Ask the background thread to refill the pool"""
+		if not self.background:
+			return
+		if self._worker is None:
+			with self._stats_lock:
+				if self._worker is None:
+					self._worker = threading.Thread(target=self._run, name="ProblemPool refill")
+					self._worker.daemon = True
+					self._worker.start()
+		self._wanted.set()
+
+	def _run(self):
+		while True:
+			self._wanted.wait()
+			self._wanted.clear()
+			try:
+				self.refill()
+			except Exception:
+				# next() falls back to generating inline until a refill works
+				logging.exception("Failed to refill the problem pool")
+
+	def stats(self):
+		"""Returns a dict of the pool's hit, miss and refill metrics"""
+		with self._stats_lock:
+			return {
+				"ready": len(self._pool),
+				"size": self.size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"refills": self.refills,
+				"refill_seconds": self.refill_seconds,
+				"last_refill_seconds": self.last_refill_seconds,
+				"mean_refill_seconds": self.refill_seconds / self.refills if self.refills else 0.0,
+			}
+
+SCREW_CHARS = string.ascii_letters + string.digits + string.punctuation
+SCREW_BYTES = bytearray(SCREW_CHARS)
+
+def screw_positions(length, rate, rng=random):
+	"""Yield the positions of a buffer to substitute
+
+	Each position is picked with probability rate, but rather than
+	drawing once per position, the gap to the next picked position is
+	drawn from the geometric distribution, so the cost is
+	proportional to the number of positions picked.
+
+	Args:
+	  length: An int. The length of the buffer.
+	  rate: A float. The chance of picking each position.
+	  rng: A random.Random to draw with. [Default: the random module]
+
+	Returns: A generator of increasing ints below length.
+	"""
+	if rate <= 0:
+		return
+	if rate >= 1:
+		for pos in xrange(length):
+			yield pos
+		return
+	log_keep = math.log(1.0 - rate)
+	rand = rng.random
+	pos = -1
+	while True:
+		pos += int(math.log(1.0 - rand()) / log_keep) + 1
+		if pos >= length:
+			return
+		yield pos
+
+def screw(solution, rate, rng=random):
+	"""Returns a copy of a solution with random characters substituted
+
+	Args:
+	  solution: A str or unicode. The solution to mutate.
+	  rate: A float. The chance of each character being substituted.
+	  rng: A random.Random to draw with. [Default: the random module]
+	"""
+	if isinstance(solution, unicode):
+		buf = list(solution)
+		chars = SCREW_CHARS
+	else:
+		buf = bytearray(solution)
+		chars = SCREW_BYTES
+	choice = rng.choice
+	for pos in screw_positions(len(buf), rate, rng):
+		buf[pos] = choice(chars)
+	if isinstance(solution, unicode):
+		return u"".join(buf)
+	return str(buf)
+
+def patch(text, patches):
+	"""Returns a copy of a text with patches applied
+
+	Args:
+	  text: A str or unicode.
+	  patches: A list of [start, end, replacement] lists, applied in
+	    order. Each replaces text[start:end] of the text as patched so
+	    far with replacement, so [start, start, "abc"] inserts and
+	    [start, end, ""] deletes.
+
+	Throws: ValueError if a patch is malformed or out of range.
+	"""
+	for edit in patches:
+		try:
+			start, end, replacement = edit
+		except (TypeError, ValueError):
+			raise ValueError("a patch must be [start, end, replacement], not {0!r}".format(edit))
+		if not isinstance(start, (int, long)) or not isinstance(end, (int, long)) or not isinstance(replacement, basestring):
+			raise ValueError("a patch must be [start, end, replacement], not {0!r}".format(edit))
+		if not 0 <= start <= end <= len(text):
+			raise ValueError("patch [{0}, {1}] is outside a draft of length {2}".format(start, end, len(text)))
+		text = text[:start] + replacement + text[end:]
+	return text
 
 class CodingProblemAssignment(object):
 	"""A coding assignment
 
 	Contains the problem being worked on and the student's current progress
 	at implementing a solution.
+
+	Attrs:
+	  problem: A CodingProblem. The problem being worked on.
+	  solution: A str. The draft of the solution so far.
+	  version: An int. Incremented every time the solution changes, so
+	    that patches can name the draft they apply to.
 	"""
 	SCREW_FACTOR = 0.05
-	SCREW_CHARS = string.ascii_letters + string.digits + string.punctuation
-
-	def random_char(self):
-		"""Generate a random printable character"""
-		return random.choice(self.SCREW_CHARS)
 
 	def __init__(self, problem):
 		"""Initialize this CodingProblemAssignment
@@ -58,6 +329,7 @@ class CodingProblemAssignment(object):
 		"""
 		self.problem = problem
 		self.solution = ""
+		self.version = 0
 
 	def update_solution(self, solution):
 		"""Update the solution currently saved to this assignment
@@ -67,6 +339,26 @@ class CodingProblemAssignment(object):
 		    (possibly incomplete)
 		"""
 		self.solution = solution
+		self.version += 1
+
+	def patch_solution(self, version, patches):
+		"""Apply patches to the solution currently saved to this assignment
+
+		Args:
+		  version: An int. The version of the solution the patches were
+		    made against.
+		  patches: A list of patches, see patch.
+
+		Throws: ValueError if the solution is no longer at version or a
+		  patch is malformed.
+
+		Returns: An int. The new version of the solution.
+		"""
+		if version != self.version:
+			raise ValueError("the draft is at version {0}, not {1}".format(self.version, version))
+		self.solution = patch(self.solution, patches)
+		self.version += 1
+		return self.version
 
 	def submit_solution(self, solution):
 		"""Grade the given solution
@@ -75,26 +367,29 @@ class CodingProblemAssignment(object):
 		wipes out the current solution so if the user's submission
 		fails they need to start over.
 
+		Tables wipe the draft under their own lock instead, see
+		Table.submit_answer.
+
 		Args:
 		  solution: A string. The solution is a string of pythong code.
 
-		Returns: A bool. Whether or not the solution passed all tests.
+		Returns: A sandbox.ExecutionResult. It is truthy if the solution
+		  passed all tests.
 		"""
 		# wipe out solution on submit.
 		self.update_solution("")
 		return self.problem.validate(solution)
 
-	def screw_solution(self):
+	def screw_solution(self, rate=None, rng=random):
 		"""Substitute random characters in the solution
 
 		Change random characters in the solution currently
 		being worked on to random values. The user then has
 		to deal with the fallout.
+
+		Args:
+		  rate: A float. The chance of each character being
+		    substituted. [Default: SCREW_FACTOR]
+		  rng: A random.Random to draw with. [Default: the random module]
 		"""
-		new_solution = ""
-		for c in self.solution:
-			if random.random() > self.SCREW_FACTOR:
-				new_solution += self.random_char()
-			else:
-				new_solution += c
-		self.solution = new_solution
+		self.update_solution(screw(self.solution, self.SCREW_FACTOR if rate is None else rate, rng))
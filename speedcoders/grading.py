@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+import sc_exceptions as exc
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class GradingJob(object):
+	"""A queued submission
+
+	Attrs:
+	  id: A str. The id the submitter polls for the result with.
+	  user: A str. The user who submitted the solution.
+	  solution: A str. The submitted python code.
+	  grade: A function(user, solution) that grades the solution.
+	  state: A str. One of QUEUED, RUNNING, DONE or FAILED.
+	  result: The value returned by grading the solution, once DONE.
+	  error: The exception raised while grading, once FAILED.
+	  submitted: A float. When the job was queued.
+	  finished: A float. When the job was DONE or FAILED, or None.
+	"""
+
+	def __init__(self, job_id, user, solution, grade):
+		"""Initialize this GradingJob
+
+		Args:
+		  job_id: A str. The id of this job.
+		  user: A str. The user who submitted the solution.
+		  solution: A str. The submitted python code.
+		  grade: A function(user, solution) that grades the solution.
+		"""
+		self.id = job_id
+		self.user = user
+		self.solution = solution
+		self.grade = grade
+		self.state = QUEUED
+		self.result = None
+		self.error = None
+		self.submitted = time.time()
+		self.finished = None
+		self._done = threading.Event()
+
+	def done(self):
+		"""Returns True if this job is DONE or FAILED"""
+		return self._done.is_set()
+
+	def wait(self, timeout):
+		"""Block until this job is finished or the timeout passes
+
+		Args:
+		  timeout: A float. The most seconds to wait.
+
+		Returns: A bool. Whether the job is finished.
+		"""
+		return self._done.wait(timeout)
+
+	def finish(self, result=None, error=None):
+		"""Record the outcome of this job and wake up any waiters"""
+		self.result = result
+		self.error = error
+		self.state = DONE if error is None else FAILED
+		self.finished = time.time()
+		self._done.set()
+
+
+class GradingQueue(object):
+	"""Grades submissions in worker threads
+
+	Request threads queue a submission and return straight away
+	instead of blocking on the table lock and the solution itself.
+	The number of workers bounds how many solutions are graded at
+	once, and the queue size bounds how many can wait.
+
+	Attrs:
+	  grade: A function taking a user and a solution, which grades
+	    the solution and returns the result to report. Used for jobs
+	    submitted without a grade function of their own.
+	  retain: A float. The seconds a finished job is kept for polling.
+	"""
+
+	def __init__(self, grade=None, workers=2, max_queued=100, retain=300):
+		"""Initialize this GradingQueue and start its workers
+
+		Args:
+		  grade: A function(user, solution) that grades a solution.
+		    [Default: None]
+		  workers: An int. The number of worker threads. [Default: 2]
+		  max_queued: An int. The most jobs that can wait to be
+		    graded. [Default: 100]
+		  retain: A float. The seconds a finished job is kept.
+		    [Default: 300]
+		"""
+		self.grade = grade
+		self.retain = retain
+		self._queue = Queue.Queue(max_queued)
+		self._jobs = {}
+		self._jobs_lock = threading.Lock()
+		self._ids = itertools.count(1)
+		for num in xrange(workers):
+			worker = threading.Thread(target=self._run, name="GradingQueue worker {0}".format(num))
+			worker.daemon = True
+			worker.start()
+
+	def submit(self, user, solution, grade=None):
+		"""Queue a solution for grading
+
+		Args:
+		  user: A str. The user submitting the solution.
+		  solution: A str. The python code to grade.
+		  grade: A function(user, solution) to grade this solution
+		    with, such as the submit_answer of the user's table.
+		    [Default: self.grade]
+
+		Throws: Queue.Full if too many jobs are already waiting.
+
+		Returns: The queued GradingJob.
+		"""
+		self.prune()
+		with self._jobs_lock:
+			job = GradingJob(str(next(self._ids)), user, solution, grade or self.grade)
+			self._jobs[job.id] = job
+		try:
+			self._queue.put_nowait(job)
+		except Queue.Full:
+			with self._jobs_lock:
+				del self._jobs[job.id]
+			raise
+		return job
+
+	def get(self, job_id):
+		"""Returns the GradingJob with the given id or None"""
+		with self._jobs_lock:
+			return self._jobs.get(job_id)
+
+	def prune(self):
+		"""Forget finished jobs older than retain seconds"""
+		cutoff = time.time() - self.retain
+		with self._jobs_lock:
+			for job_id in [job.id for job in self._jobs.itervalues() if job.done() and job.finished < cutoff]:
+				del self._jobs[job_id]
+
+	def _run(self):
+		while True:
+			job = self._queue.get()
+			job.state = RUNNING
+			try:
+				job.finish(result=job.grade(job.user, job.solution))
+			except (exc.IllegalArgumentException, exc.IllegalStateException) as e:
+				job.finish(error=e)
+			except Exception as e:
+				logging.exception("Failed to grade job %s", job.id)
+				job.finish(error=e)
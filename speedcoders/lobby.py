@@ -0,0 +1,420 @@
+#! /usr/bin/env python
+
+import collections
+import functools
+import itertools
+import time
+import uuid
+
+import game
+import locks
+import sc_exceptions as exc
+import state_store
+
+class TableRegistry(object):
+	"""Creates, finds and closes Tables by id
+
+	Every Table keeps its own lock, so tables never contend with one
+	another. The registry's lock only guards the id to table mapping
+	and is never held while a table is being used.
+
+	Tables that go unused for idle_timeout seconds are evicted, as
+	are the least recently used tables once there are more than
+	max_tables. Pinned tables are never evicted.
+
+	Given a state store, the registry is a local read cache over it.
+	Changed tables are saved behind the scenes by a WriteBehind, and
+	tables missing from the cache are loaded from the store, so every
+	instance sharing the store serves the same games. A cached table
+	is checked against the store's version at most every cache_ttl
+	seconds, and loaded again if another instance changed it. Evicting
+	a table only drops it from the cache. Which tables can be joined,
+	and the table each user is sitting at, are kept in the store too,
+	so users are listed every table and seated only once across
+	instances. Without a store they are kept in a MemoryStore here.
+
+	Attrs:
+	  seats: An int. The number of seats at new tables.
+	  tokens: An int. The number of tokens at new tables.
+	  max_tables: An int. The most tables kept at once.
+	  idle_timeout: A float. The seconds an unused table is kept.
+	  store: A state store such as a state_store.SqliteStore, or None
+	    to keep tables in this process only.
+	  writer: The state_store.WriteBehind saving tables to the store.
+	  cache_ttl: A float. The seconds a cached table is served
+	    without checking the store for a newer version.
+	  seats_index: The store holding users' seat claims, the store
+	    itself or a MemoryStore if there isn't one.
+	  claim_grace: A float. The seconds a seat claim is trusted
+	    before the table is seen to have the user, since another
+	    instance may not have saved the table yet.
+	"""
+
+	def __init__(self, seats=4, tokens=2, max_tables=10000, idle_timeout=3600, store=None, write_delay=0.5, cache_ttl=1.0):
+		"""Initialize this TableRegistry
+
+		Args:
+		  seats: An int. The number of seats at new tables. [Default: 4]
+		  tokens: An int. The number of tokens at new tables. [Default: 2]
+		  max_tables: An int. The most tables kept at once.
+		    [Default: 10000]
+		  idle_timeout: A float. The seconds an unused table is kept.
+		    [Default: 3600]
+		  store: A state store. [Default: None]
+		  write_delay: A float. The most seconds a change waits to be
+		    saved to the store. [Default: 0.5]
+		  cache_ttl: A float. The seconds a cached table is served
+		    without checking the store. [Default: 1.0]
+		"""
+		self.seats = seats
+		self.tokens = tokens
+		self.max_tables = max_tables
+		self.idle_timeout = idle_timeout
+		self.store = store
+		self.writer = state_store.WriteBehind(store, write_delay) if store is not None else None
+		self.cache_ttl = cache_ttl
+		self.seats_index = store if store is not None else state_store.MemoryStore()
+		self.claim_grace = 2 * (write_delay + cache_ttl)
+		# table id -> (table, last used), least recently used first
+		self._tables = collections.OrderedDict()
+		self._pinned = set()
+		self._ids = itertools.count(1)
+		self._lock = locks.InstrumentedLock("TableRegistry")
+
+	def __len__(self):
+		return len(self._tables)
+
+	def create(self, seats=None, tokens=None, table_id=None, pinned=False, seed=None, record=False):
+		"""Create a new Table
+
+		Args:
+		  seats: An int. The number of seats. [Default: self.seats]
+		  tokens: An int. The number of tokens. [Default: self.tokens]
+		  table_id: A str. The id to give the table. [Default: the
+		    next free number]
+		  pinned: A bool. Whether the table is exempt from eviction.
+		    [Default: False]
+		  seed: An int. The seed of the table's random streams.
+		    [Default: a fresh seed]
+		  record: A bool. Whether the table records its actions for
+		    replay. [Default: False]
+
+		Throws: IllegalStateException if table_id is already taken.
+
+		Returns: A tuple (table_id, Table).
+		"""
+		table = game.Table(seats=seats or self.seats, tokens=tokens or self.tokens, seed=seed, record=record)
+		if table_id is not None and self.store is not None and self.store.version(table_id) is not None:
+			raise exc.IllegalStateException("Table {0} already exists.".format(table_id))
+		with self._lock.hold("create"):
+			if table_id is None:
+				table_id = self.new_id()
+				while table_id in self._tables:
+					table_id = self.new_id()
+			elif table_id in self._tables:
+				raise exc.IllegalStateException("Table {0} already exists.".format(table_id))
+			self._evict(reserve=1)
+			self._tables[table_id] = (table, time.time())
+			if pinned:
+				self._pinned.add(table_id)
+		if self.writer is not None:
+			table.on_change = functools.partial(self.writer.mark, table_id, table)
+			self.writer.mark(table_id, table)
+		return table_id, table
+
+	def new_id(self):
+		"""Returns an id for a new table
+
+		Ids are numbered in order, unless tables are shared through a
+		store, where other instances are numbering tables too.
+		"""
+		if self.store is not None:
+			return uuid.uuid4().hex[:10]
+		return str(next(self._ids))
+
+	def get_or_create(self, table_id, pinned=False):
+		"""Returns the Table with the given id, creating it if missing
+
+		Args:
+		  table_id: A str. The id of the table.
+		  pinned: A bool. Whether the table is exempt from eviction.
+		    [Default: False]
+		"""
+		if pinned:
+			with self._lock.hold("get_or_create"):
+				self._pinned.add(table_id)
+		table = self.get(table_id)
+		if table is None:
+			try:
+				table_id, table = self.create(table_id=table_id, pinned=pinned)
+			except exc.IllegalStateException:
+				# created by another thread or instance in the meantime
+				table = self.get(table_id)
+		return table
+
+	def get(self, table_id):
+		"""Returns the Table with the given id or None
+
+		Marks the table as used. With a store, tables missing from the
+		cache or changed by another instance are loaded from it.
+		"""
+		with self._lock.hold("get"):
+			entry = self._tables.pop(table_id, None)
+			if entry is not None:
+				self._tables[table_id] = (entry[0], time.time())
+				self._evict()
+		table = entry[0] if entry is not None else None
+		if self.store is not None and (table is None or self._stale(table_id, table)):
+			table = self._load(table_id, table)
+		return table
+
+	def _stale(self, table_id, table):
+		"""Returns True if the store holds a newer version of a cached table"""
+		if table.stale:
+			return True
+		now = time.time()
+		if self.writer.pending(table_id) is not None or now - table.checked < self.cache_ttl:
+			return False
+		version = self.store.version(table_id)
+		if version == table.stored_version or (version is None and table.stored_version is None):
+			# up to date, or created here and not saved yet
+			table.checked = now
+			return False
+		return True
+
+	def _load(self, table_id, old=None):
+		"""Load a table from the store into the cache
+
+		A cached table that another instance changed is updated in
+		place rather than replaced, so requests, grading jobs and
+		schedulers holding on to it carry on with the new state.
+
+		Args:
+		  table_id: A str. The id of the table.
+		  old: A Table. The stale cached copy, if any. [Default: None]
+
+		Returns: The loaded Table, or None if the store doesn't have it.
+		"""
+		entry = self.store.get(table_id)
+		with self._lock.hold("load"):
+			current = self._tables.get(table_id)
+			if current is not None and current[0] is not old:
+				# another thread got here first
+				return current[0]
+			pending = self.writer.pending(table_id)
+			if pending is not None and pending is not old:
+				# evicted before its changes were saved
+				self._tables.pop(table_id, None)
+				self._tables[table_id] = (pending, time.time())
+				return pending
+			if entry is None:
+				if old is not None:
+					old.on_change = None
+				self._tables.pop(table_id, None)
+				return None
+			if old is None:
+				version, state = entry
+				table = game.Table.from_state(state)
+				table.stored_version = version
+				table.on_change = functools.partial(self.writer.mark, table_id, table)
+				self._evict(reserve=1)
+				self._tables[table_id] = (table, time.time())
+				return table
+
+		version, state = entry
+		with old.lock.hold("load_state"):
+			# versions only grow, so an older entry read before a save
+			# of this table finished is never loaded over it
+			if old.stale or old.stored_version is None or version > old.stored_version:
+				# any local changes lost the race with the other instance
+				self.writer.forget(table_id)
+				old.load_state(state)
+				old.stored_version = version
+				old.publish(game.RELOADED, version=old.version)
+			old.stale = False
+			old.checked = time.time()
+		return old
+
+	def close(self, table_id):
+		"""Remove the Table with the given id
+
+		Throws: IllegalStateException if the table is pinned.
+
+		Returns: A bool. Whether there was such a table.
+		"""
+		with self._lock.hold("close"):
+			if table_id in self._pinned:
+				raise exc.IllegalStateException("Table {0} can't be closed.".format(table_id))
+			found = self._tables.pop(table_id, None) is not None
+		if self.store is not None:
+			self.writer.forget(table_id)
+			found = self.store.version(table_id) is not None or found
+		# drops the seat claims at the table too
+		self.seats_index.delete(table_id)
+		return found
+
+	def open_tables(self):
+		"""Returns a list of (table_id, Table) with seats to fill
+
+		With a store, this includes the tables other instances
+		created, loading them into the cache.
+		"""
+		with self._lock.hold("open_tables"):
+			tables = [(table_id, entry[0]) for table_id, entry in self._tables.iteritems()]
+		if self.store is not None:
+			cached = set(table_id for table_id, table in tables)
+			for table_id in self.store.joinable():
+				if table_id not in cached:
+					table = self.get(table_id)
+					if table is not None:
+						tables.append((table_id, table))
+		return [(table_id, table) for table_id, table in tables if table.joinable()]
+
+	def seated_at(self, user):
+		"""Returns a tuple (table_id, Table) of the table a user is
+		sitting at, or None if they aren't seated"""
+		claim = self.seats_index.seated(user)
+		if claim is None:
+			return None
+		table_id = claim[0]
+		table = self.get(table_id)
+		if table is None or table.get_seat(user) is None:
+			# closed, or the seat isn't saved yet or was lost
+			return None
+		return table_id, table
+
+	def _claim_seat(self, user, table_id):
+		"""Claim a seat at a table for a user in the seats index
+
+		A claim on another table is taken over only once it is older
+		than claim_grace and that table doesn't have the user.
+
+		Throws: IllegalStateException if the user is sitting at
+		  another table.
+
+		Returns: A bool. Whether this call made the claim, rather
+		  than the user already having one at the table.
+		"""
+		claim = self.seats_index.seated(user)
+		if claim is not None and claim[0] == table_id:
+			return False
+		if claim is not None and self._claim_live(user, claim):
+			raise exc.IllegalStateException("{0} is already sitting at table {1}.".format(user, claim[0]))
+		if not self.seats_index.claim_seat(user, table_id, claim[0] if claim else None):
+			# sat down somewhere at the same time
+			claim = self.seats_index.seated(user)
+			raise exc.IllegalStateException("{0} is already sitting at table {1}.".format(user, claim[0] if claim else table_id))
+		return True
+
+	def _claim_live(self, user, claim):
+		"""Returns whether a seat claim can't be taken over yet
+
+		Args:
+		  user: A str. The user holding the claim.
+		  claim: A tuple (table_id, claimed_at) from the seats index.
+		"""
+		table_id, claimed_at = claim
+		if time.time() - claimed_at < self.claim_grace:
+			return True
+		table = self.get(table_id)
+		return table is not None and table.get_seat(user) is not None
+
+	def sit(self, table_id, user, seat_num=None):
+		"""Seat a user at a table, if they aren't sitting at another
+
+		Args:
+		  table_id: A str. The id of the table.
+		  user: A str. The user to seat.
+		  seat_num: An int. The seat to take. [Default: the first
+		    empty seat]
+
+		Throws: IllegalArgumentException if there is no such table.
+		  IllegalStateException if the user is sitting at another
+		  table, or as Table.add_user.
+
+		Returns: A json representation of the seat taken.
+		"""
+		table = self.get(table_id)
+		if table is None:
+			raise exc.IllegalArgumentException("No table {0}.".format(table_id))
+		# claimed first, so no other instance can seat the user meanwhile
+		claimed = self._claim_seat(user, table_id)
+		try:
+			return table.add_user(user, seat_num)
+		except:
+			if claimed:
+				self.seats_index.release_seat(user, table_id)
+			raise
+
+	def stand(self, table_id, user):
+		"""Remove a user from a table
+
+		Throws: IllegalArgumentException if there is no such table.
+		  IllegalStateException as Table.remove_user.
+
+		Returns: A json representation of the vacated seat.
+		"""
+		table = self.get(table_id)
+		if table is None:
+			raise exc.IllegalArgumentException("No table {0}.".format(table_id))
+		seat = table.remove_user(user)
+		self.seats_index.release_seat(user, table_id)
+		return seat
+
+	def join(self, user):
+		"""Seat a user at the first table with an empty seat
+
+		A user already sitting at a table gets their seat there back.
+		A new table is created if every table is full or playing.
+
+		Args:
+		  user: A str. The user to seat.
+
+		Throws: IllegalStateException if the user is sitting at a
+		  table that isn't saved yet, or sat down at another table
+		  while being seated.
+
+		Returns: A tuple (table_id, seat json).
+		"""
+		seated = self.seated_at(user)
+		if seated is not None:
+			table_id, table = seated
+			return table_id, table.get_seat(user).to_json()
+		claim = self.seats_index.seated(user)
+		if claim is not None and self._claim_live(user, claim):
+			# seated by another instance that hasn't saved the table yet
+			raise exc.IllegalStateException("{0} is already sitting at table {1}.".format(user, claim[0]))
+		for table_id, table in self.open_tables():
+			try:
+				return table_id, self.sit(table_id, user)
+			except AssertionError:
+				# started since it was listed
+				continue
+			except exc.IllegalStateException:
+				if table.full():
+					# filled up since it was listed
+					continue
+				raise
+		table_id, table = self.create()
+		return table_id, self.sit(table_id, user)
+
+	def _evict(self, reserve=0):
+		"""Drop idle tables and any tables over max_tables
+
+		Must be called with the lock held. Only the least recently
+		used end of the ordering is examined, so this is cheap.
+
+		Args:
+		  reserve: An int. The number of tables about to be added,
+		    to make room for. [Default: 0]
+		"""
+		cutoff = time.time() - self.idle_timeout
+		for _ in xrange(len(self._tables)):
+			table_id = next(iter(self._tables))
+			table, last_used = self._tables[table_id]
+			if len(self._tables) + reserve <= self.max_tables and last_used >= cutoff:
+				return
+			del self._tables[table_id]
+			if table_id in self._pinned:
+				# keep pinned tables, but move them out of the way
+				self._tables[table_id] = (table, time.time())
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+import threading
+import time
+import weakref
+
+import metrics
+
+# every InstrumentedLock, for reporting across all tables
+_LOCKS = weakref.WeakSet()
+
+class LockStats(object):
+	"""Wait and hold times of one method on a lock
+
+	Attrs:
+	  count: An int. The number of times the method took the lock.
+	  wait_total: A float. The seconds spent waiting to take the lock.
+	  wait_max: A float. The longest wait.
+	  hold_total: A float. The seconds the lock was held.
+	  hold_max: A float. The longest hold.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+		self.hold_total = 0.0
+		self.hold_max = 0.0
+
+	def add(self, other):
+		"""Add the times recorded in another LockStats to these"""
+		self.count += other.count
+		self.wait_total += other.wait_total
+		self.wait_max = max(self.wait_max, other.wait_max)
+		self.hold_total += other.hold_total
+		self.hold_max = max(self.hold_max, other.hold_max)
+
+	def to_dict(self):
+		"""Returns a json serializable representation of these stats"""
+		return {
+			"count": self.count,
+			"wait_total": self.wait_total,
+			"wait_mean": self.wait_total / self.count if self.count else 0.0,
+			"wait_max": self.wait_max,
+			"hold_total": self.hold_total,
+			"hold_mean": self.hold_total / self.count if self.count else 0.0,
+			"hold_max": self.hold_max,
+		}
+
+
+class _Hold(object):
+	"""Context manager returned by InstrumentedLock.hold"""
+
+	def __init__(self, lock, method):
+		self.lock = lock
+		self.method = method
+
+	def __enter__(self):
+		lock = self.lock
+		start = time.time()
+		lock._lock.acquire()
+		self.acquired = time.time()
+		# only the outermost hold of a reentrant lock is timed
+		self.outer = lock._depth == 0
+		lock._depth += 1
+		if self.outer:
+			self.wait = self.acquired - start
+
+	def __exit__(self, exc_type, exc_value, tb):
+		lock = self.lock
+		lock._depth -= 1
+		if self.outer:
+			held = time.time() - self.acquired
+			# still holding the lock, so the stats need no lock of their own
+			stats = lock.stats.get(self.method)
+			if stats is None:
+				stats = lock.stats[self.method] = LockStats()
+			stats.count += 1
+			stats.wait_total += self.wait
+			stats.wait_max = max(stats.wait_max, self.wait)
+			stats.hold_total += held
+			stats.hold_max = max(stats.hold_max, held)
+		lock._lock.release()
+		# recorded once released, so other waiters don't queue behind the histogram
+		if self.outer:
+			metrics.record("{0}.{1}.lock_wait".format(lock.name, self.method), self.wait)
+
+
+class InstrumentedLock(object):
+	"""A reentrant lock that records wait and hold times per method
+
+	Use as:
+	  with lock.hold("method_name"):
+	      ...
+
+	Attrs:
+	  name: A str. The name the stats of this lock are reported under,
+	    shared by all locks of the same kind, such as "Table".
+	  stats: A dict of method names to LockStats.
+	"""
+
+	def __init__(self, name):
+		"""Initialize this InstrumentedLock
+
+		Args:
+		  name: A str. The name to report the stats of this lock under.
+		"""
+		self.name = name
+		self.stats = {}
+		self._lock = threading.RLock()
+		self._depth = 0
+		_LOCKS.add(self)
+
+	def hold(self, method):
+		"""Returns a context manager which holds this lock
+
+		Args:
+		  method: A str. The name of the method taking the lock.
+		"""
+		return _Hold(self, method)
+
+
+def report():
+	"""Returns a dict of the lock stats of every live InstrumentedLock
+
+	Stats are combined across locks with the same name and keyed by
+	"name.method", so the report shows which methods wait on or hold
+	their locks the longest across all tables.
+	"""
+	totals = {}
+	for lock in list(_LOCKS):
+		for method, stats in lock.stats.items():
+			key = "{0}.{1}".format(lock.name, method)
+			if key not in totals:
+				totals[key] = LockStats()
+			totals[key].add(stats)
+	return dict((key, stats.to_dict()) for key, stats in totals.iteritems())
@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+
+import cProfile
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets. Each is
+# twice the last, from half a millisecond to half a minute, with a last
+# bucket for anything slower.
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** num for num in xrange(17))
+
+class Histogram(object):
+	"""Counts of durations in exponentially sized buckets
+
+	Percentiles are estimated as the upper bound of the bucket they
+	fall in, or the longest duration if that is lower, so they are
+	never under reported.
+
+	Attrs:
+	  bounds: A tuple of floats. The upper bound of each bucket.
+	  counts: A list of ints. The number of durations in each bucket,
+	    with one more bucket for durations above the last bound.
+	  count: An int. The number of durations recorded.
+	  total: A float. The sum of the durations recorded.
+	  max: A float. The longest duration recorded.
+	"""
+
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		"""Initialize this Histogram
+
+		Args:
+		  bounds: A sorted tuple of floats. The upper bound of each
+		    bucket. [Default: LATENCY_BUCKETS]
+		"""
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self._lock = threading.Lock()
+
+	def record(self, seconds):
+		"""Add a duration to this histogram"""
+		bucket = 0
+		for bound in self.bounds:
+			if seconds <= bound:
+				break
+			bucket += 1
+		with self._lock:
+			self.counts[bucket] += 1
+			self.count += 1
+			self.total += seconds
+			self.max = max(self.max, seconds)
+
+	def percentile(self, fraction):
+		"""Returns an upper bound of the given fraction of the durations"""
+		if not self.count:
+			return 0.0
+		rank = fraction * self.count
+		seen = 0
+		for bucket, count in enumerate(self.counts):
+			seen += count
+			if seen >= rank:
+				return min(self.bounds[bucket], self.max) if bucket < len(self.bounds) else self.max
+		return self.max
+
+	def to_dict(self):
+		"""Returns a json serializable representation of this histogram"""
+		with self._lock:
+			counts = list(self.counts)
+		return {
+			"count": self.count,
+			"total": self.total,
+			"mean": self.total / self.count if self.count else 0.0,
+			"max": self.max,
+			"p50": self.percentile(0.50),
+			"p95": self.percentile(0.95),
+			"p99": self.percentile(0.99),
+			# the last bucket has no upper bound
+			"buckets": [[bound, count] for bound, count in zip(self.bounds + (None,), counts) if count],
+		}
+
+
+class Registry(object):
+	"""A set of named histograms, created as durations are recorded"""
+
+	def __init__(self):
+		self._histograms = {}
+		self._lock = threading.Lock()
+
+	def record(self, name, seconds):
+		"""Add a duration to the named histogram"""
+		histogram = self._histograms.get(name)
+		if histogram is None:
+			with self._lock:
+				histogram = self._histograms.setdefault(name, Histogram())
+		histogram.record(seconds)
+
+	def report(self):
+		"""Returns a dict of names to the dicts of their histograms"""
+		return dict((name, histogram.to_dict()) for name, histogram in self._histograms.items())
+
+	def reset(self):
+		"""Forget every recorded duration"""
+		with self._lock:
+			self._histograms = {}
+
+
+# request latencies, by "METHOD route"
+ROUTES = Registry()
+# time spent in parts of the game engine, such as "Table.submit_answer.validate"
+OPERATIONS = Registry()
+
+def route_name(method, template):
+	"""Returns the name the latencies of a route are recorded under
+
+	Args:
+	  method: A str. The HTTP method, such as "GET".
+	  template: A str. The template of the route, or the path if no
+	    route matched. The templates of simple routes are anchored
+	    regexes, and the anchors are dropped.
+	"""
+	return "{0} {1}".format(method, template.lstrip('^').rstrip('$'))
+
+def record(name, seconds):
+	"""Add a duration to the histogram of a game engine operation"""
+	OPERATIONS.record(name, seconds)
+
+class _Timed(object):
+	"""Context manager returned by timed"""
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+
+	def __exit__(self, exc_type, exc_value, tb):
+		OPERATIONS.record(self.name, time.time() - self.start)
+
+def timed(name):
+	"""Returns a context manager recording how long its block takes
+
+	Args:
+	  name: A str. The operation the block is recorded under.
+	"""
+	return _Timed(name)
+
+
+class Profiler(object):
+	"""Profiles a sample of the next requests and aggregates their stats
+
+	Profiling is off until start is called. Each request then has a
+	chance of rate of being profiled, until count requests have been.
+	The stats of every profiled request are added together.
+
+	Attrs:
+	  remaining: An int. The number of requests still to be profiled.
+	  rate: A float. The chance of each request being profiled.
+	  profiled: An int. The number of requests profiled since start.
+	"""
+
+	def __init__(self):
+		self.remaining = 0
+		self.rate = 1.0
+		self.profiled = 0
+		self._stats = None
+		self._lock = threading.Lock()
+		# its own stream, so sampling doesn't disturb seeded draws from the random module
+		self._random = random.Random()
+
+	def start(self, count, rate=1.0):
+		"""Profile a sample of the next requests, dropping earlier stats
+
+		Args:
+		  count: An int. The number of requests to profile.
+		  rate: A float. The chance of each request being profiled.
+		    [Default: 1.0]
+		"""
+		with self._lock:
+			self.remaining = count
+			self.rate = rate
+			self.profiled = 0
+			self._stats = None
+
+	def stop(self):
+		"""Stop profiling requests, keeping the stats so far"""
+		with self._lock:
+			self.remaining = 0
+
+	def begin(self):
+		"""Returns a started cProfile.Profile if this request should be
+		profiled, otherwise None"""
+		# checked without the lock so requests pay nothing while off
+		if self.remaining <= 0 or self._random.random() >= self.rate:
+			return None
+		with self._lock:
+			if self.remaining <= 0:
+				return None
+			self.remaining -= 1
+		profile = cProfile.Profile()
+		profile.enable()
+		return profile
+
+	def end(self, profile):
+		"""Stop a profile from begin and add it to the stats"""
+		profile.disable()
+		with self._lock:
+			if self._stats is None:
+				self._stats = pstats.Stats(profile)
+			else:
+				self._stats.add(profile)
+			self.profiled += 1
+
+	def report(self, sort="cumulative", limit=40):
+		"""Returns the aggregated stats as text
+
+		Args:
+		  sort: A str. A pstats sort key, such as "cumulative" or
+		    "tottime". [Default: "cumulative"]
+		  limit: An int. The most functions to list. [Default: 40]
+		"""
+		output = StringIO.StringIO()
+		with self._lock:
+			output.write("{0} requests profiled, {1} to go\n".format(self.profiled, self.remaining))
+			if self._stats is not None:
+				self._stats.stream = output
+				self._stats.sort_stats(sort).print_stats(limit)
+		return output.getvalue()
+
+PROFILER = Profiler()
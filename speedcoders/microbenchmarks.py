@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import challenges
+import game
+import generator
+import sandbox
+import word_generator
+
+#Time the engine hot paths, append the results to a history file and compare
+#them with an earlier run, flagging anything that got slower than a threshold
+#usage: microbenchmarks.py [-m model] [-o history] [--compare [label]] [-t threshold]
+
+# every benchmark starts from the same random state
+SEED = 1234
+# each timed repeat runs the benchmark for at least this many seconds
+MIN_REPEAT_TIME = 0.1
+REPEATS = 5
+HISTORY_FILE = "benchmark_history.jsonl"
+
+BENCHMARKS = []
+
+def benchmark(name):
+	"""Register a benchmark setup function
+
+	The setup function is called with the parsed arguments and returns
+	the function to time, which takes no arguments.
+	"""
+	def register(setup):
+		BENCHMARKS.append((name, setup))
+		return setup
+	return register
+
+def answers(problem):
+	"""Returns a solution that passes a problem"""
+	cases = dict(zip(problem.test_inputs, problem.expected_outputs))
+	return "def {0}(value):\n\treturn {1!r}[value]\n".format(problem.expected_func, cases)
+
+def wrong_answers(problem):
+	"""Returns a solution that fails a problem"""
+	return "def {0}(value):\n\treturn value\n".format(problem.expected_func)
+
+def sample_problem():
+	return next(iter(challenges.AdditionProblemGenerator(random.Random(SEED))))
+
+def playing_table(seats=4):
+	"""Returns a seeded Table with a game in progress"""
+	table = game.Table(seats=seats, tokens=1, seed=SEED)
+	for num in xrange(seats):
+		table.add_user("user{0}".format(num))
+	table.play()
+	return table
+
+def active_user(table):
+	for seat in table.table:
+		if seat.token:
+			return seat.user
+
+@benchmark("word_generator.load")
+def bench_load(args):
+	return lambda: word_generator.load(args.model)
+
+@benchmark("WordGenerator.generate_word")
+def bench_generate_word(args):
+	words = challenges.get_word_generator()
+	rng = random.Random(SEED)
+	return lambda: words.generate_word(rng=rng)
+
+def bench_problem_generator(problem_generator):
+	problems = iter(problem_generator(random.Random(SEED)))
+	return lambda: next(problems)
+
+benchmark("AppendProblemGenerator")(lambda args: bench_problem_generator(challenges.AppendProblemGenerator))
+benchmark("AdditionProblemGenerator")(lambda args: bench_problem_generator(challenges.AdditionProblemGenerator))
+benchmark("SubstitutionProblemGenerator")(lambda args: bench_problem_generator(challenges.SubstitutionProblemGenerator))
+
+@benchmark("ProblemGenerator")
+def bench_problems(args):
+	problems = iter(generator.ProblemGenerator(rng=random.Random(SEED)))
+	return lambda: next(problems)
+
+@benchmark("CodingProblem.validate pass")
+def bench_validate_pass(args):
+	problem = sample_problem()
+	solution = answers(problem)
+	return lambda: problem.validate(solution)
+
+@benchmark("CodingProblem.validate fail")
+def bench_validate_fail(args):
+	problem = sample_problem()
+	solution = wrong_answers(problem)
+	return lambda: problem.validate(solution)
+
+@benchmark("Table.to_json")
+def bench_to_json(args):
+	table = playing_table()
+	def encode():
+		# drop the cached snapshot and seat json so every call encodes the table
+		for seat in table.table:
+			seat.changed()
+		table._snapshot = None
+		return table.to_json()
+	return encode
+
+@benchmark("Table.to_json cached")
+def bench_to_json_cached(args):
+	return playing_table().to_json
+
+@benchmark("Table.submit_answer pass")
+def bench_submit_pass(args):
+	table = playing_table()
+	def submit():
+		user = active_user(table)
+		table.submit_answer(user, answers(table.get_seat(user).coding_task.problem))
+	return submit
+
+@benchmark("Table.submit_answer fail")
+def bench_submit_fail(args):
+	table = playing_table()
+	def submit():
+		user = active_user(table)
+		table.submit_answer(user, wrong_answers(table.get_seat(user).coding_task.problem))
+	return submit
+
+@benchmark("CodingProblemAssignment.screw_solution")
+def bench_screw(args):
+	task = generator.CodingProblemAssignment(sample_problem())
+	task.update_solution(answers(task.problem) * 8)
+	rng = random.Random(SEED)
+	return lambda: task.screw_solution(rng=rng)
+
+def run(func, loops):
+	start = time.time()
+	for _ in xrange(loops):
+		func()
+	return time.time() - start
+
+def measure(func, repeats=REPEATS):
+	"""Time a function
+
+	Runs the function enough times for each repeat to take at least
+	MIN_REPEAT_TIME, once to warm up and then repeats times.
+
+	Returns: A dict of the best and median seconds per call, and the
+	  calls per repeat.
+	"""
+	loops = 1
+	while True:
+		elapsed = run(func, loops)
+		if elapsed >= MIN_REPEAT_TIME:
+			break
+		loops *= max(2, min(10, int(MIN_REPEAT_TIME / max(elapsed, 1e-6)) + 1))
+	times = sorted(run(func, loops) / loops for _ in xrange(repeats))
+	return {"best": times[0], "median": times[len(times) // 2], "loops": loops}
+
+def run_benchmarks(args):
+	"""Returns a dict of benchmark names to their measure results"""
+	results = {}
+	for name, setup in BENCHMARKS:
+		if args.bench and not any(pattern in name for pattern in args.bench):
+			continue
+		random.seed(SEED)
+		func = setup(args)
+		results[name] = measure(func, args.repeats)
+		print >> sys.stderr, "{0:<42} {1:12.2f} us".format(name, results[name]["best"] * 1e6)
+	return results
+
+def read_history(filename):
+	"""Returns the list of runs saved in a history file"""
+	if not os.path.exists(filename):
+		return []
+	with open(filename) as history:
+		return [json.loads(line) for line in history if line.strip()]
+
+def save_run(filename, run):
+	with open(filename, "a") as history:
+		history.write(json.dumps(run, sort_keys=True) + "\n")
+
+def compare(baseline, results, threshold):
+	"""Compare results with an earlier run
+
+	Args:
+	  baseline: A dict. A run from the history file.
+	  results: A dict of benchmark names to their measure results.
+	  threshold: A float. The fraction a benchmark may slow down by
+	    before it is flagged.
+
+	Returns: A list of the names of the benchmarks that regressed.
+	"""
+	regressions = []
+	print "{0:<42} {1:>12} {2:>12} {3:>8}".format("benchmark", "before us", "after us", "change")
+	for name, result in sorted(results.iteritems()):
+		before = baseline["results"].get(name)
+		if before is None:
+			print "{0:<42} {1:>12} {2:12.2f} {3:>8}".format(name, "-", result["best"] * 1e6, "new")
+			continue
+		change = result["best"] / before["best"] - 1
+		flag = ""
+		if change > threshold:
+			regressions.append(name)
+			flag = "  REGRESSION"
+		print "{0:<42} {1:12.2f} {2:12.2f} {3:+7.1f}%{4}".format(name, before["best"] * 1e6, result["best"] * 1e6, change * 100, flag)
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Time the engine hot paths and track them over time.")
+	parser.add_argument("-m", "--model", default="word_gen3.pickle",
+		help="the word model to load [default: word_gen3.pickle]")
+	parser.add_argument("-o", "--history", default=HISTORY_FILE,
+		help="the history file runs are appended to [default: {0}]".format(HISTORY_FILE))
+	parser.add_argument("-l", "--label",
+		help="a label to save this run under, such as a commit")
+	parser.add_argument("-b", "--bench", action="append",
+		help="only run benchmarks whose name contains this, may be repeated")
+	parser.add_argument("-r", "--repeats", type=int, default=REPEATS,
+		help="timed repeats of each benchmark [default: {0}]".format(REPEATS))
+	parser.add_argument("-c", "--compare", nargs="?", const="", metavar="LABEL",
+		help="compare with the last run, or the last run with this label, exiting 1 if anything regressed")
+	parser.add_argument("-t", "--threshold", type=float, default=0.2,
+		help="the slowdown flagged as a regression [default: 0.2]")
+	parser.add_argument("--no-save", action="store_true",
+		help="don't append this run to the history file")
+	parser.add_argument("--no-sandbox", action="store_true",
+		help="run solutions in this process rather than sandbox workers")
+	args = parser.parse_args()
+
+	challenges.WORD_MODEL_FILE = args.model
+	if args.no_sandbox:
+		sandbox.ENABLED = False
+
+	history = read_history(args.history)
+	baseline = None
+	if args.compare is not None:
+		runs = [past for past in history if not args.compare or past.get("label") == args.compare]
+		if not runs:
+			sys.exit("no earlier run to compare with in {0}".format(args.history))
+		baseline = runs[-1]
+
+	results = run_benchmarks(args)
+	current = {
+		"time": datetime.datetime.utcnow().isoformat(),
+		"label": args.label,
+		"python": platform.python_version(),
+		"sandbox": sandbox.ENABLED,
+		"results": results,
+	}
+	if not args.no_save:
+		save_run(args.history, current)
+
+	if baseline is not None:
+		if baseline.get("sandbox") != current["sandbox"]:
+			print "warning: comparing runs with and without the sandbox"
+		if compare(baseline, results, args.threshold):
+			sys.exit(1)
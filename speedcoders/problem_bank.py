@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+
+import logging
+import random
+import struct
+import threading
+import time
+
+try:
+	import mmap
+except ImportError:
+	# not in the App Engine sandbox, where banks are read instead
+	mmap = None
+
+import challenges
+import startup
+import word_generator
+
+# A problem bank file holds:
+#   header: magic, version, kind count, problem count, index offset
+#   kinds: for each kind, its name and the range of problem numbers
+#     holding problems of that kind
+#   problems: CodingProblem.dumps records, grouped by kind
+#   index: problem count + 1 file offsets, where problem n spans
+#     offsets n to n + 1
+BANK_MAGIC = "SCPB"
+BANK_VERSION = 1
+BANK_HEADER = struct.Struct("<4sHHIQ")
+BANK_KIND = struct.Struct("<16sII")
+BANK_OFFSET = struct.Struct("<Q")
+
+# The bank ProblemGenerators draw from by default, or None to generate
+# problems live. Loaded the first time a problem is drawn.
+PROBLEM_BANK_FILE = None
+
+_problem_bank = None
+_problem_bank_lock = threading.Lock()
+
+def get_problem_bank():
+	"""Returns the shared ProblemBank, or None if there is no bank file"""
+	global _problem_bank
+	if _problem_bank is None and PROBLEM_BANK_FILE is not None:
+		with _problem_bank_lock:
+			if _problem_bank is None:
+				start = time.time()
+				bank = ProblemBank(PROBLEM_BANK_FILE)
+				startup.record("problem_bank", time.time() - start)
+				_problem_bank = bank
+	return _problem_bank
+
+def unique_problems(problems, count, max_attempts=None):
+	"""Take problems with distinct statements from an iterator
+
+	Args:
+	  problems: An iterator of CodingProblems.
+	  count: An int. The number of problems wanted.
+	  max_attempts: An int. The most problems to draw before giving up
+	    on finding count distinct ones. [Default: 10 * count]
+
+	Returns: A generator of at most count CodingProblems.
+	"""
+	max_attempts = max_attempts or 10 * count
+	# hashes rather than statements keep millions of them in memory
+	seen = set()
+	found = 0
+	for attempts, problem in enumerate(problems):
+		if found == count or attempts == max_attempts:
+			break
+		key = hash(problem.statement)
+		if key in seen:
+			continue
+		seen.add(key)
+		found += 1
+		yield problem
+	if found < count:
+		logging.warning("Only found %d distinct problems of %d wanted", found, count)
+
+def build_bank(filename, generators, count, dedupe=True):
+	"""Generate problems into a problem bank file
+
+	Args:
+	  filename: A str. The file to write.
+	  generators: A list of problem generators with a KIND, such as
+	    challenges.AppendProblemGenerator().
+	  count: An int. The number of problems to generate of each kind.
+	  dedupe: A bool. Whether to drop problems whose statement was
+	    already generated. [Default: True]
+
+	Returns: A dict of kinds to the number of problems written.
+	"""
+	offsets = []
+	kinds = []
+	with open(filename, "wb") as bank:
+		# the header and kind table are rewritten once the counts are known
+		bank.write("\0" * (BANK_HEADER.size + BANK_KIND.size * len(generators)))
+		for problem_generator in generators:
+			first = len(offsets)
+			problems = iter(problem_generator)
+			if dedupe:
+				problems = unique_problems(problems, count)
+			for problem in problems:
+				if len(offsets) - first == count:
+					break
+				offsets.append(bank.tell())
+				bank.write(problem.dumps())
+			kinds.append((problem_generator.KIND, first, len(offsets) - first))
+
+		index_offset = bank.tell()
+		offsets.append(index_offset)
+		for offset in offsets:
+			bank.write(BANK_OFFSET.pack(offset))
+
+		bank.seek(0)
+		bank.write(BANK_HEADER.pack(BANK_MAGIC, BANK_VERSION, len(kinds), len(offsets) - 1, index_offset))
+		for kind in kinds:
+			bank.write(BANK_KIND.pack(*kind))
+	return dict((kind, kind_count) for kind, first, kind_count in kinds)
+
+
+class ProblemBank(object):
+	"""Random access to the problems in a problem bank file
+
+	Problems are read straight out of the file by their offset, so
+	drawing one costs the same however large the bank is.
+
+	Attrs:
+	  filename: A str. The bank file.
+	  kinds: A dict of kinds of problem to a tuple (first, count) of
+	    the problem numbers holding problems of that kind.
+	"""
+
+	def __init__(self, filename, use_mmap=True):
+		"""Initialize this ProblemBank
+
+		Args:
+		  filename: A str. A file written by build_bank.
+		  use_mmap: A bool. If True, the file is memory-mapped so that
+		    processes opening the same bank share its pages. Otherwise
+		    it is read into memory, as it is where mmap isn't
+		    available. [Default: True]
+
+		Throws: ValueError if the file is not a problem bank.
+		"""
+		self.filename = filename
+		with open(filename, "rb") as bank:
+			if use_mmap and mmap is not None:
+				self._data = mmap.mmap(bank.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				self._data = bank.read()
+
+		magic, version, kind_count, count, index_offset = BANK_HEADER.unpack_from(self._data, 0)
+		if magic != BANK_MAGIC or version != BANK_VERSION:
+			raise ValueError("{0} is not a version {1} problem bank.".format(filename, BANK_VERSION))
+
+		self.kinds = {}
+		for num in xrange(kind_count):
+			kind, first, kind_count = BANK_KIND.unpack_from(self._data, BANK_HEADER.size + num * BANK_KIND.size)
+			self.kinds[kind.rstrip("\0")] = (first, kind_count)
+		self._offsets = word_generator.MappedArray(self._data, index_offset, count + 1, "Q")
+		self._count = count
+
+	def __len__(self):
+		return self._count
+
+	def get(self, num):
+		"""Returns the CodingProblem with the given number"""
+		if num < 0 or num >= self._count:
+			raise IndexError(num)
+		return challenges.CodingProblem.loads(self._data[self._offsets[num]:self._offsets[num + 1]])
+
+	def draw(self, kinds=None, rng=random):
+		"""Returns a random CodingProblem
+
+		Each kind is equally likely to be drawn, like the problems
+		generated live by ProblemGenerator.
+
+		Args:
+		  kinds: A list of strs. The kinds of problem to draw from.
+		    [Default: every kind in the bank]
+		  rng: A random.Random to draw with. [Default: the random module]
+
+		Throws: ValueError if the bank has no problems of those kinds.
+		"""
+		ranges = [self.kinds[kind] for kind in sorted(kinds or self.kinds) if self.kinds.get(kind, (0, 0))[1]]
+		if not ranges:
+			raise ValueError("{0} has no problems of kinds {1}.".format(self.filename, kinds))
+		first, count = rng.choice(ranges)
+		return self.get(first + rng.randrange(count))
@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+
+import argparse
+
+import challenges
+from problem_bank import build_bank
+
+#Generate coding problems offline into a problem bank for ProblemGenerator to draw from
+
+GENERATORS = dict((problem_generator.KIND, problem_generator) for problem_generator in (
+	challenges.AppendProblemGenerator,
+	challenges.AdditionProblemGenerator,
+	challenges.SubstitutionProblemGenerator,
+))
+
+parser = argparse.ArgumentParser(description="Build a problem bank of pre-generated coding problems.")
+parser.add_argument("bank", help="the problem bank file to write")
+parser.add_argument("-n", "--count", type=int, default=100000,
+	help="problems to generate of each kind [default: 100000]")
+parser.add_argument("-k", "--kinds", default=",".join(sorted(GENERATORS)),
+	help="comma separated kinds of problem to generate [default: all of {0}]".format(", ".join(sorted(GENERATORS))))
+parser.add_argument("-w", "--word-model", default=challenges.WORD_MODEL_FILE,
+	help="the word model to generate names and strings with [default: {0}]".format(challenges.WORD_MODEL_FILE))
+parser.add_argument("--keep-duplicates", action="store_true",
+	help="keep problems whose statement was already generated")
+args = parser.parse_args()
+
+kinds = args.kinds.split(",")
+for kind in kinds:
+	if kind not in GENERATORS:
+		parser.error("unknown kind '{0}'".format(kind))
+
+challenges.WORD_MODEL_FILE = args.word_model
+counts = build_bank(args.bank, [GENERATORS[kind]() for kind in kinds], args.count, not args.keep_duplicates)
+for kind in kinds:
+	print "{0:>14}: {1} problems".format(kind, counts[kind])
@@ -0,0 +1,29 @@
+#! /usr/bin/env python
+
+import json
+import sys
+import time
+
+import game
+
+#Replay a recorded game several times, checking that every replay ends in the
+#same state and reporting how long each took. Record a game by creating its
+#table with "record": true and save /admin/tables/<table_id>/recording
+#usage: replay_benchmark.py recording.json [replays]
+
+if __name__ == "__main__":
+	with open(sys.argv[1]) as recording_file:
+		recording = json.load(recording_file)
+	replays = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+	actions = len(recording["actions"])
+	final = None
+	for num in xrange(replays):
+		start = time.time()
+		table = game.replay(recording)
+		elapsed = time.time() - start
+		state = table.to_json()
+		if final is not None and state != final:
+			sys.exit("replay {0} diverged:\n{1}\n{2}".format(num, final, state))
+		final = state
+		print "replay {0}: {1:8.3f}s {2:10.0f} actions/s".format(num, elapsed, actions / elapsed)
@@ -0,0 +1,34 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+import random
+
+# Seeded random streams. Every consumer of randomness that should be
+# reproducible takes a random.Random, and the streams for one seed are
+# derived from it by name, so that adding draws to one stream never
+# shifts the numbers drawn from another.
+
+def new_seed():
+	"""Returns a fresh random seed, an int"""
+	return int(os.urandom(8).encode("hex"), 16)
+
+def stream_seed(seed, name):
+	"""Returns the seed of the named stream derived from a seed
+
+	Args:
+	  seed: An int. The seed the stream is derived from.
+	  name: A str. The name of the stream, such as "tokens".
+	"""
+	return int(hashlib.sha1("{0}:{1}".format(seed, name)).hexdigest()[:16], 16)
+
+def stream(seed, name):
+	"""Returns a random.Random for the named stream of a seed
+
+	Args:
+	  seed: An int. The seed the stream is derived from.
+	  name: A str. The name of the stream. Use a different name for
+	    each purpose, and for each worker drawing in parallel, such
+	    as "problems" or "worker-3".
+	"""
+	return random.Random(stream_seed(seed, name))
@@ -0,0 +1,464 @@
+#! /usr/bin/env python
+
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# Solutions are run in a pool of pre-forked worker processes so that a
+# slow, looping or memory hungry submission can be killed without taking
+# the web server down with it. This isolates resource usage only; the
+# code is still exec'd with full python privileges. Where processes
+# can't be started, such as the App Engine standard runtime, solutions
+# run in process with no limits.
+ENABLED = True
+WORKERS = 4
+TIMEOUT = 2.0
+CPU_LIMIT = 1
+MEMORY_LIMIT = 256 * 1024 * 1024
+# compiled solutions kept per process, keyed by a hash of their source
+CODE_CACHE_SIZE = 256
+# the most bytes a worker may send back for one job
+MAX_RESULT_SIZE = 1024 * 1024
+# failed solutions are logged at most this many times a minute
+FAILURE_LOG_RATE = 10
+
+# the filename solutions are compiled with, to find them in tracebacks
+SOLUTION_FILENAME = "<solution>"
+
+# kinds of ExecutionResult errors
+SYNTAX_ERROR = "syntax"
+RUNTIME_ERROR = "runtime"
+TIMEOUT_ERROR = "timeout"
+RESOURCE_ERROR = "resources"
+ERROR_KINDS = (SYNTAX_ERROR, RUNTIME_ERROR, TIMEOUT_ERROR, RESOURCE_ERROR)
+
+_pool = None
+_pool_failed = False
+_pool_lock = threading.Lock()
+_code_cache = collections.OrderedDict()
+_code_cache_lock = threading.Lock()
+
+class ExecutionResult(object):
+	"""The outcome of running a solution against a set of test inputs
+
+	Attrs:
+	  outputs: A list. The value the solution returned for each test
+	    input that it was run against. Only kept when the solution
+	    runs in this process, since a worker's outputs are objects
+	    made by the solution and are checked where they are made.
+	  timings: A list of floats. The seconds each test input took.
+	  error: A str describing why the solution could not be run to
+	    completion, or None.
+	  error_kind: A str. One of SYNTAX_ERROR, RUNTIME_ERROR,
+	    TIMEOUT_ERROR or RESOURCE_ERROR
+	    if there was an error, otherwise None.
+	  error_line: An int. The line of the solution the error was
+	    raised from, if known.
+	  timed_out: A bool. Whether the solution was killed for running
+	    past its time limit.
+	  passed: A bool. Whether the outputs matched the expected outputs.
+	  failed_cases: A list of ints. The indexes of the test inputs
+	    whose outputs were wrong.
+	"""
+
+	def __init__(self, outputs=None, timings=None, error=None, timed_out=False, error_kind=None, error_line=None):
+		"""Initialize this ExecutionResult
+
+		Args:
+		  outputs: A list. The value returned for each test input.
+		    [Default: []]
+		  timings: A list of floats. The seconds each test input took.
+		    [Default: []]
+		  error: A str. Why the solution could not be run, if it
+		    couldn't. [Default: None]
+		  timed_out: A bool. Whether the solution ran past its time
+		    limit. [Default: False]
+		  error_kind: A str. The kind of error. [Default: None]
+		  error_line: An int. The line of the solution the error
+		    came from. [Default: None]
+		"""
+		self.outputs = outputs if outputs is not None else []
+		self.timings = timings if timings is not None else []
+		self.error = error
+		self.error_kind = error_kind
+		self.error_line = error_line
+		self.timed_out = timed_out
+		self.passed = False
+		self.failed_cases = []
+
+	def __nonzero__(self):
+		return self.passed
+
+	def to_dict(self):
+		"""Returns a json serializable summary of this result"""
+		return {
+			"passed": self.passed,
+			"failed_cases": self.failed_cases,
+			"timings": self.timings,
+			"error": self.error,
+			"error_kind": self.error_kind,
+			"error_line": self.error_line,
+			"timed_out": self.timed_out,
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		"""Returns the ExecutionResult summarized in a dict by to_dict
+
+		The dict comes from a worker the solution ran in, so every
+		field is checked to be a plain value of the right type.
+
+		Throws: ValueError if the dict is not one to_dict could have
+		  made.
+		"""
+		def check(ok, field):
+			if not ok:
+				raise ValueError("bad '{0}' in execution result".format(field))
+		number = (int, long, float)
+		check(isinstance(data, dict), "result")
+		check(isinstance(data.get("passed"), bool), "passed")
+		check(isinstance(data.get("timed_out"), bool), "timed_out")
+		check(isinstance(data.get("failed_cases"), list) and all(isinstance(idx, (int, long)) and not isinstance(idx, bool) for idx in data["failed_cases"]), "failed_cases")
+		check(isinstance(data.get("timings"), list) and all(isinstance(seconds, number) and not isinstance(seconds, bool) for seconds in data["timings"]), "timings")
+		check(data.get("error") is None or isinstance(data["error"], basestring), "error")
+		check(data.get("error_kind") is None or data["error_kind"] in ERROR_KINDS, "error_kind")
+		check(data.get("error_line") is None or isinstance(data["error_line"], (int, long)) and not isinstance(data["error_line"], bool), "error_line")
+		result = cls(timings=data["timings"], error=data["error"], timed_out=data["timed_out"], error_kind=data["error_kind"], error_line=data["error_line"])
+		result.passed = data["passed"] and result.error is None and not data["failed_cases"]
+		result.failed_cases = data["failed_cases"]
+		return result
+
+class RateLimitedLog(object):
+	"""Logs at most a fixed number of messages a minute
+
+	Messages over the limit are counted rather than logged, and the
+	count is reported with the next message that gets through.
+	"""
+
+	def __init__(self, per_minute):
+		self.per_minute = per_minute
+		self._window = 0
+		self._logged = 0
+		self._suppressed = 0
+		self._lock = threading.Lock()
+
+	def log(self, msg, *args):
+		"""Log a message at INFO level unless over the limit"""
+		window = int(time.time() // 60)
+		with self._lock:
+			if window != self._window:
+				self._window = window
+				self._logged = 0
+			if self._logged >= self.per_minute:
+				self._suppressed += 1
+				return
+			self._logged += 1
+			suppressed, self._suppressed = self._suppressed, 0
+		if suppressed:
+			msg += " ({0} more failures not logged)".format(suppressed)
+		logging.info(msg, *args)
+
+FAILURE_LOG = RateLimitedLog(FAILURE_LOG_RATE)
+
+def compile_solution(solution):
+	"""Compile a solution, reusing the result for source seen before
+
+	Both code objects and syntax errors are cached, so resubmitting
+	the same text never compiles it twice in one process.
+
+	Args:
+	  solution: A str. The user's python code.
+
+	Throws: SyntaxError, TypeError or ValueError if the solution
+	  can't be compiled.
+
+	Returns: A code object.
+	"""
+	source = solution.encode("utf-8") if isinstance(solution, unicode) else solution
+	key = hashlib.sha1(source).digest()
+	with _code_cache_lock:
+		compiled = _code_cache.pop(key, None)
+		if compiled is not None:
+			_code_cache[key] = compiled
+	if compiled is None:
+		try:
+			compiled = compile(solution, SOLUTION_FILENAME, "exec")
+		except (SyntaxError, TypeError, ValueError) as e:
+			compiled = e
+		with _code_cache_lock:
+			_code_cache[key] = compiled
+			if len(_code_cache) > CODE_CACHE_SIZE:
+				_code_cache.popitem(last=False)
+	if isinstance(compiled, Exception):
+		raise compiled
+	return compiled
+
+def syntax_error(error):
+	"""Returns an ExecutionResult for a solution that doesn't compile"""
+	if isinstance(error, SyntaxError):
+		return ExecutionResult(error="SyntaxError: {0}".format(error.msg), error_kind=SYNTAX_ERROR, error_line=error.lineno)
+	return ExecutionResult(error="{0}: {1}".format(type(error).__name__, error), error_kind=SYNTAX_ERROR)
+
+def runtime_error(outputs=None, timings=None):
+	"""Returns an ExecutionResult for the exception being handled
+
+	Only the exception itself and the line of the solution it came
+	from are kept, rather than the whole traceback.
+	"""
+	error_type, error, tb = sys.exc_info()
+	line = None
+	for filename, lineno, _, _ in traceback.extract_tb(tb):
+		if filename == SOLUTION_FILENAME:
+			line = lineno
+	message = traceback.format_exception_only(error_type, error)[-1].strip()
+	return ExecutionResult(outputs, timings, error=message, error_kind=RUNTIME_ERROR, error_line=line)
+
+def check_outputs(result, expected_outputs):
+	"""Set whether a result's outputs match the expected outputs"""
+	try:
+		result.failed_cases = [idx for idx, output in enumerate(result.outputs) if output != expected_outputs[idx]]
+	except Exception:
+		# an output that can't even be compared fails every case
+		result.failed_cases = range(len(expected_outputs))
+	result.passed = not result.failed_cases
+
+def run_solution(solution, func_name, inputs, expected_outputs):
+	"""Exec a solution and check the function it defines on each input
+
+	This is NOT a safe function and does no isolation of its own. See
+	execute.
+
+	Args:
+	  solution: A str. The user's python code.
+	  func_name: A str. The name of the function the code should define.
+	  inputs: A list. The values to call the function with.
+	  expected_outputs: A list. The values the function should return.
+
+	Returns: An ExecutionResult.
+	"""
+	try:
+		code = compile_solution(solution)
+	except (SyntaxError, TypeError, ValueError) as e:
+		return syntax_error(e)
+
+	namespace = {}
+	try:
+		exec code in namespace
+	except Exception:
+		return runtime_error()
+	if not callable(namespace.get(func_name)):
+		return ExecutionResult(error="Solution does not define a function called '{0}'.".format(func_name), error_kind=RUNTIME_ERROR)
+	func = namespace[func_name]
+
+	outputs = []
+	timings = []
+	for value in inputs:
+		start = time.time()
+		try:
+			output = func(value)
+		except Exception:
+			return runtime_error(outputs, timings)
+		timings.append(time.time() - start)
+		outputs.append(output)
+	result = ExecutionResult(outputs, timings)
+	check_outputs(result, expected_outputs)
+	return result
+
+def _limit_cpu(seconds):
+	"""Let this process use only the given cpu seconds from now on"""
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	soft = int(usage.ru_utime + usage.ru_stime) + seconds + 1
+	hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+	if hard != resource.RLIM_INFINITY:
+		soft = min(soft, hard)
+	resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def _worker_main(conn, cpu_limit, memory_limit):
+	"""Run jobs sent over a pipe until it is closed
+
+	Going over the cpu limit kills the worker with SIGXCPU and going
+	over the memory limit makes allocations fail, so a job that does
+	either never reports back and the pool replaces the worker.
+
+	Outputs are checked here and only the json of the result is sent
+	back, so nothing the solution made is ever unpickled by the parent.
+	"""
+	if resource is not None and memory_limit:
+		resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+	while True:
+		try:
+			solution, func_name, inputs, expected_outputs = conn.recv()
+		except EOFError:
+			return
+		if resource is not None and cpu_limit:
+			_limit_cpu(cpu_limit)
+		result = run_solution(solution, func_name, inputs, expected_outputs)
+		try:
+			data = json.dumps(result.to_dict())
+		except Exception:
+			data = json.dumps(ExecutionResult(timings=result.timings, error="Solution raised an error that can't be reported.", error_kind=RUNTIME_ERROR).to_dict())
+		conn.send_bytes(data)
+
+
+class SandboxWorker(object):
+	"""A worker process and the pipe used to send it jobs"""
+
+	def __init__(self, cpu_limit, memory_limit):
+		self.conn, child_conn = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=_worker_main, args=(child_conn, cpu_limit, memory_limit))
+		self.process.daemon = True
+		self.process.start()
+		child_conn.close()
+
+	def kill(self):
+		"""Stop this worker, whatever it is doing"""
+		self.conn.close()
+		if self.process.is_alive():
+			self.process.terminate()
+		self.process.join()
+
+
+class SandboxPool(object):
+	"""A pool of warm worker processes that run solutions
+
+	Attrs:
+	  size: An int. The number of worker processes.
+	  timeout: A float. The wall clock seconds a job may take.
+	  cpu_limit: An int. The cpu seconds a job may use.
+	  memory_limit: An int. The bytes of address space each worker
+	    may use.
+	"""
+
+	def __init__(self, size=WORKERS, timeout=TIMEOUT, cpu_limit=CPU_LIMIT, memory_limit=MEMORY_LIMIT):
+		"""Initialize this SandboxPool, starting all of its workers
+
+		Args:
+		  size: An int. The number of worker processes. [Default: WORKERS]
+		  timeout: A float. The wall clock seconds a job may take.
+		    [Default: TIMEOUT]
+		  cpu_limit: An int. The cpu seconds a job may use.
+		    [Default: CPU_LIMIT]
+		  memory_limit: An int. The bytes of address space each
+		    worker may use. [Default: MEMORY_LIMIT]
+		"""
+		self.size = size
+		self.timeout = timeout
+		self.cpu_limit = cpu_limit
+		self.memory_limit = memory_limit
+		self._idle = Queue.Queue()
+		for _ in xrange(size):
+			self._idle.put(self.spawn())
+
+	def spawn(self):
+		"""Start a new worker process"""
+		return SandboxWorker(self.cpu_limit, self.memory_limit)
+
+	def run(self, solution, func_name, inputs, expected_outputs):
+		"""Run and check a solution in a worker process
+
+		Blocks until a worker is free. A worker that times out, dies
+		or sends back something other than a result is replaced with
+		a fresh one.
+
+		Args:
+		  solution: A str. The user's python code.
+		  func_name: A str. The name of the function the code should define.
+		  inputs: A list. The values to call the function with.
+		  expected_outputs: A list. The values the function should return.
+
+		Returns: An ExecutionResult, without outputs.
+		"""
+		worker = self._idle.get()
+		try:
+			worker.conn.send((solution, func_name, inputs, expected_outputs))
+			if worker.conn.poll(self.timeout):
+				data = worker.conn.recv_bytes(MAX_RESULT_SIZE)
+				try:
+					result = ExecutionResult.from_dict(json.loads(data))
+				except ValueError:
+					result = ExecutionResult(error="Solution sent back a result that can't be read.", error_kind=RUNTIME_ERROR)
+				else:
+					self._idle.put(worker)
+					return result
+			else:
+				result = ExecutionResult(error="Solution took longer than {0} seconds.".format(self.timeout), timed_out=True, error_kind=TIMEOUT_ERROR)
+		except (EOFError, IOError):
+			result = ExecutionResult(error="Solution used too much cpu or memory.", timed_out=True, error_kind=RESOURCE_ERROR)
+		except:
+			self.replace(worker)
+			raise
+		self.replace(worker)
+		return result
+
+	def replace(self, worker):
+		"""Kill a worker and add a fresh one to the pool in its place"""
+		worker.kill()
+		self._idle.put(self.spawn())
+
+	def close(self):
+		"""Stop every idle worker"""
+		while True:
+			try:
+				self._idle.get_nowait().kill()
+			except Queue.Empty:
+				return
+
+def get_pool():
+	"""Returns the shared SandboxPool, starting it on first use
+
+	Returns None if the sandbox is disabled or its workers can't be
+	started here.
+	"""
+	global _pool, _pool_failed
+	if _pool is None and ENABLED and not _pool_failed:
+		with _pool_lock:
+			if _pool is None and not _pool_failed:
+				try:
+					_pool = SandboxPool(WORKERS, TIMEOUT, CPU_LIMIT, MEMORY_LIMIT)
+				except (OSError, NotImplementedError, AttributeError):
+					logging.exception("Can't start sandbox workers, running solutions in process.")
+					_pool_failed = True
+	return _pool
+
+def execute(solution, func_name, inputs, expected_outputs):
+	"""Run a solution against a set of test inputs and check its outputs
+
+	Uses the shared SandboxPool if one can be started and otherwise
+	runs the solution in this process. Solutions that don't compile
+	are rejected here without being sent to a worker. Failures are
+	logged through the rate limited FAILURE_LOG.
+
+	Args:
+	  solution: A str. The user's python code.
+	  func_name: A str. The name of the function the code should define.
+	  inputs: A list. The values to call the function with.
+	  expected_outputs: A list. The values the function should return.
+
+	Returns: An ExecutionResult. It is truthy if every output was the
+	  expected one.
+	"""
+	try:
+		compile_solution(solution)
+	except (SyntaxError, TypeError, ValueError) as e:
+		result = syntax_error(e)
+	else:
+		pool = get_pool()
+		if pool is None:
+			result = run_solution(solution, func_name, inputs, expected_outputs)
+		else:
+			result = pool.run(solution, func_name, inputs, expected_outputs)
+	if result.error is not None:
+		FAILURE_LOG.log("Solution for %s failed: %s (line %s)", func_name, result.error, result.error_line)
+	return result
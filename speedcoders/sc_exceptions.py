@@ -2,7 +2,7 @@
 class GameOverException(Exception):
 	def __init__(self, loser, msg):
 		self.loser = loser
-		super(self, GameOverException).__init__(msg)
+		super(GameOverException, self).__init__(msg)
 
 class IllegalStateException(Exception):
 	pass
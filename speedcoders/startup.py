@@ -0,0 +1,34 @@
+#! /usr/bin/env python
+
+import logging
+import time
+
+# Cold start timings for this instance. Import this module before any
+# other so that STARTED is as close to the start of the instance as
+# possible.
+STARTED = time.time()
+TIMINGS = {}
+
+def record(name, seconds):
+	"""Record how long a step of the cold start took
+
+	Args:
+	  name: A str. The name of the step, such as "word_model".
+	  seconds: A float. The time the step took.
+	"""
+	TIMINGS[name] = seconds
+	logging.info("startup: %s took %.3fs, %.3fs after instance start", name, seconds, time.time() - STARTED)
+
+def report():
+	"""Returns a dict of the recorded cold start timings
+
+	Besides each recorded step, includes the seconds since the
+	instance started and the share of the recorded time spent on
+	loading the word model.
+	"""
+	result = dict(TIMINGS)
+	result["uptime"] = time.time() - STARTED
+	total = sum(TIMINGS.itervalues())
+	if total and "word_model" in TIMINGS:
+		result["word_model_share"] = TIMINGS["word_model"] / total
+	return result
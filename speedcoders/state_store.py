@@ -0,0 +1,339 @@
+#! /usr/bin/env python
+
+import logging
+import marshal
+import threading
+import time
+
+try:
+	import sqlite3
+except ImportError:
+	# not in the App Engine sandbox, where only MemoryStore is used
+	sqlite3 = None
+
+# Table states are stored as marshalled dicts, see Table.to_state, next
+# to the table version they were saved at. A write only succeeds if the
+# stored version is still the one the writer last loaded or saved, so
+# two instances never silently overwrite each other's changes.
+#
+# Stores also keep which tables users can join, and a claim on the one
+# table each user is sitting at, so that every instance seats a user at
+# most once.
+
+class MemoryStore(object):
+	"""Keeps table states in a dict in this process
+
+	Only shares tables between the threads of one instance, but
+	behaves like the other stores, so it is used where there is no
+	store file and in tests.
+	"""
+
+	def __init__(self):
+		self._states = {}
+		self._joinable = set()
+		# user -> (table_id, claimed at)
+		self._seats = {}
+		self._lock = threading.Lock()
+
+	def get(self, table_id):
+		"""Returns a tuple (version, state) of a stored table, or None"""
+		with self._lock:
+			entry = self._states.get(table_id)
+		if entry is None:
+			return None
+		return entry[0], marshal.loads(entry[1])
+
+	def version(self, table_id):
+		"""Returns the stored version of a table, or None if not stored"""
+		with self._lock:
+			entry = self._states.get(table_id)
+		return entry[0] if entry else None
+
+	def put_many(self, writes):
+		"""Store a batch of table states
+
+		Args:
+		  writes: A list of tuples (table_id, expected_version,
+		    version, state, joinable). expected_version is the
+		    version the writer last loaded or saved, or None for a
+		    new table. joinable is whether users can sit down at it.
+
+		Returns: A set of the ids of the tables that were not written
+		  because their stored version was not the expected one.
+		"""
+		conflicts = set()
+		with self._lock:
+			for table_id, expected_version, version, state, joinable in writes:
+				entry = self._states.get(table_id)
+				if (entry[0] if entry else None) != expected_version:
+					conflicts.add(table_id)
+					continue
+				self._states[table_id] = (version, marshal.dumps(state))
+				if joinable:
+					self._joinable.add(table_id)
+				else:
+					self._joinable.discard(table_id)
+		return conflicts
+
+	def delete(self, table_id):
+		"""Remove a table, and the claims on seats at it, from the store"""
+		with self._lock:
+			self._states.pop(table_id, None)
+			self._joinable.discard(table_id)
+			for user, claim in self._seats.items():
+				if claim[0] == table_id:
+					del self._seats[user]
+
+	def joinable(self):
+		"""Returns a list of the ids of the stored tables users can join"""
+		with self._lock:
+			return list(self._joinable)
+
+	def seated(self, user):
+		"""Returns a tuple (table_id, claimed_at) of the table a user
+		claimed a seat at, or None"""
+		with self._lock:
+			return self._seats.get(user)
+
+	def claim_seat(self, user, table_id, replace=None):
+		"""Claim a seat at a table for a user
+
+		Args:
+		  user: A str. The user sitting down.
+		  table_id: A str. The table they are sitting at.
+		  replace: A str. The table of a stale claim to take over.
+		    [Default: None, to only claim if the user has no claim]
+
+		Returns: A bool. Whether the claim was made.
+		"""
+		with self._lock:
+			claim = self._seats.get(user)
+			if (claim[0] if claim else None) != replace:
+				return False
+			self._seats[user] = (table_id, time.time())
+			return True
+
+	def release_seat(self, user, table_id):
+		"""Drop a user's claim on a seat, if it is at the given table"""
+		with self._lock:
+			claim = self._seats.get(user)
+			if claim is not None and claim[0] == table_id:
+				del self._seats[user]
+
+
+class SqliteStore(object):
+	"""Keeps table states in a SQLite database file
+
+	Stands in for Datastore when running locally: every instance on
+	the machine opening the same file shares the same tables.
+	"""
+
+	def __init__(self, filename):
+		"""Initialize this SqliteStore
+
+		Args:
+		  filename: A str. The database file, created if missing.
+
+		Throws: ImportError if sqlite3 isn't available here.
+		"""
+		if sqlite3 is None:
+			raise ImportError("SqliteStore needs the sqlite3 module.")
+		self.filename = filename
+		self._db = sqlite3.connect(filename, check_same_thread=False)
+		self._lock = threading.Lock()
+		with self._lock:
+			self._db.execute("CREATE TABLE IF NOT EXISTS tables (table_id TEXT PRIMARY KEY, version INTEGER NOT NULL, state BLOB NOT NULL)")
+			self._db.execute("CREATE TABLE IF NOT EXISTS joinable (table_id TEXT PRIMARY KEY)")
+			self._db.execute("CREATE TABLE IF NOT EXISTS seats (user TEXT PRIMARY KEY, table_id TEXT NOT NULL, claimed_at REAL NOT NULL)")
+			self._db.execute("CREATE INDEX IF NOT EXISTS seats_by_table ON seats (table_id)")
+			self._db.commit()
+
+	def get(self, table_id):
+		"""Returns a tuple (version, state) of a stored table, or None"""
+		with self._lock:
+			row = self._db.execute("SELECT version, state FROM tables WHERE table_id = ?", (table_id,)).fetchone()
+		if row is None:
+			return None
+		return row[0], marshal.loads(str(row[1]))
+
+	def version(self, table_id):
+		"""Returns the stored version of a table, or None if not stored"""
+		with self._lock:
+			row = self._db.execute("SELECT version FROM tables WHERE table_id = ?", (table_id,)).fetchone()
+		return row[0] if row else None
+
+	def put_many(self, writes):
+		"""Store a batch of table states in one transaction
+
+		See MemoryStore.put_many.
+		"""
+		conflicts = set()
+		with self._lock:
+			with self._db:
+				for table_id, expected_version, version, state, joinable in writes:
+					blob = buffer(marshal.dumps(state))
+					if expected_version is None:
+						cursor = self._db.execute("INSERT OR IGNORE INTO tables (table_id, version, state) VALUES (?, ?, ?)",
+							(table_id, version, blob))
+					else:
+						cursor = self._db.execute("UPDATE tables SET version = ?, state = ? WHERE table_id = ? AND version = ?",
+							(version, blob, table_id, expected_version))
+					if cursor.rowcount != 1:
+						conflicts.add(table_id)
+					elif joinable:
+						self._db.execute("INSERT OR IGNORE INTO joinable (table_id) VALUES (?)", (table_id,))
+					else:
+						self._db.execute("DELETE FROM joinable WHERE table_id = ?", (table_id,))
+		return conflicts
+
+	def delete(self, table_id):
+		"""Remove a table, and the claims on seats at it, from the store"""
+		with self._lock:
+			with self._db:
+				self._db.execute("DELETE FROM tables WHERE table_id = ?", (table_id,))
+				self._db.execute("DELETE FROM joinable WHERE table_id = ?", (table_id,))
+				self._db.execute("DELETE FROM seats WHERE table_id = ?", (table_id,))
+
+	def joinable(self):
+		"""See MemoryStore.joinable"""
+		with self._lock:
+			return [row[0] for row in self._db.execute("SELECT table_id FROM joinable")]
+
+	def seated(self, user):
+		"""See MemoryStore.seated"""
+		with self._lock:
+			row = self._db.execute("SELECT table_id, claimed_at FROM seats WHERE user = ?", (user,)).fetchone()
+		return tuple(row) if row else None
+
+	def claim_seat(self, user, table_id, replace=None):
+		"""See MemoryStore.claim_seat"""
+		with self._lock:
+			with self._db:
+				if replace is None:
+					cursor = self._db.execute("INSERT OR IGNORE INTO seats (user, table_id, claimed_at) VALUES (?, ?, ?)",
+						(user, table_id, time.time()))
+				else:
+					cursor = self._db.execute("UPDATE seats SET table_id = ?, claimed_at = ? WHERE user = ? AND table_id = ?",
+						(table_id, time.time(), user, replace))
+				return cursor.rowcount == 1
+
+	def release_seat(self, user, table_id):
+		"""See MemoryStore.release_seat"""
+		with self._lock:
+			with self._db:
+				self._db.execute("DELETE FROM seats WHERE user = ? AND table_id = ?", (user, table_id))
+
+
+def open_store(filename=None):
+	"""Returns a SqliteStore for a file, or a MemoryStore if None"""
+	if filename is None:
+		return MemoryStore()
+	return SqliteStore(filename)
+
+
+class WriteBehind(object):
+	"""Saves changed tables to a store in batches from a background thread
+
+	Mutations only mark their table dirty, so they never wait on the
+	store. Every delay seconds the dirty tables are encoded and written
+	in one batch. If a table was changed by another instance since it
+	was loaded, the write is rejected and the table is marked stale so
+	that it is loaded again, dropping the local changes.
+
+	Attrs:
+	  store: A MemoryStore or SqliteStore.
+	  delay: A float. The most seconds a change waits to be written.
+	  writes: An int. The number of table states written.
+	  batches: An int. The number of batches written.
+	  conflicts: An int. The number of writes rejected.
+	"""
+
+	def __init__(self, store, delay=0.5):
+		"""Initialize this WriteBehind
+
+		Args:
+		  store: A MemoryStore or SqliteStore.
+		  delay: A float. The seconds between batches. [Default: 0.5]
+		"""
+		self.store = store
+		self.delay = delay
+		self.writes = 0
+		self.batches = 0
+		self.conflicts = 0
+		self._dirty = {}
+		# tables handed to the store but not yet marked as saved
+		self._in_flight = {}
+		self._lock = threading.Lock()
+		self._worker = None
+
+	def mark(self, table_id, table):
+		"""Queue a table to be saved with the next batch"""
+		with self._lock:
+			self._dirty[table_id] = table
+			if self._worker is None:
+				self._worker = threading.Thread(target=self._run, name="WriteBehind")
+				self._worker.daemon = True
+				self._worker.start()
+
+	def pending(self, table_id):
+		"""Returns the Table with the given id if it has changes waiting
+		to be saved, or being saved, otherwise None"""
+		with self._lock:
+			return self._dirty.get(table_id) or self._in_flight.get(table_id)
+
+	def forget(self, table_id):
+		"""Drop any changes to a table waiting to be saved"""
+		with self._lock:
+			self._dirty.pop(table_id, None)
+
+	def flush(self):
+		"""Save every dirty table now
+
+		Returns: A set of the ids of the tables whose writes conflicted.
+		"""
+		with self._lock:
+			dirty, self._dirty = self._dirty, {}
+			# still pending until stored_version is updated, so readers
+			# don't mistake the newly stored version for a remote change
+			self._in_flight.update(dirty)
+		if not dirty:
+			return set()
+
+		try:
+			writes = []
+			for table_id, table in dirty.iteritems():
+				with table.lock.hold("to_state"):
+					writes.append((table_id, table.stored_version, table.version, table.to_state(), table.joinable()))
+			try:
+				conflicts = self.store.put_many(writes)
+			except Exception:
+				# keep the tables for the next batch, unless changed again since
+				with self._lock:
+					for table_id, table in dirty.iteritems():
+						self._dirty.setdefault(table_id, table)
+				raise
+
+			for table_id, expected_version, version, state, joinable in writes:
+				table = dirty[table_id]
+				if table_id in conflicts:
+					logging.warning("Table %s changed elsewhere, dropping local changes", table_id)
+					table.stale = True
+				else:
+					table.stored_version = version
+		finally:
+			with self._lock:
+				for table_id, table in dirty.iteritems():
+					if self._in_flight.get(table_id) is table:
+						del self._in_flight[table_id]
+		self.writes += len(writes) - len(conflicts)
+		self.batches += 1
+		self.conflicts += len(conflicts)
+		return conflicts
+
+	def _run(self):
+		while True:
+			time.sleep(self.delay)
+			try:
+				self.flush()
+			except Exception:
+				logging.exception("Failed to save tables")
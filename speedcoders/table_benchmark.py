@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+
+import sys
+import time
+
+import game
+
+#Time seat lookups and seating at tables of increasing size, comparing the
+#seat index with the linear scan it replaced
+#usage: table_benchmark.py [max seats] [lookups]
+
+def linear_get_seat(table, user):
+	"""The original get_seat, scanning every seat"""
+	for seat in table.table:
+		if seat.user == user:
+			return seat
+	return None
+
+def linear_full(table):
+	"""The original intent of full, checking every seat"""
+	return all(not seat.empty() for seat in table.table)
+
+def per_call(func, count):
+	start = time.time()
+	for _ in xrange(count):
+		func()
+	return (time.time() - start) / count * 1e6
+
+if __name__ == "__main__":
+	max_seats = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+	print "{0:>6} {1:>12} {2:>12} {3:>12} {4:>12} {5:>12}".format(
+		"seats", "scan us", "index us", "scan full", "index full", "fill ms")
+	seats = 4
+	while seats <= max_seats:
+		table = game.Table(seats=seats, tokens=1)
+		start = time.time()
+		for num in xrange(seats):
+			table.add_user("user{0}".format(num))
+		fill = (time.time() - start) * 1000
+		last = "user{0}".format(seats - 1)
+		print "{0:6d} {1:12.3f} {2:12.3f} {3:12.3f} {4:12.3f} {5:12.3f}".format(seats,
+			per_call(lambda: linear_get_seat(table, last), count),
+			per_call(lambda: table.get_seat(last), count),
+			per_call(lambda: linear_full(table), count),
+			per_call(table.full, count),
+			fill)
+		seats *= 4
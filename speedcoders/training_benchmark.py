@@ -0,0 +1,33 @@
+#! /usr/bin/env python
+
+import multiprocessing
+import sys
+import time
+
+import word_generator
+
+#Time counting ngrams of a corpus with an increasing number of processes
+#usage: training_benchmark.py corpus [ngram sizes] [max processes]
+
+if __name__ == "__main__":
+	corpus = sys.argv[1]
+	sizes = [int(size) for size in sys.argv[2].split(",")] if len(sys.argv) > 2 else [3]
+	max_processes = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+
+	start = time.time()
+	serial = [word_generator.NGramCounts(size) for size in sizes]
+	for chunk in word_generator.read_chunks(corpus):
+		for counts in serial:
+			counts.ingest(chunk)
+	baseline = time.time() - start
+	print "serial:      {0:8.2f}s".format(baseline)
+
+	processes = 1
+	while processes <= max_processes:
+		start = time.time()
+		models = word_generator.parallel_counts([corpus], sizes, processes)
+		elapsed = time.time() - start
+		same = all(model.counts() == counts.counts() for model, counts in zip(models, serial))
+		print "{0:3d} processes: {1:8.2f}s {2:6.2f}x{3}".format(processes, elapsed, baseline / elapsed,
+			"" if same else " MISMATCH")
+		processes *= 2
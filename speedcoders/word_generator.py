@@ -1,9 +1,38 @@
 #!/usr/bin/env python
+import array
+import bisect
 import cPickle
+import multiprocessing
+import os
 import random
 import string
+import struct
+import sys
+from collections import defaultdict
 from itertools import tee, izip
 
+try:
+	import mmap
+except ImportError:
+	# not in the App Engine sandbox, where models are read instead
+	mmap = None
+
+# compact model file layout, all little endian:
+#   header: magic, version, ngram_size, word_count, ngram_count
+#   keys: ngram_count sorted ngrams of ngram_size bytes each
+#   first counts: ngram_count cumulative uint32 word start counts
+#   next counts: ngram_count rows of 27 cumulative uint32 follow counts,
+#     the last column being the end of word
+#   next ids: ngram_count rows of 26 int32 ngram ids reached by
+#     appending each letter, or -1 if that letter never follows
+COMPACT_MAGIC = "SCWG"
+COMPACT_VERSION = 1
+COMPACT_HEADER = struct.Struct("<4sHHII")
+NATIVE_LITTLE_ENDIAN = sys.byteorder == "little"
+# generate_words gives up after this many words in a row fall outside
+# the length range, since the model may never produce one in range
+MAX_MISSES = 10000
+
 def window(iterable, size):
 	"""Return a sliding window iterator over the given iterable
 
@@ -23,6 +52,59 @@ def window(iterable, size):
 			next(each, None)
 	return izip(*iters)
 
+def alias_table(weights):
+	"""Build a Walker/Vose alias table for a discrete distribution
+
+	The returned table allows drawing an index with probability
+	proportional to its weight in constant time, independent of
+	the number of weights. See alias_sample.
+
+	Args:
+	  weights: A list of non-negative numbers. At least one weight
+	    must be positive.
+
+	Returns: A tuple (probs, aliases) of two lists the same length
+	  as weights. probs holds the chance of keeping each column and
+	  aliases holds the index to use otherwise.
+	"""
+	size = len(weights)
+	total = float(sum(weights))
+	scaled = [weight * size / total for weight in weights]
+	probs = [0.0] * size
+	aliases = range(size)
+	small = [idx for idx, prob in enumerate(scaled) if prob < 1.0]
+	large = [idx for idx, prob in enumerate(scaled) if prob >= 1.0]
+	while small and large:
+		less = small.pop()
+		more = large.pop()
+		probs[less] = scaled[less]
+		aliases[less] = more
+		scaled[more] = (scaled[more] + scaled[less]) - 1.0
+		if scaled[more] < 1.0:
+			small.append(more)
+		else:
+			large.append(more)
+	# anything left over is only off from 1.0 by rounding error
+	for idx in large + small:
+		probs[idx] = 1.0
+	return probs, aliases
+
+def alias_sample(probs, aliases, rng=random):
+	"""Draw a random index from an alias table
+
+	Args:
+	  probs: A list of floats. The first list returned by alias_table.
+	  aliases: A list of ints. The second list returned by alias_table.
+	  rng: A random.Random to draw with. [Default: the random module]
+
+	Returns: An int. The sampled index.
+	"""
+	val = rng.random() * len(probs)
+	idx = int(val)
+	if val - idx < probs[idx]:
+		return idx
+	return aliases[idx]
+
 class NGram(object):
 	"""An ngram
 
@@ -47,6 +129,9 @@ class NGram(object):
 	    of integers representing the running count of how many
 	    times each letter has followed this ngram in the source
 	    corpus.
+	  alias_probs, aliases: Lists. The alias table built from
+	    next_letter_probs by build_sampling_index. None until the
+	    probabilities are finalized.
 	"""
 	END_OF_WORD = 26
 
@@ -60,6 +145,8 @@ class NGram(object):
 		self.count = 0
 		self.first_prob = 0
 		self.next_letter_probs = [0] * 27
+		self.alias_probs = None
+		self.aliases = None
 
 	def finalize_probabilities(self, word_count):
 		"""Convert running counts into probabilities
@@ -73,19 +160,23 @@ class NGram(object):
 		self.first_prob = float(self.first_prob) / word_count
 		for idx, letter_count in enumerate(self.next_letter_probs):
 			self.next_letter_probs[idx] = float(letter_count) / self.count
+		self.build_sampling_index()
+
+	def build_sampling_index(self):
+		"""Build the alias table used by generate_letter"""
+		self.alias_probs, self.aliases = alias_table(self.next_letter_probs)
 
-	def generate_letter(self):
+	def generate_letter(self, rng=random):
 		"""Generate the next letter
 
 		Generates a letter that follows this ngram using the
-		next_letter_probs calculated during ingest.
-		"""
-		val = random.random()
-		sum_so_far = 0.0
-		idx = -1
-		while sum_so_far < val:
-			idx += 1
-			sum_so_far += self.next_letter_probs[idx]
+		alias table built from next_letter_probs. Returns None
+		if the word should end after this ngram.
+
+		Args:
+		  rng: A random.Random to draw with. [Default: the random module]
+		"""
+		idx = alias_sample(self.alias_probs, self.aliases, rng)
 		if idx == self.END_OF_WORD:
 			return None
 		return string.ascii_lowercase[idx]
@@ -107,6 +198,9 @@ class WordGenerator(object):
 	  ngram_size: An int. The size of the ngrams that will be
 	    considered when ingesting words. A larger ngram size
 	    will require more memory but produce better results.
+	  first_ngrams: A list of strs. The ngrams that can start a
+	    word, in the order used by the first ngram alias table.
+	    None until the probabilities are finalized.
 	"""
 
 	def __init__(self, word_list, ngram_size=2):
@@ -122,6 +216,9 @@ class WordGenerator(object):
 		self.probs = {}
 		self.word_count = 0
 		self.ngram_size = ngram_size
+		self.first_ngrams = None
+		self.first_alias_probs = None
+		self.first_aliases = None
 		for word in word_list:
 			self.ingest_word(word)
 
@@ -139,7 +236,8 @@ class WordGenerator(object):
 			return
 		self.word_count += 1
 		last_ngram = None
-		for ngram in ("".join(chars) for chars in window(word, self.ngram_size)):
+		for idx in xrange(len(word) - self.ngram_size + 1):
+			ngram = word[idx:idx + self.ngram_size]
 			if ngram not in self.probs:
 				self.probs[ngram] = NGram(ngram)
 
@@ -164,37 +262,653 @@ class WordGenerator(object):
 		"""
 		for ngram in self.probs:
 			self.probs[ngram].finalize_probabilities(self.word_count)
+		self.build_first_index()
+
+	def build_first_index(self):
+		"""Build the alias table used by generate_first_ngram
+
+		Only ngrams that actually start a word are included, so the
+		table is usually much smaller than probs.
+		"""
+		starts = [ngram for ngram in self.probs.itervalues() if ngram.first_prob > 0]
+		self.first_ngrams = [ngram.ngram for ngram in starts]
+		self.first_alias_probs, self.first_aliases = alias_table([ngram.first_prob for ngram in starts])
+
+	def build_sampling_index(self):
+		"""Build every alias table from already finalized probabilities
+
+		Generators pickled before alias tables existed only carry the
+		finalized probabilities, so this is run on them after loading.
+		"""
+		for ngram in self.probs.itervalues():
+			ngram.build_sampling_index()
+		self.build_first_index()
 
-	def generate_first_ngram(self):
+	def generate_first_ngram(self, rng=random):
 		"""Generate the first ngram of a random word
 
-		Uses the first_prob attrs from the ngrams in probs to randomly
-		pick the first ngram of a random word.
+		Uses the alias table built from the first_prob attrs of the
+		ngrams in probs to randomly pick the first ngram of a random
+		word in constant time.
+
+		Args:
+		  rng: A random.Random to draw with. [Default: the random module]
 		"""
-		val = random.random()
-		sum_so_far = 0.0
-		ngram_iter = self.probs.itervalues()
-		while sum_so_far < val:
-			ngram = next(ngram_iter)
-			sum_so_far += ngram.first_prob
-		return ngram.ngram
+		return self.first_ngrams[alias_sample(self.first_alias_probs, self.first_aliases, rng)]
 
-	def generate_word(self):
+	def generate_word(self, max_len=None, rng=random):
 		"""Generate a random word
 
 		Generates a random word that 'looks like' the words ingested
-		from the source corpus.
+		from the source corpus. Each letter costs one alias table
+		draw, so the time taken is proportional to the word length.
+
+		Args:
+		  max_len: An int. If given, generation stops as soon as the
+		    word grows past this length and None is returned.
+		    [Default: None]
+		  rng: A random.Random to draw with. [Default: the random module]
 		"""
-		word = self.generate_first_ngram()
-		idx = 0
-		next_letter = self.probs[word[idx:idx+self.ngram_size]].generate_letter()
+		probs = self.probs
+		ngram = self.generate_first_ngram(rng)
+		letters = [ngram]
+		length = len(ngram)
+		next_letter = probs[ngram].generate_letter(rng)
 		while next_letter:
-			word += next_letter
-			idx += 1
-			next_letter = self.probs[word[idx:idx+self.ngram_size]].generate_letter()
-		return word
+			length += 1
+			if max_len is not None and length > max_len:
+				return None
+			letters.append(next_letter)
+			ngram = ngram[1:] + next_letter
+			next_letter = probs[ngram].generate_letter(rng)
+		return "".join(letters)
+
+	def generate_words(self, n, min_len=None, max_len=None, rng=random):
+		"""Generate a batch of random words
+
+		See generate_words.
+		"""
+		return generate_words(self, n, min_len, max_len, rng)
+
+class MappedArray(object):
+	"""A read-only array of fixed size records over a buffer
+
+	Reads little endian values straight out of a str or mmap
+	without copying the whole section, so a memory-mapped model
+	is only paged in where it is sampled.
+
+	Attrs:
+	  buf: A str or mmap. The buffer holding the records.
+	  offset: An int. The byte offset of the first record.
+	  length: An int. The number of records.
+	  fmt: A struct.Struct. The little endian format of one record.
+	"""
+
+	def __init__(self, buf, offset, length, typecode):
+		"""Initialize this MappedArray
+
+		Args:
+		  buf: A str or mmap. The buffer holding the records.
+		  offset: An int. The byte offset of the first record.
+		  length: An int. The number of records.
+		  typecode: A str. The struct format of one record, such as "I".
+		"""
+		self.buf = buf
+		self.offset = offset
+		self.length = length
+		self.fmt = struct.Struct("<" + typecode)
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, idx):
+		if idx < 0:
+			idx += self.length
+		if idx < 0 or idx >= self.length:
+			raise IndexError(idx)
+		return self.fmt.unpack_from(self.buf, self.offset + idx * self.fmt.size)[0]
+
+
+class CompactWordGenerator(object):
+	"""Generates random words from a compact array-backed model
+
+	Holds the same information as a finalized WordGenerator, but as
+	a handful of flat tables indexed by ngram id rather than a dict
+	of NGram objects. Ngrams are numbered by their position in the
+	sorted key table. Probabilities are kept as cumulative integer
+	counts so that a letter is picked by bisecting a single row.
+
+	Attrs:
+	  ngram_size: An int. The size of the ngrams in the model.
+	  word_count: An int. The total number of words ingested.
+	  keys: A MappedArray of strs. The ngram for each ngram id.
+	  first_counts: A sequence of ints. The cumulative number of
+	    words started by each ngram id.
+	  next_counts: A sequence of ints. For each ngram id, a row of
+	    27 cumulative counts of the letters and end of word following
+	    that ngram.
+	  next_ids: A sequence of ints. For each ngram id, a row of 26
+	    ngram ids reached by appending each letter to that ngram.
+	"""
+
+	def __init__(self, ngram_size, word_count, keys, first_counts, next_counts, next_ids):
+		"""Initialize this CompactWordGenerator
+
+		Args:
+		  ngram_size: An int. The size of the ngrams in the model.
+		  word_count: An int. The total number of words ingested.
+		  keys: A MappedArray of strs. The ngram for each ngram id.
+		  first_counts: A sequence of ints. See class attrs.
+		  next_counts: A sequence of ints. See class attrs.
+		  next_ids: A sequence of ints. See class attrs.
+		"""
+		self.ngram_size = ngram_size
+		self.word_count = word_count
+		self.keys = keys
+		self.first_counts = first_counts
+		self.next_counts = next_counts
+		self.next_ids = next_ids
+
+	def __len__(self):
+		return len(self.keys)
+
+	def ngram_id(self, ngram):
+		"""Returns the id of the given ngram or None if it is unknown"""
+		idx = bisect.bisect_left(self.keys, ngram)
+		if idx < len(self.keys) and self.keys[idx] == ngram:
+			return idx
+		return None
+
+	def generate_first_id(self, rng=random):
+		"""Generate the id of the first ngram of a random word"""
+		first_counts = self.first_counts
+		return bisect.bisect_right(first_counts, int(rng.random() * first_counts[-1]))
+
+	def generate_word(self, max_len=None, rng=random):
+		"""Generate a random word
+
+		Generates a random word that 'looks like' the words ingested
+		from the source corpus.
+
+		Args:
+		  max_len: An int. If given, generation stops as soon as the
+		    word grows past this length and None is returned.
+		    [Default: None]
+		  rng: A random.Random to draw with. [Default: the random module]
+		"""
+		next_counts = self.next_counts
+		next_ids = self.next_ids
+		letters_table = string.ascii_lowercase
+		rand = rng.random
+		ngram_id = self.generate_first_id(rng)
+		letters = [self.keys[ngram_id]]
+		length = self.ngram_size
+		while True:
+			# rows are cumulative from zero, so bisect within the row in place
+			row = ngram_id * 27
+			idx = bisect.bisect_right(next_counts, int(rand() * next_counts[row + 26]), row, row + 27) - row
+			if idx == NGram.END_OF_WORD:
+				return "".join(letters)
+			length += 1
+			if max_len is not None and length > max_len:
+				return None
+			letters.append(letters_table[idx])
+			ngram_id = next_ids[ngram_id * 26 + idx]
+
+	def generate_words(self, n, min_len=None, max_len=None, rng=random):
+		"""Generate a batch of random words
+
+		See generate_words.
+		"""
+		return generate_words(self, n, min_len, max_len, rng)
+
+
+def generate_words(generator, n, min_len=None, max_len=None, rng=random):
+	"""Generate a batch of random words within a length range
+
+	Words longer than max_len are abandoned as soon as they grow past
+	it rather than generated in full, and words shorter than min_len
+	are drawn again, up to MAX_MISSES times in a row.
+
+	Args:
+	  generator: A WordGenerator or CompactWordGenerator.
+	  n: An int. The number of words to generate.
+	  min_len: An int. The shortest acceptable word. [Default: None]
+	  max_len: An int. The longest acceptable word. [Default: None]
+	  rng: A random.Random to draw with, so that a seeded generator
+	    produces the same words every time. [Default: the random
+	    module]
+
+	Throws: ValueError if no word can fall within the length range, or
+	  MAX_MISSES words in a row fell outside it.
+
+	Returns: A list of n strs.
+	"""
+	if max_len is not None and (max_len < generator.ngram_size or max_len < (min_len or 0)):
+		raise ValueError("No words of length {0} to {1} with ngrams of size {2}.".format(min_len, max_len, generator.ngram_size))
+	generate_word = generator.generate_word
+	words = []
+	append = words.append
+	misses = 0
+	while len(words) < n:
+		word = generate_word(max_len, rng)
+		if word is not None and (min_len is None or len(word) >= min_len):
+			append(word)
+			misses = 0
+			continue
+		misses += 1
+		if misses == MAX_MISSES:
+			raise ValueError("Gave up on words of length {0} to {1} after {2} misses in a row.".format(min_len, max_len, misses))
+	return words
+
+def compact_counts(generator):
+	"""Recover the integer counts held by a word generator
+
+	Works on WordGenerators both before and after their probabilities
+	have been finalized, and on CompactWordGenerators.
+
+	Args:
+	  generator: A WordGenerator or CompactWordGenerator.
+
+	Returns: A tuple (ngrams, first_counts, next_counts) of a sorted
+	  list of ngram strs, a list of the word start count of each
+	  ngram and a list of each ngram's 27 follow counts.
+	"""
+	if isinstance(generator, CompactWordGenerator):
+		ngrams = [generator.keys[idx] for idx in xrange(len(generator))]
+		first_counts = differences(generator.first_counts[idx] for idx in xrange(len(generator)))
+		next_counts = [differences(generator.next_counts[idx] for idx in xrange(row * 27, row * 27 + 27))
+			for row in xrange(len(generator))]
+		return ngrams, first_counts, next_counts
+
+	finalized = generator.first_ngrams is not None
+	ngrams = sorted(generator.probs)
+	first_counts = []
+	next_counts = []
+	for key in ngrams:
+		ngram = generator.probs[key]
+		if finalized:
+			first_counts.append(int(round(ngram.first_prob * generator.word_count)))
+			next_counts.append([int(round(prob * ngram.count)) for prob in ngram.next_letter_probs])
+		else:
+			first_counts.append(ngram.first_prob)
+			next_counts.append(list(ngram.next_letter_probs))
+	return ngrams, first_counts, next_counts
+
+def cumulative(counts):
+	"""Returns the running totals of the given counts"""
+	total = 0
+	totals = []
+	for count in counts:
+		total += count
+		totals.append(total)
+	return totals
+
+def differences(totals):
+	"""Returns the counts whose running totals are given"""
+	last = 0
+	counts = []
+	for total in totals:
+		counts.append(total - last)
+		last = total
+	return counts
+
+def compact_tables(ngrams, first_counts, next_counts):
+	"""Build the tables of a compact model from counts
+
+	Args:
+	  ngrams: A sorted list of strs. Every ngram in the model.
+	  first_counts: A list of ints. The word start count of each ngram.
+	  next_counts: A list of lists of 27 ints. The follow counts of
+	    each ngram.
 
-def load(filename):
-	"""Load a pickled version of a WordGenerator"""
-	return cPickle.load(open(filename, "rb"))
+	Returns: A tuple (keys, first_table, next_table, next_ids) of the
+	  concatenated ngrams and the three arrays described by
+	  COMPACT_HEADER, in native byte order.
+	"""
+	ids = dict((ngram, idx) for idx, ngram in enumerate(ngrams))
+	next_ids = array.array("i")
+	for ngram, row in zip(ngrams, next_counts):
+		for idx, letter in enumerate(string.ascii_lowercase):
+			next_ids.append(ids[ngram[1:] + letter] if row[idx] else -1)
+
+	first_table = array.array("I", cumulative(first_counts))
+	next_table = array.array("I")
+	for row in next_counts:
+		next_table.extend(cumulative(row))
+	return "".join(ngrams), first_table, next_table, next_ids
+
+def write_compact(filename, ngram_size, word_count, ngrams, first_counts, next_counts):
+	"""Write counts to a compact model file
+
+	See the layout described by COMPACT_HEADER. The file can be read
+	back with load_compact.
+
+	Args:
+	  filename: A str. The file to write.
+	  ngram_size: An int. The size of the ngrams.
+	  word_count: An int. The total number of words counted.
+	  ngrams, first_counts, next_counts: See compact_tables.
+	"""
+	keys, first_table, next_table, next_ids = compact_tables(ngrams, first_counts, next_counts)
+	with open(filename, "wb") as out:
+		out.write(COMPACT_HEADER.pack(COMPACT_MAGIC, COMPACT_VERSION,
+			ngram_size, word_count, len(ngrams)))
+		out.write(keys)
+		for table in (first_table, next_table, next_ids):
+			if not NATIVE_LITTLE_ENDIAN:
+				table.byteswap()
+			out.write(table.tostring())
+
+def save_compact(generator, filename):
+	"""Write a word generator to a compact model file
+
+	Args:
+	  generator: A WordGenerator or CompactWordGenerator.
+	  filename: A str. The file to write.
+	"""
+	write_compact(filename, generator.ngram_size, generator.word_count, *compact_counts(generator))
+
+def read_table(data, offset, length, typecode):
+	"""Copy a little endian table out of a str into an array"""
+	table = array.array(typecode)
+	table.fromstring(data[offset:offset + length * table.itemsize])
+	if not NATIVE_LITTLE_ENDIAN:
+		table.byteswap()
+	return table
+
+def load_compact(filename, use_mmap=False):
+	"""Load a CompactWordGenerator from a compact model file
+
+	Args:
+	  filename: A str. A file written by save_compact.
+	  use_mmap: A bool. If True, the file is memory-mapped and sampled
+	    in place, so processes loading the same file share its pages.
+	    Otherwise the tables are read into arrays. Ignored where
+	    mmap isn't available. [Default: False]
+
+	Throws: ValueError if the file is not a compact model.
+	"""
+	use_mmap = use_mmap and mmap is not None
+	with open(filename, "rb") as model:
+		if use_mmap:
+			data = mmap.mmap(model.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			data = model.read()
+
+	magic, version, ngram_size, word_count, count = COMPACT_HEADER.unpack_from(data, 0)
+	if magic != COMPACT_MAGIC or version != COMPACT_VERSION:
+		raise ValueError("{0} is not a version {1} compact word model.".format(filename, COMPACT_VERSION))
+
+	keys_offset = COMPACT_HEADER.size
+	first_offset = keys_offset + count * ngram_size
+	next_offset = first_offset + count * 4
+	ids_offset = next_offset + count * 27 * 4
+
+	keys = MappedArray(data, keys_offset, count, "{0}s".format(ngram_size))
+	if use_mmap:
+		first_counts = MappedArray(data, first_offset, count, "I")
+		next_counts = MappedArray(data, next_offset, count * 27, "I")
+		next_ids = MappedArray(data, ids_offset, count * 26, "i")
+	else:
+		first_counts = read_table(data, first_offset, count, "I")
+		next_counts = read_table(data, next_offset, count * 27, "I")
+		next_ids = read_table(data, ids_offset, count * 26, "i")
+	return CompactWordGenerator(ngram_size, word_count, keys, first_counts, next_counts, next_ids)
+
+def load(filename, use_mmap=False):
+	"""Load a word generator from disk
+
+	Compact model files are loaded as CompactWordGenerators and
+	anything else is unpickled as a WordGenerator. Generators
+	pickled without alias tables get them built here.
+
+	Args:
+	  filename: A str. A compact model file or a pickled WordGenerator.
+	  use_mmap: A bool. Whether to memory-map a compact model file.
+	    Ignored for pickles. [Default: False]
+	"""
+	with open(filename, "rb") as model:
+		magic = model.read(len(COMPACT_MAGIC))
+	if magic == COMPACT_MAGIC:
+		return load_compact(filename, use_mmap)
+
+	generator = cPickle.load(open(filename, "rb"))
+	if getattr(generator, "first_ngrams", None) is None:
+		generator.build_sampling_index()
+	return generator
+
+
+def read_chunks_from(words, chunk_size=10000):
+	"""Group an iterable of words into lists of chunk_size words"""
+	chunk = []
+	for word in words:
+		chunk.append(word)
+		if len(chunk) == chunk_size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def read_chunks(filename, chunk_size=10000):
+	"""Stream the words of a corpus file in chunks
+
+	Args:
+	  filename: A str. A file with one word per line.
+	  chunk_size: An int. The number of words in each chunk.
+	    [Default: 10000]
+
+	Returns: An iterator of lists of stripped words.
+	"""
+	with open(filename) as corpus:
+		for chunk in read_chunks_from((line.strip() for line in corpus), chunk_size):
+			yield chunk
+
+
+class NGramCounts(object):
+	"""Running ngram counts for building a compact word model
+
+	A lighter weight alternative to ingesting into a WordGenerator.
+	Each ngram and the character following it are counted together
+	as a single (ngram_size + 1) character key of a flat dict, so no
+	per-ngram objects are built. Counts from several corpora, chunks
+	or processes can be merged, and counts can be seeded from an
+	existing model to update it without retraining from scratch.
+
+	Attrs:
+	  ngram_size: An int. The size of the ngrams counted.
+	  word_count: An int. The total number of words counted.
+	  first: A dict mapping ngram strs to the number of words they
+	    start.
+	  follows: A dict mapping each ngram followed by a letter or
+	    END_MARKER to the number of times that was seen.
+	"""
+	END_MARKER = "$"
+	FOLLOW_INDEX = dict((char, idx) for idx, char in enumerate(string.ascii_lowercase + END_MARKER))
+
+	def __init__(self, ngram_size):
+		"""Initialize this NGramCounts
+
+		Args:
+		  ngram_size: An int. The size of the ngrams to count.
+		"""
+		self.ngram_size = ngram_size
+		self.word_count = 0
+		self.first = defaultdict(int)
+		self.follows = defaultdict(int)
+
+	def ingest(self, words):
+		"""Count every ngram in the given words
+
+		Words shorter than ngram_size or with characters other than
+		lowercase ascii letters are skipped.
+
+		Args:
+		  words: An iterable of strs.
+		"""
+		size = self.ngram_size
+		first = self.first
+		follows = self.follows
+		word_count = 0
+		for word in words:
+			if len(word) < size or word.translate(None, string.ascii_lowercase):
+				continue
+			word_count += 1
+			first[word[:size]] += 1
+			word += self.END_MARKER
+			for idx in xrange(len(word) - size):
+				follows[word[idx:idx + size + 1]] += 1
+		self.word_count += word_count
+
+	def ingest_file(self, filename, chunk_size=10000):
+		"""Count every ngram in a corpus file, streaming it in chunks
+
+		Args:
+		  filename: A str. A file with one word per line.
+		  chunk_size: An int. See read_chunks. [Default: 10000]
+		"""
+		for chunk in read_chunks(filename, chunk_size):
+			self.ingest(chunk)
+
+	def merge(self, other):
+		"""Add the counts of another NGramCounts to these counts
+
+		Args:
+		  other: An NGramCounts with the same ngram_size.
+		"""
+		assert other.ngram_size == self.ngram_size
+		self.word_count += other.word_count
+		for key, count in other.first.iteritems():
+			self.first[key] += count
+		for key, count in other.follows.iteritems():
+			self.follows[key] += count
+
+	def add_model(self, generator):
+		"""Add the counts held by an existing model to these counts
+
+		Args:
+		  generator: A WordGenerator or CompactWordGenerator with the
+		    same ngram_size.
+		"""
+		assert generator.ngram_size == self.ngram_size
+		chars = string.ascii_lowercase + self.END_MARKER
+		ngrams, first_counts, next_counts = compact_counts(generator)
+		self.word_count += generator.word_count
+		for ngram, first_count, row in zip(ngrams, first_counts, next_counts):
+			if first_count:
+				self.first[ngram] += first_count
+			for char, count in zip(chars, row):
+				if count:
+					self.follows[ngram + char] += count
+
+	def counts(self):
+		"""Returns the counts in the form taken by compact_tables"""
+		ngrams = sorted(set(key[:-1] for key in self.follows))
+		ids = dict((ngram, idx) for idx, ngram in enumerate(ngrams))
+		first_counts = [self.first.get(ngram, 0) for ngram in ngrams]
+		next_counts = [[0] * 27 for _ in ngrams]
+		for key, count in self.follows.iteritems():
+			next_counts[ids[key[:-1]]][self.FOLLOW_INDEX[key[-1]]] = count
+		return ngrams, first_counts, next_counts
+
+	def save(self, filename):
+		"""Write these counts to a compact model file"""
+		write_compact(filename, self.ngram_size, self.word_count, *self.counts())
+
+	def to_generator(self):
+		"""Returns an in-memory CompactWordGenerator for these counts"""
+		keys, first_table, next_table, next_ids = compact_tables(*self.counts())
+		count = len(first_table)
+		return CompactWordGenerator(self.ngram_size, self.word_count,
+			MappedArray(keys, 0, count, "{0}s".format(self.ngram_size)),
+			first_table, next_table, next_ids)
+
+
+def file_shards(filename, shard_count):
+	"""Split a corpus file into byte ranges of roughly equal size
+
+	Args:
+	  filename: A str. A file with one word per line.
+	  shard_count: An int. The number of shards.
+
+	Returns: A list of (filename, start, end) tuples. See read_shard.
+	"""
+	size = os.path.getsize(filename)
+	bounds = [size * idx // shard_count for idx in xrange(shard_count + 1)]
+	return [(filename, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def read_shard(filename, start, end):
+	"""Stream the words of a byte range of a corpus file
+
+	A word belongs to the shard its line starts in, so shards from
+	file_shards cover every word exactly once.
+
+	Args:
+	  filename: A str. A file with one word per line.
+	  start: An int. The first byte of the shard.
+	  end: An int. The byte after the last byte of the shard.
+
+	Returns: An iterator of stripped words.
+	"""
+	with open(filename, "rb") as corpus:
+		if start:
+			# skip the rest of a line started in the previous shard
+			corpus.seek(start - 1)
+			corpus.readline()
+		pos = corpus.tell()
+		while pos < end:
+			line = corpus.readline()
+			if not line:
+				break
+			pos += len(line)
+			yield line.strip()
+
+def count_shard(shard):
+	"""Count the ngrams of one shard for each of several ngram sizes
+
+	Args:
+	  shard: A tuple (filename, start, end, sizes) of a shard from
+	    file_shards and a list of ngram sizes.
+
+	Returns: A list of NGramCounts, one per size.
+	"""
+	filename, start, end, sizes = shard
+	models = [NGramCounts(size) for size in sizes]
+	for chunk in read_chunks_from(read_shard(filename, start, end)):
+		for counts in models:
+			counts.ingest(chunk)
+	return models
+
+def parallel_counts(filenames, sizes, processes=None, shards_per_process=4):
+	"""Count the ngrams of several corpus files with a process pool
+
+	Each file is split into byte range shards that are counted in
+	separate processes, and the partial counts are merged in shard
+	order. Counts are exact, so the result is the same for any
+	number of processes.
+
+	Args:
+	  filenames: A list of strs. Files with one word per line.
+	  sizes: A list of ints. The ngram sizes to count.
+	  processes: An int. The size of the process pool. [Default: the
+	    number of cpus]
+	  shards_per_process: An int. How many shards each file is split
+	    into per process, to even out uneven shards. [Default: 4]
+
+	Returns: A list of NGramCounts, one per size.
+	"""
+	processes = processes or multiprocessing.cpu_count()
+	shards = []
+	for filename in filenames:
+		shards.extend(shard + (sizes,) for shard in file_shards(filename, processes * shards_per_process))
 
+	models = [NGramCounts(size) for size in sizes]
+	pool = multiprocessing.Pool(processes)
+	try:
+		for partial in pool.imap(count_shard, shards):
+			for counts, part in zip(models, partial):
+				counts.merge(part)
+	finally:
+		pool.close()
+		pool.join()
+	return models
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+import random
+import string
+import sys
+import time
+
+import word_generator
+
+#Compare words per second of the linear scan samplers against the alias tables
+#usage: word_generator_benchmark.py [model] [words]
+
+def linear_first_ngram(generator):
+	"""The original first ngram sampler, walking every ngram in probs"""
+	val = random.random()
+	sum_so_far = 0.0
+	ngram_iter = generator.probs.itervalues()
+	while sum_so_far < val:
+		ngram = next(ngram_iter)
+		sum_so_far += ngram.first_prob
+	return ngram.ngram
+
+def linear_letter(ngram):
+	"""The original next letter sampler, walking next_letter_probs"""
+	val = random.random()
+	sum_so_far = 0.0
+	idx = -1
+	while sum_so_far < val:
+		idx += 1
+		sum_so_far += ngram.next_letter_probs[idx]
+	if idx == word_generator.NGram.END_OF_WORD:
+		return None
+	return string.ascii_lowercase[idx]
+
+def linear_word(generator):
+	"""The original generate_word, built on the linear scan samplers"""
+	word = linear_first_ngram(generator)
+	idx = 0
+	next_letter = linear_letter(generator.probs[word[idx:idx+generator.ngram_size]])
+	while next_letter:
+		word += next_letter
+		idx += 1
+		next_letter = linear_letter(generator.probs[word[idx:idx+generator.ngram_size]])
+	return word
+
+def words_per_second(generate, count):
+	random.seed(0)
+	start = time.time()
+	for _ in xrange(count):
+		generate()
+	return count / (time.time() - start)
+
+if __name__ == "__main__":
+	model = sys.argv[1] if len(sys.argv) > 1 else "word_gen3.pickle"
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+	generator = word_generator.load(model)
+	before = words_per_second(lambda: linear_word(generator), count)
+	after = words_per_second(generator.generate_word, count)
+	print "{0} ngrams, {1} words".format(len(generator.probs), count)
+	print "linear scan: {0:10.0f} words/s".format(before)
+	print "alias table: {0:10.0f} words/s".format(after)
+	print "speedup:     {0:10.1f}x".format(after / before)
@@ -1,16 +1,41 @@
 #! /usr/bin/env python
 
-import cPickle
-import string
+import argparse
 
-from word_generator import WordGenerator
+from word_generator import NGramCounts, load, parallel_counts, read_chunks
 
-#Generate and pickle a WordGenerator for fast loading later
+#Count ngrams in one or more corpora and save compact models for fast loading later
 
-ngrams = 3
-wordlist = open("/usr/share/dict/words").readlines()
-wordlist = [word.strip() for word in wordlist if all(c in string.ascii_lowercase for c in word.strip())]
-w = WordGenerator(wordlist, ngrams)
-w.finalize_probabilities()
+parser = argparse.ArgumentParser(description="Build compact word models from word lists.")
+parser.add_argument("corpus", nargs="*",
+	help="files with one word per line [default: /usr/share/dict/words, unless --base is given]")
+parser.add_argument("-n", "--ngrams", default="3",
+	help="comma separated ngram sizes to build a model for each [default: 3]")
+parser.add_argument("-b", "--base",
+	help="an existing model or pickle to add the corpus counts to, instead of starting from scratch")
+parser.add_argument("-c", "--chunk-size", type=int, default=10000,
+	help="words read from a corpus at a time [default: 10000]")
+parser.add_argument("-p", "--processes", type=int, default=1,
+	help="count shards of the corpora in this many processes, 0 for one per cpu [default: 1]")
+args = parser.parse_args()
 
-cPickle.dump(w, open("word_gen{0}.pickle".format(ngrams), "wb"))
+sizes = [int(size) for size in args.ngrams.split(",")]
+corpora = args.corpus or ([] if args.base else ["/usr/share/dict/words"])
+
+if args.processes != 1:
+	models = parallel_counts(corpora, sizes, args.processes)
+else:
+	models = [NGramCounts(size) for size in sizes]
+	# read each corpus once, counting every ngram size from the same chunks
+	for corpus in corpora:
+		for chunk in read_chunks(corpus, args.chunk_size):
+			for counts in models:
+				counts.ingest(chunk)
+
+if args.base:
+	base = load(args.base)
+	for counts in models:
+		counts.add_model(base)
+
+for counts in models:
+	counts.save("word_gen{0}.model".format(counts.ngram_size))
@@ -0,0 +1,35 @@
+#! /usr/bin/env python
+
+import random
+import unittest
+
+import word_generator
+
+class GenerateWordsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.generator = word_generator.WordGenerator(["cat", "cart", "dog", "door"])
+		self.generator.finalize_probabilities()
+		self.rng = random.Random(0)
+
+	def test_in_range(self):
+		words = word_generator.generate_words(self.generator, 20, 3, 4, self.rng)
+		self.assertEqual(len(words), 20)
+		for word in words:
+			self.assertTrue(3 <= len(word) <= 4)
+
+	def test_max_len_below_ngram_size(self):
+		with self.assertRaises(ValueError):
+			word_generator.generate_words(self.generator, 1, max_len=1, rng=self.rng)
+
+	def test_min_len_above_max_len(self):
+		with self.assertRaises(ValueError):
+			word_generator.generate_words(self.generator, 1, 5, 4, self.rng)
+
+	def test_min_len_out_of_reach(self):
+		# the model never makes a word longer than 4 letters
+		with self.assertRaises(ValueError):
+			word_generator.generate_words(self.generator, 1, min_len=50, rng=self.rng)
+
+if __name__ == "__main__":
+	unittest.main()